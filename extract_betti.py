@@ -18,18 +18,24 @@ import matplotlib.pyplot as plt
 import re
 import os
 import rbc_npy2Perseus as n2p
+import rbc_framestore
+import rbc_stats
 
 def extract_betti (persFiles, files, b_num, threshold):
     """
         Extract betti number time series from cell at for sublevel sets below threshold
         persFiles is directory of perseus output for cell
-        files is directory for associated .npys
+        files is directory for associated .npys, or a frame store
+        (packed or not, see rbc_framestore)
         b_num is betti number
         threshold is factor of mean desired (i.e. .5-1.5)
     """
     if not persFiles.endswith('/'):
         persFiles+='/'
-    if not files.endswith('/'):
+    store = None
+    if rbc_framestore.is_store(files):
+        store = rbc_framestore.open_store(files)
+    elif not files.endswith('/'):
         files+='/'
     if os.path.isdir (persFiles):
         dlist = os.listdir(persFiles)
@@ -50,9 +56,13 @@ def extract_betti (persFiles, files, b_num, threshold):
         with open(persFiles+frame, 'r') as f:
             s = f.read()
         f.close()
-        data = numpy.load(files+frame.rstrip('_betti.txt')+'.npy')
-        #dM = data[data>0].mean() #USE MEAN
-        dM = numpy.median(data[data>0])
+        #median of the in-cell pixels, from the stats table (see rbc_stats)
+        if store is not None:
+            k = int(frame[:-len('_betti.txt')].rpartition('_')[-1])
+            dM = rbc_stats.frame_stat(store.fname, 'median', k)
+        else:
+            dM = rbc_stats.frame_stat(files+frame.rstrip('_betti.txt')+'.npy', 'median')
+        #dM = rbc_stats.frame_stat(..., 'mean') #USE MEAN
         tHeight = threshold*dM
         dstr = s.split('\n')
         dstr.pop(0)#pop '' - could use .remove('')
@@ -7,6 +7,9 @@ import os, errno
 import cPickle as pkl
 import chomp_betti
 import rbc_basic
+import rbc_framestore
+import rbc_boundary
+import rbc_catalog
 import time, shutil
 
 
@@ -25,7 +28,7 @@ def run_fft_filter( files, bnd_file, modes, suffix= 'fft_frames/bandpass/',
     images at the mean (of pixels inside the cell boundary). Save the
     thresholded image to fft_frames/ directory.
 
-    fdir : directory to frames
+    fdir : directory to frames, or a frame store (see rbc_framestore)
 
     modes : percentage of modes (low->high) to use for low-pass filter
 
@@ -33,8 +36,14 @@ def run_fft_filter( files, bnd_file, modes, suffix= 'fft_frames/bandpass/',
 
     
     """
+    store = None
     # grab all frames, skip the directories
-    if os.path.isdir( files ):
+    if rbc_framestore.is_store( files ):
+        store = rbc_framestore.open_store( files )
+        fdir = store.fdir
+        files = fdir
+        frames = range( len( store ) )
+    elif os.path.isdir( files ):
         fdir = files + '/'
         dlist = os.listdir( fdir )
         if os.uname()[0] == 'Linux':
@@ -52,14 +61,20 @@ def run_fft_filter( files, bnd_file, modes, suffix= 'fft_frames/bandpass/',
     # create the directory if necessary
     make_dir( savedir )
 
-    frames.sort( key=rbc_basic.natural_key )
+    if store is None:
+        frames.sort( key=rbc_basic.natural_key )
+    # buffer the boundary by trimming one pixel off the edge. The
+    # boundary is loaded (and buffered) once per cell and shared.
+    bnd = rbc_boundary.get_boundary( bnd_file ).buffered
     # list to hold frames in case we are saving them
     images = []
     # hold data
     filtered_frames = []
     # compute fft and filtered ifft on (normed) images
     for frame in frames:
-        if frame.endswith( 'npy' ):
+        if store is not None:
+            savename = store.frame_name( frame )
+        elif frame.endswith( 'npy' ):
             savename = frame.rstrip( '.npy' )
         elif frame.endswith( 'txt' ):
             savename = frame.rstrip( '.txt' )
@@ -70,15 +85,15 @@ def run_fft_filter( files, bnd_file, modes, suffix= 'fft_frames/bandpass/',
         # store the modes. This is a single number or a tuple
         # (interval)
         fft_data[ 'modes' ] = modes
-        try:
-            image = numpy.loadtxt( fdir+frame )
-        except ValueError:
-            image = numpy.load( fdir+frame )
-        except IOError:
-            raise
-        bnd = numpy.loadtxt( bnd_file )
-        # buffer the boundary by trimming one pixel off the edge
-        bnd = buffer_boundary( bnd )
+        if store is not None:
+            image = store[ frame ]
+        else:
+            try:
+                image = numpy.loadtxt( fdir+frame )
+            except ValueError:
+                image = numpy.load( fdir+frame )
+            except IOError:
+                raise
         image = bnd * image
         # normalize the images and shift (in z direction) so centered
         # at zero
@@ -166,7 +181,8 @@ def normalize_image( img ):
     subtracting the mean.
     """
     vmax = img.max()
-    img = img / vmax
+    # upcast, frames may be stored as compact integers
+    img = img / float( vmax )
     vmean = img.mean()
     return img - vmean
 
@@ -327,27 +343,11 @@ def ideal_low_pass( X, r=0.2, metric='L2' ):
 def buffer_boundary( bnd ):
     """
     Simple 1 pixel buffer that shrinks the boundary matrix.
+
+    See rbc_boundary.get_boundary( bnd_file ).buffered for a cached
+    copy.
     """
-    # indices 'inside' cell
-    wb = np.where( bnd )
-    coords = zip( wb[0], wb[1] )
-    buff = bnd.copy()
-    for i,j in coords:
-        if bnd[i-1,j] == 0:
-            buff[i,j] = 0
-            continue
-        elif bnd[i,j-1] == 0:
-            buff[i,j] = 0
-            continue
-        elif bnd[i+1,j] == 0:
-            buff[i,j] = 0
-            continue
-        elif bnd[i,j+1] == 0:
-            buff[i,j] = 0
-            continue
-        else:
-            continue
-    return buff
+    return rbc_boundary.erode( bnd )
 
 def plot_3d( img ):
 
@@ -579,10 +579,10 @@ def fft_analyze( cell_dir, modes, dim=0, max_dim=2 ):
     print "Finding all .betti files with mode", str( modes )
     cell_dir += 'r'+modes +'_betti/'
     print "dir", cell_dir
-    dlist = os.listdir( cell_dir ) 
+    dlist = rbc_catalog.get_catalog( cell_dir ).files( 'fft_betti_r'+modes )
     # concatenate_fft_modes( cell_dir, modes )
     loadtxt = numpy.loadtxt
-    betti_list = [ loadtxt( cell_dir+f )[:,1] for f in dlist ]
+    betti_list = [ loadtxt( f )[:,1] for f in dlist ]
     betti_arr = numpy.array( betti_list )
     return betti_arr[:,dim].mean(), betti_arr[:,dim].var() #, numpy.median( betti_arr[:,dim] )
 
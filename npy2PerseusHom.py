@@ -21,6 +21,7 @@ import matplotlib.pylab as plt
 import re
 import os
 import rbc_npy2Perseus as n2p
+import rbc_framestore
 
 def write_file ( fname, output ):
     """ 
@@ -41,23 +42,8 @@ def write_file ( fname, output ):
     """
     #Load npy file
     data = numpy.load(fname)
-    size = data.shape#(203,198)
-    dim = len ( size )
-    #Open file
-    text = open (output + ".txt", "w")
-    #Write number of dimensions
-    text . write (str(dim) + "\n")
-    #Write resolutions
-    for i in xrange(len(size)):
-        text . write (str(size[i]) + "\n")
-    #Write strictly 2D file
-    for i in xrange(size[0]):#203
-        for j in xrange(size[1]):#198
-            if int(data[i][j]) == 0:
-                text . write (str(-1) + "\n")
-            else:
-                text . write (str(1) + "\n")
-    text . close()
+    #header and grid in one write, nonzero -> 1, 0 -> -1
+    n2p.write_dense (data, output + ".txt", binary=True)
 
 def write_sparse_file ( fname, output):
     """
@@ -156,7 +142,15 @@ def write_block_dense ( files, output, m, n ):
         - DENSE CUBICAL TOPLEX FORMAT
         - m is index of frame to start from (index start at 0)
         - n is index of frame to end at
+        - files may also be a frame store (see rbc_framestore)
         """
+    if rbc_framestore.is_store (files):
+        store = rbc_framestore.open_store (files)
+        dims = (len(store),) + tuple(store.frame_shape)
+        #sizes are written backward
+        n2p.write_dense (store[m:n+1], output + ".txt", dims=dims[::-1],
+                         binary=True)
+        return
     #grab files, skip directories
     if os.path.isdir (files):
         fdir = files + '/'
@@ -184,23 +178,16 @@ def write_block_dense ( files, output, m, n ):
             print 'End index out of bounds'
             return
     #Sort frames
-    frames.sort(key=natural_key)
+    frames.sort(key=n2p.natural_key)
     #Open file ( and write dimensions )
     text = open (output + ".txt", "w")
     text . write (str(numDim) + "\n")
     for i in xrange(len(dataDims)):
         #text . write (str(dataDims[i]) + "\n") #Iterate forward
         text . write (str(dataDims[-1-i]) + "\n")#Iterate backward
-    #Write data
-    for ind, frame in zip(xrange(len(frames)),frames):
-        if ind >= m and ind <= n: #if within block
-            data = numpy.load(files+frame)
-            for i in xrange(imgSize[0]):
-                for j in xrange(imgSize[1]):
-                    if int(data[i][j]) == 0:
-                        text . write (str(-1) + "\n")
-                    else:
-                        text . write (str(1) + "\n")
+    #Write data, only the frames within the block are loaded
+    block = [numpy.load(files+frame) for frame in frames[m:n+1]]
+    text . write (n2p.format_dense(block, binary=True))
     text . close()
 
 def write_block_sparse ( files, output, m, n ):
@@ -1,10 +1,12 @@
 import numpy
 import time
-import csv
 import os
+from multiprocessing import Pool, cpu_count
+import rbc_framestore
+import rbc_stats
 
 
-def cell2npy( fname, skip=0 ):
+def cell2npy( fname, skip=None ):
     """
     Sometimes a cell image is stored in a DOS file format, with
     approximately 200 lines. This reads the file and converts the
@@ -14,48 +16,150 @@ def cell2npy( fname, skip=0 ):
     skip these and fill the numpy arrays from the fifth line (i=4 in
     zero-based indexing).
 
+    The whole body of the file is tokenized at once by numpy, rather
+    than converting each value with int().
+
     fname -- full path to the file
+
+    skip -- number of header lines to skip. Default (None) skips all
+    leading lines that are not a row of pixel values (ie., the
+    dimensions, the 'I' and the blank line).
     """
     # this convert from DOS newline format ('U'==universal newline)
-    reader = csv.reader( open( fname, 'rU' ), delimiter='\t' )
-    lines = list( reader )
-    # convert strings to ints
-    rows = [ [ int( val ) for val in row[:-1] ] for row in lines[skip:] ]
-    try:
-        return numpy.vstack( rows[skip:] )
-    except ValueError:
-        print "problem with rows, here are the first 10:", rows[:10]
-                       
-    
-def stack_cell( cell, fdir ):
-    """
-    fdir -- directory containing the Complement cell image frames.
+    with open( fname, 'rU' ) as fh:
+        if skip is None:
+            # header lines have at most one token
+            line = fh.readline()
+            while line and len( line.split() ) <= 1:
+                line = fh.readline()
+        else:
+            for i in xrange( skip ):
+                fh.readline()
+            line = fh.readline()
+            # skip blank lines
+            while line and not line.strip():
+                line = fh.readline()
+        ncols = len( line.split() )
+        body = line + fh.read()
+    if ncols == 0:
+        print "no rows found in", fname
+        return None
+    vals = numpy.fromstring( body, dtype=numpy.int64, sep=' ' )
+    if vals.size % ncols != 0:
+        print "problem with rows in", fname, ":", vals.size, \
+            "values is not a multiple of", ncols, "columns"
+        return None
+    return rbc_framestore.to_compact( vals.reshape( (-1, ncols) ) )
 
-    Return a 3D numpy array, with the third axis corrseponding to
-    time.
+
+def cell_frames( cell, fdir ):
+    """
+    Sorted frame file names of <cell>, a subdirectory of <fdir>.
     """
     if not fdir.endswith( '/' ): fdir+='/'
     dlist = os.listdir( fdir + cell + '/' )
     dlist.sort()
-    all_frames = []
-    print "converting frames..."
+    # this skips any hidden files... a little error handling at
+    # least :}
+    return [ frame for frame in dlist if not frame.startswith('.') ]
+
+def stack_cell( cell, fdir, dtype=None ):
+    """
+    fdir -- directory containing the Complement cell image frames.
+
+    dtype -- dtype of the frame store. Default is the compact dtype of
+    the first frame (see rbc_framestore.compact_dtype()).
+
+    Writes the frames of <cell> to a frame store,
+    <fdir><cell>_stack.npy, with time along the first axis, and the
+    per-frame statistics next to it (see rbc_stats). Returns the
+    FrameStore.
+    """
+    if not fdir.endswith( '/' ): fdir+='/'
+    dlist = cell_frames( cell, fdir )
+    if not dlist:
+        raise ValueError( "no frames in cell " + cell + " (" + fdir + cell + "/)" )
+    savefile = fdir + cell + rbc_framestore.STORE_SUFFIX
+    store = None
+    print "converting frames for", cell, "..."
     tstart = time.time()
-    for frame in dlist:
-        # this skips any hidden files... a little error handling at
-        # least :}
-        if frame.startswith('.'): continue
-        all_frames.append( cell2npy( fdir + cell + '/' + frame ) )
+    for k, frame in enumerate( dlist ):
+        arr = cell2npy( fdir + cell + '/' + frame )
+        if arr is None:
+            raise ValueError( "could not convert frame " + fdir + cell + \
+                              '/' + frame )
+        if store is None:
+            if dtype is None:
+                dtype = arr.dtype
+            store = rbc_framestore.create_store( savefile, len( dlist ),
+                                                 arr.shape, dtype=dtype,
+                                                 name=cell,
+                                                 source=fdir + cell + '/' )
+        store.data[k] = rbc_framestore.to_compact( arr, dtype )
+    store.flush()
+    del store
+    rbc_stats.write_stats( savefile )
     print "It took ", time.time() - tstart, "seconds for converting", \
-        len( dlist ), "frames."
-    numpy.save( fdir + cell, all_frames )
-    return numpy.array( all_frames, dtype=numpy.int )
+        len( dlist ), "frames of", cell
+    return rbc_framestore.open_store( savefile )
+
+def _stack_cell( args ):
+    """
+    Pool.map() helper. Returns the path to the store rather than the
+    store itself, so nothing large is pickled back to the parent.
+    Returns None for a cell without frames.
+    """
+    cell, fdir, dtype = args
+    if not cell_frames( cell, fdir ):
+        print "skipping cell", cell, ": no frames"
+        return None
+    return stack_cell( cell, fdir, dtype ).fname
+
+def stack_cells( cells, fdir, nproc=None, dtype=None ):
+    """
+    Convert every cell in <cells> to a frame store, <nproc> cells at a
+    time.
+
+    cells -- list of cell names (subdirectories of <fdir>)
+
+    fdir -- directory containing the Complement cells
+
+    nproc -- number of worker processes. Default is cpu_count().
+
+    Returns a dict of FrameStores keyed by cell name. Cells without
+    frames are skipped.
+    """
+    if nproc is None:
+        nproc = cpu_count()
+    nproc = max( 1, min( nproc, len( cells ) ) )
+    args = [ ( cell, fdir, dtype ) for cell in cells ]
+    tstart = time.time()
+    if nproc == 1:
+        fnames = map( _stack_cell, args )
+    else:
+        pool = Pool( processes=nproc )
+        try:
+            fnames = pool.map( _stack_cell, args )
+        finally:
+            pool.close()
+            pool.join()
+    print "It took ", time.time() - tstart, "seconds for converting", \
+        len( cells ), "cells using", nproc, "processes."
+    return dict( ( cell, rbc_framestore.open_store( f ) )
+                 for cell, f in zip( cells, fnames ) if f is not None )
 
 if __name__ == "__main__":
 
+    import sys
+
     celldir = '/data/jberwald/wyss/data/rbc/cells/'
     cells = [ 'new_3', 'new_4', 'new_5', 'new_6', 'new_7', 'new_8', 'new_9',
               'old_10', 'old_2', 'old_5', 'old_6', 'old_7', 'old_8', 'old_9' ]
 
-    for cell in cells:
-        print "Lumping frames for cell", cell, "into a 3D array..."
-        stack_cell( cell, celldir )
+    # optional number of worker processes
+    if len( sys.argv ) > 1:
+        nproc = int( sys.argv[1] )
+    else:
+        nproc = None
+    print "Lumping frames for", len( cells ), "cells into frame stores..."
+    stack_cells( cells, celldir, nproc=nproc )
@@ -3,6 +3,11 @@ from matplotlib import pyplot as plt
 import os, shutil
 import csv
 import time
+import rbc_basic
+import rbc_framestore
+import rbc_boundary
+import rbc_catalog
+import rbc_stats
 try:
     from jjb.chomp import chomp_betti
 except ImportError:
@@ -30,8 +35,7 @@ def plot_raw_cell( fname, **args ):
     skiprows = fargs['skiprows']
 
     # load boundary matrix for dimensions of cell array
-    bnd_arr = numpy.loadtxt( fargs['bnd'] )
-    nx,ny = bnd_arr.shape
+    nx,ny = rbc_boundary.get_boundary( fargs['bnd'] ).shape
     frames = load_rbc( fname, skiprows, nx, ny )
     num_cols = len( frames ) # for subplot 
 
@@ -66,9 +70,7 @@ def load_rbc( fname, skiprows, nx, ny ):
     according to boundary data determined from <bnd> arg in
     plot_raw_data().
     """
-    C = numpy.loadtxt( fname, skiprows=skiprows )    
-    cell_frames = [ C[i].reshape(( nx,ny )) for i in range( 5000-skiprows ) ]
-    return cell_frames
+    return rbc_basic.load_rbc( fname, skiprows, nx=nx, ny=ny )
 
 def complement2npy( fname ):
     """
@@ -84,7 +86,7 @@ def complement2npy( fname ):
     # convert strings to ints
     rows = [ [ int( val ) for val in row[:-1] ] for row in lines[4:] ]
     try:
-        return numpy.vstack( rows[4:], dtype=numpy.int )
+        return rbc_framestore.to_compact( numpy.vstack( rows[4:] ) )
     except ValueError:
         print "problem with rows, here are the first 10:", rows[:10]
                        
@@ -107,7 +109,7 @@ def extract_complement_cell( fdir ):
         all_frames.append( complement2npy( fdir + frame ) )
     print "Took ", time.time() - tstart, "seconds for converting", \
         len( dlist ), "frames."
-    return numpy.array( all_frames )
+    return rbc_framestore.to_compact( numpy.array( all_frames ) )
     
 
 def make_dir( fdir ):
@@ -120,10 +122,14 @@ def make_dir( fdir ):
         if e.errno != errno.EEXIST:
             raise
     
-def extract_frames( fname, bnd ):
+def extract_frames( fname, bnd, store=False ):
     """
     Each line of fname contains a raveled matrix. Read each line,
     reshape it based on array stored in <bnd> file. Save to file.
+
+    store -- if True, write all frames to a single frame store (see
+    rbc_framestore) in the frames/ subfolder instead of one NPY file
+    per frame.
     """
     if os.uname()[0] == 'Linux':
         savefunc = numpy.save
@@ -131,9 +137,9 @@ def extract_frames( fname, bnd ):
         # why the !@$# doesn't Mac save readable .npy files??
         savefunc = numpy.savetxt
     fh = open( fname, 'r' )
-    bnd_arr = numpy.loadtxt( bnd )
-    nx, ny = bnd_arr.shape
-    bnd_arr = bnd_arr.ravel()
+    boundary = rbc_boundary.get_boundary( bnd )
+    nx, ny = boundary.shape
+    bnd_arr = boundary.ravel
     # save files in a special folder
     part = fname.rpartition( '/' )
     cell_name = part[-1]
@@ -144,10 +150,17 @@ def extract_frames( fname, bnd ):
 
     make_dir( savedir )
     # print 'savedir', savedir
+
+    if store:
+        fh.close()
+        savefile = savedir + cell_name + rbc_framestore.STORE_SUFFIX
+        return rbc_basic.cell2npy_stream( fname, bnd, rows=(nx,ny),
+                                          savefile=savefile )
      
     # loop over lines in <fname> and save each as nx x ny array
     #k = 0. 
     fromstring = numpy.fromstring
+    stats = []
     for k, line in enumerate( fh.readlines() ):
         arr = fromstring( line, sep='\t' )
         # remove boundary
@@ -155,6 +168,15 @@ def extract_frames( fname, bnd ):
         arr.resize( (nx,ny) )
         #numpy.save( savedir + cell_name + '_' + str(k), arr )
         savefunc( savedir + cell_name + '_' + str(k), arr )
+        stats.append( rbc_stats.frame_stats( arr[numpy.newaxis] ) )
+    # per-frame statistics, see rbc_stats
+    if stats:
+        stats = rbc_stats.concat_stats( stats )
+        if savefunc is numpy.save:
+            stats.update( rbc_stats.file_stats( [ savedir + cell_name + '_' + str(k) + '.npy'
+                                                  for k in xrange( len( stats['max'] ) ) ] ) )
+        rbc_stats.save_stats( savedir + cell_name + rbc_stats.STATS_SUFFIX,
+                              numpy.arange( len( stats['max'] ) ), stats )
 
 def frames2png( fdir ):
     """
@@ -304,21 +326,12 @@ def read_betti_dir( fdir, val ):
     """
     Read all .betti files in a directory and sort them for time series analysis.
     """
-    dlist = os.listdir( fdir )
-    # focus on one threshold value
-    ending = str( val ) + '.betti'
-    betti_list = [ f for f in dlist if f.endswith( ending ) ]
-
-    betti_dict = dir_hash( betti_list )
-    frames = betti_dict.keys()
-    frames.sort()
-    # keep the frame numbers organized in a dict ?
-    #betti = {}
-    # nah, just list them, but append them in frame order
+    # focus on one threshold value; the catalog returns the files in
+    # frame order
+    betti_list = rbc_catalog.get_catalog( fdir ).files( 'chomp_betti_'+str( val ) )
     betti_arr = []
-    for i in frames:
-        b = betti_dict[i]
-        bnums = numpy.loadtxt( fdir+b, dtype=numpy.uint8 )
+    for b in betti_list:
+        bnums = numpy.loadtxt( b, dtype=numpy.uint8 )
         betti_arr.append( bnums )
     betti_arr = numpy.asarray( betti_arr )
     return betti_arr.T
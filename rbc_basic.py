@@ -22,10 +22,19 @@ In [4]: R.plot_frame( f[0] )
 directory as this module. Note the halo--the boundary has not been
 removed.)
 
+The first call to load_rbc() builds a sidecar index
+(<fname>.idx.npy) holding the byte offset of every frame, so later
+calls only read and parse the requested frames.
+
 """
 
 import numpy
+from itertools import islice
 import re
+import time
+import rbc_framestore
+import rbc_boundary
+import rbc_stats
 #import matplotlib
 #matplotlib.use( 'Agg' )
 import matplotlib.pyplot as plt
@@ -35,6 +44,8 @@ import matplotlib.cm as cmx
 import sys, os
 
 slash = '/'
+# sidecar file holding the byte offsets of each frame in a cell file
+INDEX_SUFFIX = '.idx.npy'
 
 def cell2npy( cell, bnd, rows=(203,198) ):
     """
@@ -46,7 +57,7 @@ def cell2npy( cell, bnd, rows=(203,198) ):
 
     row -- dimensions (tuple)
     """
-    bnd_arr = numpy.loadtxt( bnd )
+    bnd_arr = rbc_boundary.get_boundary( bnd ).ravel
     frames = []
     print "opening ", cell
     with open( cell, 'rU' ) as fh:
@@ -60,9 +71,118 @@ def cell2npy( cell, bnd, rows=(203,198) ):
             frames.append( arr )
     savefile = cell + '.npy'
     print "saving file to", savefile
-    stack = numpy.dstack( frames )
+    stack = rbc_framestore.to_compact( numpy.dstack( frames ) )
     numpy.save( savefile, stack )
     return stack
+
+def count_frames( cell ):
+    """
+    Count the frames (non-blank lines) in a concatenated cell file
+    without holding more than one line in memory.
+    """
+    nframes = 0
+    with open( cell, 'rU' ) as fh:
+        for line in fh:
+            if line.strip():
+                nframes += 1
+    return nframes
+
+def cell2npy_stream( cell, bnd, rows=(203,198), chunk=100, savefile=None,
+                     report=500, dtype=None ):
+    """
+    Streaming version of cell2npy(). Read <cell> <chunk> lines at a
+    time, remove the boundary, and append the frames to an NPY file on
+    disk (see rbc_framestore.create_writer()), in a single pass over
+    <cell>. Memory use is bounded by <chunk> frames, regardless of the
+    number of frames in the cell.
+
+    cell -- full path to concatenated file
+
+    bnd -- full path to boundary file
+
+    rows -- dimensions (tuple)
+
+    chunk -- number of lines parsed at once
+
+    savefile -- frame store to write to. Default is <cell>_stack.npy.
+    If <savefile> ends in rbc_framestore.ARCHIVE_SUFFIX, the frames
+    are written to a compressed archive instead.
+
+    report -- print progress (frames/sec) every <report> frames
+
+    dtype -- dtype of the store. Default is the compact dtype (see
+    rbc_framestore.compact_dtype()) of the first chunk. A ValueError
+    is raised if a later chunk does not fit; pass dtype explicitly
+    (eg., numpy.int16 or numpy.float64) in that case.
+
+    NOTE: frames are stored along the *first* axis, (frames, nx, ny),
+    unlike the dstack'ed array returned by cell2npy().
+
+    The per-frame statistics (see rbc_stats) are computed chunk by
+    chunk and saved next to the store.
+
+    Returns a read-only rbc_framestore.FrameStore.
+    """
+    rows = tuple( rows )
+    bnd_arr = rbc_boundary.get_boundary( bnd ).ravel
+    if savefile is None:
+        savefile = cell + rbc_framestore.STORE_SUFFIX
+    archive = savefile.endswith( rbc_framestore.ARCHIVE_SUFFIX )
+    store = None
+    stats = []
+    fromstring = numpy.fromstring
+    k = 0
+    tstart = time.time()
+    with open( cell, 'rU' ) as fh:
+        while True:
+            raw = list( islice( fh, chunk ) )
+            if not raw:
+                break
+            lines = [ line for line in raw if line.strip() ]
+            if not lines:
+                continue
+            n = len( lines )
+            block = fromstring( ''.join( lines ), sep=' ' )
+            block = block.reshape( (n, -1) )
+            # remove boundary
+            block *= bnd_arr
+            # the first chunk determines the dtype of the store
+            if store is None:
+                if dtype is None:
+                    dtype = rbc_framestore.compact_dtype( block )
+                meta = dict( name=cell.rpartition( slash )[-1],
+                             source=cell, boundary=bnd )
+                if archive:
+                    store = rbc_framestore.create_archive( savefile, rows,
+                                                           dtype, **meta )
+                else:
+                    store = rbc_framestore.create_writer( savefile, rows,
+                                                          dtype, **meta )
+                print "streaming frames to", savefile, "as", \
+                    numpy.dtype( dtype )
+            try:
+                block = rbc_framestore.to_compact( block, dtype )
+            except ValueError, e:
+                raise ValueError( "frames " + str( k ) + "-" + str( k+n-1 ) + \
+                                  ": " + str( e ) )
+            store.append( block.reshape( (n,)+rows ) )
+            stats.append( rbc_stats.frame_stats( block ) )
+            # report progress whenever we cross a multiple of <report>
+            if report and (k+n) // report > k // report:
+                elapsed = max( time.time() - tstart, 1e-6 )
+                rate = (k+n) / elapsed
+                print "  converted", k+n, "frames (", \
+                    round( rate, 1 ), "frames/sec )"
+            k += n
+    if k == 0:
+        raise ValueError( "no frames in " + cell )
+    store.close()
+    del store
+    rbc_stats.save_stats( rbc_stats.stats_name( savefile ), numpy.arange( k ),
+                          rbc_stats.concat_stats( stats ) )
+    print "It took ", time.time() - tstart, "seconds for converting", \
+        k, "frames."
+    return rbc_framestore.open_store( savefile )
     
 
 def natural_key(string_):
@@ -71,14 +191,75 @@ def natural_key(string_):
     """
     return [int(s) if s.isdigit() else s for s in re.split(r'(\d+)', string_)]
 
-def load_rbc( fname, skiprows, nx, ny ):
+def build_line_index( fname, save=True ):
     """
-    Returns a block of frames from <fname> cell data. Reshapes array
-    according to boundary data determined from nx, ny (determined from
-    corresponding boundary file).
+    Scan <fname> once and record the byte offset of every frame
+    (non-blank line). The last entry is the size of the file, so
+    frames k..n-1 occupy bytes offsets[k]:offsets[n].
+
+    save -- write the offsets to <fname>.idx.npy
+
+    Returns array of offsets (length = number of frames + 1).
+    """
+    offsets = []
+    pos = 0
+    with open( fname, 'rb' ) as fh:
+        for line in fh:
+            if line.strip():
+                offsets.append( pos )
+            pos += len( line )
+    offsets.append( pos )
+    offsets = numpy.array( offsets, dtype=numpy.int64 )
+    if save:
+        try:
+            numpy.save( fname + INDEX_SUFFIX, offsets )
+        except IOError:
+            print "could not save line index for", fname
+    return offsets
+
+def line_index( fname ):
+    """
+    Return the frame offsets for <fname>, reading the sidecar index if
+    it is still valid (newer than <fname> and matching its size) and
+    rebuilding it otherwise.
+    """
+    idx = fname + INDEX_SUFFIX
+    try:
+        if os.path.getmtime( idx ) >= os.path.getmtime( fname ):
+            offsets = numpy.load( idx )
+            if offsets[-1] == os.path.getsize( fname ):
+                return offsets
+    except (OSError, IOError, ValueError):
+        pass
+    return build_line_index( fname )
+
+def load_rbc( fname, skiprows, nx=203, ny=198, stop=None ):
+    """
+    Returns frames skiprows..stop-1 from <fname> cell data. Reshapes
+    array according to boundary data determined from nx, ny
+    (determined from corresponding boundary file).
+
+    Uses the byte-offset index (see line_index()) to seek directly to
+    frame <skiprows>, so only the requested frames are parsed.
+
+    stop -- one past the last frame to read. Default is the end of the
+    cell.
     """
-    C = numpy.loadtxt( fname, skiprows=skiprows )    
-    cell_frames = [ C[i].reshape(( nx,ny )) for i in range( 5000-skiprows ) ]
+    start = skiprows
+    offsets = line_index( fname )
+    nframes = len( offsets ) - 1
+    if stop is None or stop > nframes:
+        stop = nframes
+    if start < 0 or stop < start:
+        raise ValueError( "bad frame range [" + str( start ) + ", " + \
+                          str( stop ) + ") for cell with " + \
+                          str( nframes ) + " frames" )
+    with open( fname, 'rb' ) as fh:
+        fh.seek( offsets[start] )
+        buf = fh.read( offsets[stop] - offsets[start] )
+    C = numpy.fromstring( buf, sep=' ' )
+    C = rbc_framestore.to_compact( C.reshape( (stop-start, nx, ny) ) )
+    cell_frames = [ C[i] for i in range( stop-start ) ]
     return cell_frames
 
 def extract_frames( fname, bnd, to_png=True, save_prefix='/data/jberwald/old_png/old12' ):
@@ -93,9 +274,9 @@ def extract_frames( fname, bnd, to_png=True, save_prefix='/data/jberwald/old_png
         # why the !@$# doesn't Mac save readable .npy files??
         savefunc = numpy.savetxt
     fh = open( fname, 'r' )
-    bnd_arr = numpy.loadtxt( bnd )
-    nx, ny = bnd_arr.shape
-    bnd_arr = bnd_arr.ravel()
+    boundary = rbc_boundary.get_boundary( bnd )
+    nx, ny = boundary.shape
+    bnd_arr = boundary.ravel
     # save files in a special folder
     part = fname.rpartition( '/' )
     cell_name = part[-1]
@@ -215,7 +396,7 @@ def plot_sublevel_set( frame, height, bndfile=None, persfile=None,
     print "data", data.shape
     # if we read in a data file we might need a boundary file to go with it.
     if bndfile:
-        bnd = numpy.loadtxt( bndfile )
+        bnd = rbc_boundary.get_boundary( bndfile ).arr
         print "boundary", bnd.shape
         try:
             data = bnd.ravel() * data
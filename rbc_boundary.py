@@ -0,0 +1,170 @@
+"""
+Module containing a process-wide registry of cell boundaries. Each
+boundary file (boundary_Nov_*) is read once; the derived forms needed
+by the processing stages are computed once and shared, read-only.
+
+Useage:
+
+In [1]: import rbc_boundary as B
+
+In [2]: bnd = B.get_boundary( '/data/jberwald/rbc/New/boundary_Nov_new110125' )
+
+In [3]: frame = bnd.arr * frame     # remove the halo
+
+In [4]: frame[ bnd.mask ]           # pixels inside the cell
+
+Use boundary_file() to find the boundary for a cell name,
+eg. 'new_110125' --> <prefix>boundary_Nov_new110125.
+
+Frames can be packed down to the pixels inside the boundary (a 1D
+vector per frame) and unpacked again:
+
+In [5]: v = bnd.gather( frame )     # len( v ) == bnd.npix
+
+In [6]: frame = bnd.scatter( v )
+"""
+import numpy
+import os
+
+slash = '/'
+
+# cache of Boundary objects, keyed by absolute path of boundary file
+_registry = {}
+
+
+def boundary_file( prefix, cell ):
+    """
+    Return the path to the boundary file for <cell> (eg., 'new_110125'
+    or 'new_110125/') in directory <prefix>.
+    """
+    if not prefix.endswith( slash ): prefix += slash
+    cell = cell.rstrip( slash ).rpartition( slash )[-1]
+    # drop everything after the cell id (eg. -concatenated-ASCII)
+    cell = cell.partition( '-' )[0]
+    return prefix + 'boundary_Nov_' + cell.replace( '_', '' )
+
+def get_boundary( bnd ):
+    """
+    Return the (cached) Boundary for boundary file <bnd>. If <bnd> is
+    already a Boundary it is returned unchanged.
+    """
+    if isinstance( bnd, Boundary ):
+        return bnd
+    key = os.path.abspath( bnd )
+    try:
+        return _registry[ key ]
+    except KeyError:
+        b = Boundary( bnd )
+        _registry[ key ] = b
+        return b
+
+def clear_registry():
+    """
+    Forget all cached boundaries (eg., after a boundary file changes).
+    """
+    _registry.clear()
+
+def erode( bnd ):
+    """
+    Simple 1 pixel buffer that shrinks the boundary matrix. Same as
+    fft_image.buffer_boundary(): a pixel is removed if any of its four
+    neighbors lies outside the cell.
+    """
+    inside = bnd != 0
+    keep = inside.copy()
+    keep[1:,:] &= inside[:-1,:]
+    keep[:-1,:] &= inside[1:,:]
+    keep[:,1:] &= inside[:,:-1]
+    keep[:,:-1] &= inside[:,1:]
+    buff = bnd.copy()
+    buff[ ~keep ] = 0
+    return buff
+
+def _readonly( arr ):
+    arr.flags.writeable = False
+    return arr
+
+
+class Boundary( object ):
+    """
+    A cell boundary and its derived forms. All arrays are read-only so
+    they can be shared between stages.
+
+    arr -- boundary matrix as stored on disk (nx, ny)
+
+    ravel -- arr.ravel(), to multiply raveled frames
+
+    mask -- boolean (nx, ny) mask of pixels inside the cell
+
+    index -- flat indices of the pixels inside the cell
+
+    buffered -- arr with 1 pixel trimmed off the edge (see erode())
+
+    bbox -- ( (xmin, xmax), (ymin, ymax) ) of the pixels inside the
+    cell, inclusive
+    """
+    def __init__( self, fname ):
+        self.fname = fname
+        self.arr = _readonly( numpy.loadtxt( fname ) )
+        self.ravel = _readonly( self.arr.ravel() )
+        self.mask = _readonly( self.arr != 0 )
+        self.index = _readonly( numpy.flatnonzero( self.mask ) )
+        self.buffered = _readonly( erode( self.arr ) )
+        rows = numpy.flatnonzero( self.mask.any( axis=1 ) )
+        cols = numpy.flatnonzero( self.mask.any( axis=0 ) )
+        if len( rows ):
+            self.bbox = ( ( rows[0], rows[-1] ), ( cols[0], cols[-1] ) )
+        else:
+            self.bbox = None
+
+    def __repr__( self ):
+        return "Boundary( '" + self.fname + "', shape=" + str( self.shape ) + \
+            ", " + str( self.npix ) + " pixels )"
+
+    @property
+    def shape( self ):
+        return self.arr.shape
+
+    @property
+    def npix( self ):
+        """
+        Number of pixels inside the cell.
+        """
+        return len( self.index )
+
+    @property
+    def coords( self ):
+        """
+        ( rows, cols ) of the pixels inside the cell, in the same
+        (row-major) order as the packed vectors.
+        """
+        return numpy.unravel_index( self.index, self.shape )
+
+    def gather( self, frames, check=False ):
+        """
+        Pack a frame (nx, ny) or a stack of frames (n, nx, ny) down to
+        the pixels inside the cell. Returns a vector of length npix, or
+        an (n, npix) array.
+
+        check -- raise a ValueError if any pixel outside the cell is
+        nonzero (ie., the packing would not be lossless).
+        """
+        frames = numpy.asarray( frames )
+        flat = frames.reshape( frames.shape[:-2] + ( -1, ) )
+        if check:
+            if numpy.any( flat[..., ~self.mask.ravel()] ):
+                raise ValueError( "frame has nonzero pixels outside the boundary" )
+        return flat[..., self.index]
+
+    def scatter( self, packed, dtype=None ):
+        """
+        Inverse of gather(). Returns dense frame(s) with zeros outside
+        the cell.
+        """
+        packed = numpy.asarray( packed )
+        if dtype is None:
+            dtype = packed.dtype
+        lead = packed.shape[:-1]
+        dense = numpy.zeros( lead + ( self.arr.size, ), dtype=dtype )
+        dense[..., self.index] = packed
+        return dense.reshape( lead + self.shape )
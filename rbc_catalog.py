@@ -0,0 +1,303 @@
+"""
+Module containing a per-directory catalog of frame artifacts. A
+directory is listed and its file names parsed once; the result is
+pickled to CATALOG_DIR (one file per directory, named by the md5 of
+its absolute path, so writing it does not touch the directory) and
+only refreshed when the directory's mtime changes (ie., files were
+added or removed). Lookups by frame number are dict lookups.
+
+Useage:
+
+In [1]: import rbc_catalog as C
+
+In [2]: cat = C.get_catalog( '/data/PerseusData/PerseusOutput/original/2d_sparse/New/new_110125/' )
+
+In [3]: cat.path( 1000, 'dgm1' )     # Perseus H_1 diagram for frame 1000
+
+In [4]: cat.files( 'dgm1' )          # all H_1 diagrams, in frame order
+
+Artifact kinds are determined by PATTERNS (first match wins):
+
+npy -- frames, <name>_<k>.npy
+
+pers -- Perseus input, <name>_<k>.txt
+
+dgm0, dgm1, ... -- Perseus diagrams, <name>_<k>_<dim>.txt (but not
+<type>_<id>_<k>.txt, the Perseus input of complement cells such as
+new_3)
+
+betti -- Perseus betti numbers, <name>_<k>_betti.txt
+
+cub, cbetti -- chomp input/output, <name>_<k>.cub, <name>_<k>.cbetti
+
+fft_pkl_r05, fft_cub_r05, fft_betti_r05, ... -- fft_image output,
+<name>_<k>_r<mode>.<ext>
+
+chomp_betti_075, ... -- raw_cell chomp output,
+<type>_<id>_<k>_<thresh>.betti
+"""
+import os, re
+import time
+import thread
+import hashlib
+import cPickle as pkl
+
+slash = '/'
+
+# where catalogs are pickled, outside the cataloged directories
+CATALOG_DIR = os.environ.get( 'RBC_CATALOG_DIR',
+                              os.path.expanduser( '~/.rbc_catalogs' ) )
+# catalogs used to be kept in the directory itself; old ones are ignored
+CATALOG_NAME = '.catalog.pkl'
+# directory mtimes this recent (seconds) are not trusted, since files
+# added within the same timestamp tick would not change them
+MTIME_SLACK = 1.0
+
+# ( kind, regex ). Each regex has groups 'name' and 'frame', and
+# optionally 'sub', which is appended to the kind. Complement cells
+# are named <type>_<id> (eg. new_3), so new_3_5.txt is frame 5 of
+# new_3, not dgm5 of frame 3 of new.
+PATTERNS = [
+    ( 'dgm', re.compile( r'^(?![a-z]+_\d+_\d+\.txt$)(?P<name>.+)_(?P<frame>\d+)_(?P<sub>\d)\.txt$' ) ),
+    ( 'betti', re.compile( r'^(?P<name>.+)_(?P<frame>\d+)_betti\.txt$' ) ),
+    ( 'pers', re.compile( r'^(?P<name>.+)_(?P<frame>\d+)\.txt$' ) ),
+    ( 'npy', re.compile( r'^(?P<name>.+)_(?P<frame>\d+)\.npy$' ) ),
+    ( 'fft_pkl_', re.compile( r'^(?P<name>.+)_(?P<frame>\d+)_(?P<sub>r\d+)\.pkl$' ) ),
+    ( 'fft_cub_', re.compile( r'^(?P<name>.+)_(?P<frame>\d+)_(?P<sub>r\d+)\.cub$' ) ),
+    ( 'fft_betti_', re.compile( r'^(?P<name>.+)_(?P<frame>\d+)_(?P<sub>r\d+)\.betti$' ) ),
+    ( 'chomp_betti_', re.compile( r'^(?P<name>[a-z]+_\d+)_(?P<frame>\d+)_(?P<sub>[^_.]+)\.betti$' ) ),
+    ( 'cub', re.compile( r'^(?P<name>.+)_(?P<frame>\d+)\.cub$' ) ),
+    ( 'cbetti', re.compile( r'^(?P<name>.+)_(?P<frame>\d+)\.cbetti$' ) )
+    ]
+
+# in-process cache of catalogs, keyed by absolute directory path
+_catalogs = {}
+
+
+def natural_key(string_):
+    """
+    Use with frames.sort(key=natural_key)
+    """
+    return [int(s) if s.isdigit() else s for s in re.split(r'(\d+)', string_)]
+
+def parse_name( fname, patterns=PATTERNS ):
+    """
+    Return ( kind, name, frame ) for file name <fname>, or None if it
+    matches none of <patterns>.
+    """
+    for kind, regex in patterns:
+        m = regex.match( fname )
+        if m:
+            d = m.groupdict()
+            if d.get( 'sub' ):
+                kind += d['sub']
+            return kind, d['name'], int( d['frame'] )
+    return None
+
+def frame_number( fname ):
+    """
+    Frame number of the artifact <fname> (full path or file name), or
+    None if the name is not recognized.
+    """
+    parsed = parse_name( fname.rpartition( slash )[-1] )
+    if parsed:
+        return parsed[2]
+    return None
+
+def catalog_name( fdir ):
+    """
+    Path of the pickled catalog of directory <fdir> in CATALOG_DIR.
+    """
+    key = hashlib.md5( os.path.abspath( fdir ) ).hexdigest()
+    return os.path.join( CATALOG_DIR, key + '.pkl' )
+
+def get_catalog( fdir, refresh=True ):
+    """
+    Return the catalog for directory <fdir>, loading it from disk or
+    building it if necessary.
+
+    refresh -- check the directory mtime and pick up added or removed
+    files.
+    """
+    key = os.path.abspath( fdir )
+    try:
+        cat = _catalogs[ key ]
+    except KeyError:
+        cat = FrameCatalog( fdir )
+        _catalogs[ key ] = cat
+        return cat
+    if refresh:
+        cat.refresh()
+    return cat
+
+
+class FrameCatalog( object ):
+    """
+    Frame number --> file name for each kind of artifact in a
+    directory.
+
+    self.entries[ kind ][ name ][ frame ] = file name, where name is the
+    part of the file name before the frame number (eg.,
+    new_110125-concatenated-ASCII). Most directories hold a single
+    cell, ie. a single name.
+    """
+    def __init__( self, fdir, save=True ):
+        """
+        fdir -- directory to catalog
+
+        save -- pickle the catalog to CATALOG_DIR (see catalog_name())
+        """
+        if not fdir.endswith( slash ): fdir += slash
+        self.fdir = fdir
+        self.save = save
+        self.mtime = None
+        self.entries = {}
+        # every file name seen at the last refresh, recognized or not
+        self.seen = set()
+        self._load()
+        self.refresh()
+
+    def __repr__( self ):
+        return "FrameCatalog( '" + self.fdir + "', kinds=" + \
+            str( sorted( self.entries.keys() ) ) + " )"
+
+    def _load( self ):
+        try:
+            with open( catalog_name( self.fdir ), 'rb' ) as fh:
+                state = pkl.load( fh )
+            if state['fdir'] != os.path.abspath( self.fdir ):
+                return
+            mtime, entries, seen = state['mtime'], state['entries'], state['seen']
+        except Exception:
+            # missing, unreadable or corrupt; rebuild from a listing
+            return
+        self.mtime = mtime
+        self.entries = entries
+        self.seen = seen
+
+    def _dump( self ):
+        if not self.save:
+            return
+        state = { 'fdir' : os.path.abspath( self.fdir ),
+                  'mtime' : self.mtime,
+                  'entries' : self.entries,
+                  'seen' : self.seen }
+        # written under a temporary name and renamed, so concurrent
+        # readers never see a partial file
+        cname = catalog_name( self.fdir )
+        tmp = cname + '.' + str( os.getpid() ) + '.' + \
+            str( thread.get_ident() ) + '.tmp'
+        try:
+            if not os.path.isdir( CATALOG_DIR ):
+                try:
+                    os.makedirs( CATALOG_DIR )
+                except OSError:
+                    # created meanwhile by another process
+                    pass
+            with open( tmp, 'wb' ) as fh:
+                pkl.dump( state, fh, protocol=-1 )
+            os.rename( tmp, cname )
+        except (IOError, OSError):
+            # no writable cache directory, just keep the catalog in memory
+            try:
+                os.remove( tmp )
+            except OSError:
+                pass
+
+    def refresh( self ):
+        """
+        Update the catalog if the directory changed since the last
+        refresh. Only new file names are parsed.
+        """
+        # the mtime is taken before listing, so files added meanwhile
+        # change it again and are picked up by the next refresh
+        mtime = os.stat( self.fdir ).st_mtime
+        if mtime == self.mtime:
+            return
+        if time.time() - mtime < MTIME_SLACK:
+            mtime = None
+        dlist = set( f for f in os.listdir( self.fdir )
+                     if not f.startswith( CATALOG_NAME ) )
+        if dlist == self.seen:
+            if mtime != self.mtime:
+                self.mtime = mtime
+                self._dump()
+            return
+        for f in dlist - self.seen:
+            parsed = parse_name( f )
+            if parsed is None:
+                continue
+            kind, name, frame = parsed
+            self.entries.setdefault( kind, {} ).setdefault( name, {} )[ frame ] = f
+        removed = self.seen - dlist
+        if removed:
+            for kind in self.entries.keys():
+                for name in self.entries[kind].keys():
+                    frames = self.entries[kind][name]
+                    for frame, f in frames.items():
+                        if f in removed:
+                            del frames[frame]
+                    if not frames:
+                        del self.entries[kind][name]
+                if not self.entries[kind]:
+                    del self.entries[kind]
+        self.seen = dlist
+        self.mtime = mtime
+        self._dump()
+
+    def kinds( self ):
+        return sorted( self.entries.keys() )
+
+    def names( self, kind ):
+        """
+        Cell names for which there are files of <kind>.
+        """
+        return sorted( self.entries.get( kind, {} ).keys(), key=natural_key )
+
+    def frames( self, kind, name=None ):
+        """
+        Sorted frame numbers of <kind> (for cell <name>).
+        """
+        return sorted( self._frames( kind, name ).keys() )
+
+    def _frames( self, kind, name ):
+        names = self.entries.get( kind, {} )
+        if name is None:
+            if len( names ) > 1:
+                raise ValueError( self.fdir + " holds several cells, pass name= one of " + \
+                                  str( self.names( kind ) ) )
+            if not names:
+                return {}
+            name = names.keys()[0]
+        return names.get( name, {} )
+
+    def filenames( self, kind, name=None ):
+        """
+        File names (no directory) of <kind>, sorted by cell name and
+        frame number. If <name> is None, files for all cells are
+        returned.
+        """
+        if name is None:
+            names = self.names( kind )
+        else:
+            names = [ name ]
+        fnames = []
+        for n in names:
+            frames = self.entries.get( kind, {} ).get( n, {} )
+            fnames.extend( frames[k] for k in sorted( frames ) )
+        return fnames
+
+    def files( self, kind, name=None ):
+        """
+        Full paths of <kind>, sorted as in filenames().
+        """
+        return [ self.fdir + f for f in self.filenames( kind, name ) ]
+
+    def path( self, frame, kind, name=None ):
+        """
+        Full path of the <kind> file for <frame>, or None.
+        """
+        f = self._frames( kind, name ).get( frame )
+        if f is None:
+            return None
+        return self.fdir + f
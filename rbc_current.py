@@ -15,48 +15,35 @@ import os
 import time
 import cPickle as pkl
 from collections import defaultdict
+import rbc_stats
+import rbc_diagrams
 
 def get_gens_between (file, epsilon1, epsilon2):
     """
         Epsilon1 is lower bound, epsilon2 is upper bound, i.e.
         epsilon1 < (death - birth) < epsilon2
     """
-    with open(file, 'r') as f:
-        s = f.read()
-    f.close()
-    goodGens = []
-    #split up generators
-    stringGens = s.split('\n')
-    stringGens.remove('')
-    gens = []
-    #parse generators
-    for sgen in stringGens:
-        gens.append(map(int,sgen.split(' ')))
-    for (birth,death) in gens:
-        if (death - birth) > epsilon1 and (death-birth) < epsilon2:
-            goodGens.append((birth,death))
-    return goodGens
+    #generators from the cell's diagram store or the Perseus file
+    return rbc_diagrams.load(file).between(epsilon1, epsilon2)
 
 def get_gens_between_normed( fname, eps1, eps2, means=False ):
     """
     """
-    gens = numpy.loadtxt( fname )
+    gens = rbc_diagrams.load( fname ).pairs
     y1, y2 = normalize_mid_lifespan( gens, eps1, eps2 )
         
     # normalize the generator stack and the midrange band
     gens = normalize( gens )
-    goodGens = []
     # now find the normalized midrange generators birth and death time
-    for (birth,death) in gens:
-        if (death - birth) > y1 and (death-birth) < y2:
-            goodGens.append((birth,death))
+    life = gens[:,1] - gens[:,0]
+    goodGens = gens[ (life > y1) & (life < y2) ]
     if means:
-        if goodGens:
-            return numpy.asarray( goodGens )
+        if len( goodGens ):
+            return goodGens
         else:
             return None
     else:
-        return goodGens
+        return [ tuple( gen ) for gen in goodGens.tolist() ]
 
 def normalize_mid_lifespan( gens, eps0, eps1 ):
     """
@@ -108,7 +95,7 @@ def get_mean_sigma ( fname ):
     std = tsArr.std()
     return (mean, std)
 
-def get_ts ( file, data='', lb=0, ub=None ):
+def get_ts ( file, data='', lb=0, ub=None, inf=None ):
     """
         Get time series of persistence values for file
         (persistence value is the death-birth integer for each generator)
@@ -118,18 +105,20 @@ def get_ts ( file, data='', lb=0, ub=None ):
         i.e.
         '.._xxxx_$betti_num_1.txt'
 
+        inf: policy for the infinite generators, see get_gens
+
     ** No error checking that ub argument makes sense **
     """
-    gens = get_gens ( file, data )
+    gens = get_gens ( file, data=data, inf=inf )
     if not ub:
         # just set the upper bound to infinity
         ub = numpy.infty
-    ts = [(death-birth) for (birth,death) in gens
-          if (death-birth) > lb and death < ub]
-    tsArr = numpy.array(ts)
+    ts = gens.lifespans
+    tsArr = ts[(ts > lb) & (gens.deaths < ub)].astype(numpy.int)
     return tsArr
 
-def get_midrange_ts( fdir, lb, betti=1, sname=None, mean=False, infinite=False ):
+def get_midrange_ts( fdir, lb, betti=1, sname=None, mean=False, infinite=False,
+                     inf=None ):
     """
     fdir -- directory containing persistence diagrams
 
@@ -138,28 +127,23 @@ def get_midrange_ts( fdir, lb, betti=1, sname=None, mean=False, infinite=False )
     betti -- 0,1,2: which betti number to extract generators for
 
     sname -- full path for directory to save file
+
+    infinite -- leave out the infinite generators (policy 'drop')
+
+    inf -- policy for the infinite generators, 'drop' or 'keep' (see
+    handle_inf); overrides <infinite>
     """
-    dlist = os.listdir( fdir )
-    diag_list = []
-    # find all diagram files in <fdir> for <betti>
-    suffix = '_' + str( betti ) + '.txt'
-    for f in dlist:
-        if f.endswith( suffix ):
-            diag_list.append( f )
-            fname = fdir + f
-    diag_list.sort( key=natural_key )
+    if not fdir.endswith( '/' ): fdir += '/'
+    # all diagrams in <fdir> for <betti>, in files or diagram stores
+    diag_list = [ f.rpartition( '/' )[-1]
+                  for f in rbc_diagrams.diagram_files( fdir, betti ) ]
     midrange_gens = []
     num_gens = []
-    if infinite:
-        for d in diag_list:
-            # account for the one infinite generator
-            num_gens.append( len(get_ts( fdir + d, lb=lb ))-1 )
-            midrange_gens.append( get_ts( fdir + d, lb=lb )[:-1] )
-    # just truncate the noisy generators, leaving the 'infinite' ones in the list
-    else:
-        for d in diag_list:
-            num_gens.append( len(get_ts( fdir + d, lb=lb )) )
-            midrange_gens.append( get_ts( fdir + d, lb=lb ) )
+    inf = inf_policy( inf, rmv=infinite )
+    for d in diag_list:
+        ts = get_ts( fdir + d, lb=lb, inf=inf )
+        num_gens.append( len(ts) )
+        midrange_gens.append( ts )
     genarr = midrange_gens #numpy.array( midrange_gens, dtype=numpy.int )
     if mean:
         genarr = numpy.asarray( midrange_gens, dtype=numpy.int )
@@ -169,106 +153,93 @@ def get_midrange_ts( fdir, lb, betti=1, sname=None, mean=False, infinite=False )
     else:
         return genarr
 
-def get_gens ( file, rmv='',data = ''):
+def get_gens ( file, rmv='',data = '', inf=None, add=1 ):
     """
         Get generators function
-    """
-    with open(file, 'r') as f:
-        s = f.read()
-    f.close()
-    #split up generators
-    stringGens = s.split('\n')
-    stringGens.remove('')
-    gens = [map(int,sgen.split(' ')) for sgen in stringGens]
-    if data:
-        maxHeight = get_Max( data, 1)
-        for gen in gens:
-            if gen[-1] == -1:
-                gen[-1] == maxHeight
-    if rmv:
-        remove_inf( gens )
-    return gens
+        Returns rbc_diagrams.Diagram, which iterates as (birth, death)
+        pairs
+        - infinite generators (death -1) are handled by policy inf
+          (see handle_inf). Default: 'drop' if rmv, 'clamp' to the max
+          height of frame data plus add if data is given, else 'keep'
+    """
+    #generators from the cell's diagram store or the Perseus file
+    gens = rbc_diagrams.load(file)
+    inf = inf_policy(inf, rmv, data)
+    maxHeight = None
+    if inf == 'clamp':
+        maxHeight = get_Max( data, add)
+    return handle_inf( gens, inf, maxHeight )
 
 def get_gens_bin_Block (file, lb=0, per_bin=3,rmv='',max = ''):
     """
         Returns outlying generators whose persistence values
         are unique (=1) (or beneath per_bin requirement)
     """
-    gens = get_gens_Block (file,rmv,max )
-    pkMap = {}
-    pGenMap = {}
-    goodGens = []
-    for (birth,death) in gens:
-        pers = death-birth
-        if pers in pkMap:
-            pkMap[pers] = pkMap[pers]+1
-            pGenMap[pers].append( (birth,death) )
-        else:
-            pkMap[pers] = 1
-            pGenMap[pers] = [(birth, death)]
-    #get the lowest persistence value such that all larger 
-    #pers values have k <= 2
-    lb_pers = 0
-    for p in sorted(pkMap.iterkeys()):
-        if pkMap[p] > per_bin:
-            lb_pers = p
-    for p, k in pkMap.iteritems():
-        #if k <= 2 and p >= lb_pers: #madalena suggestion
-        if p >= lb_pers:
-            goodGens.extend (pGenMap[p])
-    #print len(goodGens)
-    return goodGens
+    gens = get_gens_Block (file,None,rmv,max )
+    return gens[bin_mask(gens.lifespans, per_bin)]
 
-def get_gens_Block ( file, ind, rmv='',max = ''):
+def get_gens_Block ( file, ind, rmv='',max = '', inf=None):
     """
         Get generators function
+        Returns rbc_diagrams.Diagram, see get_gens
+        - max is the height infinite generators are clamped to
+          (e.g. get_Max_Block( data, ind, 1)), inf as in get_gens
+    """
+    #generators from the cell's diagram store or the Perseus file
+    gens = rbc_diagrams.load(file)
+    inf = inf_policy(inf, rmv, max)
+    return handle_inf( gens, inf, max or None )
+
+#policies for the infinite generators, see handle_inf
+INF_POLICIES = ('drop', 'clamp', 'keep')
+
+def inf_policy ( inf=None, rmv='', clamp='' ):
     """
-    with open(file, 'r') as f:
-        s = f.read()
-    f.close()
-    #split up generators
-    stringGens = s.split('\n')
-    stringGens.remove('')
-    gens = [map(int,sgen.split(' ')) for sgen in stringGens]
-    #print gens
-    if max:
-        maxHeight = max#get_Max_Block( data, ind, 1)
-        for gen in gens:
-            if gen[-1] == -1:
-                gen[-1] == maxHeight
+        - Policy for the infinite generators: inf if given, else from
+          the old flags, 'drop' if rmv, 'clamp' if a max height (or its
+          frame) is given, otherwise 'keep'
+        """
+    if inf is not None:
+        return inf
     if rmv:
-        remove_inf( gens )
-    return gens
-    
+        return 'drop'
+    if clamp:
+        return 'clamp'
+    return 'keep'
+
+def handle_inf ( gens, inf='keep', maxHeight=None ):
+    """
+        - Infinite generators (death -1) of Diagram gens, by policy:
+          'drop' removes them, 'clamp' sets their death to maxHeight
+          (max height of the frame + k, see get_Max), 'keep' leaves
+          them at -1
+        - one boolean mask over the diagram arrays, O(n)
+        - Returns a Diagram (gens itself for 'keep')
+        """
+    if inf == 'drop':
+        return gens.drop_infinite()
+    if inf == 'clamp':
+        if maxHeight is None:
+            raise ValueError("clamping infinite generators needs a max height")
+        return gens.clamp_infinite(maxHeight)
+    if inf == 'keep':
+        return gens
+    raise ValueError("unknown policy for infinite generators: " + str(inf) +
+                     ", use one of " + str(INF_POLICIES))
+
 def remove_inf_Block ( gens ):
-    max = 0
-    maxInd = []
-    for ind in xrange(len(gens)):
-        pers = gens[ind][1] - gens[ind][0]
-        if pers > max:
-            maxInd = []
-            maxInd.append(ind)
-        if pers == max:
-            #add ind to remove minus number to be removed ahead of it
-            maxInd.append( ind-len(maxInd) )
-        max = pers #update the current maximum
-    for ind in maxInd:
-        gens.pop( ind )
+    return remove_inf( gens )
 
 def remove_inf ( gens ):
-    max = 0
-    maxInd = []
-    for ind in xrange(len(gens)):
-        pers = gens[ind][1] - gens[ind][0]
-        if pers > max:
-            maxInd = []
-            maxInd.append(ind)
-        if pers == max:
-            #add ind to remove minus number to be removed ahead of it
-            maxInd.append( ind-len(maxInd) )
-        max = pers
-    for ind in maxInd:
-        gens.pop( ind )
+    """
+        Remove the infinite generators (death -1). A list of
+        generators is changed in place, for a Diagram a new Diagram is
+        returned
+        """
+    if isinstance(gens, rbc_diagrams.Diagram):
+        return gens.drop_infinite()
+    gens[:] = [gen for gen in gens if gen[-1] != -1]
+    return gens
 
 def get_gens_normalize ( file, data = ''):
     """
@@ -278,19 +249,11 @@ def get_gens_normalize ( file, data = ''):
         retrieving outlying generators is independent
         of normalization (so far) - kel, 7/2/2012
         """
-    with open(file, 'r') as f:
-        s = f.read()
-    f.close()
-    #split up generators
-    stringGens = s.split('\n')
-    stringGens.remove('')
+    #same clamped max height as get_gens, from the stats table
     maxHeight = get_Max( data, 1)
-    gens = [map(int,sgen.split(' ')) for sgen in stringGens]
-    for gen in gens:
-        if gen[-1] == -1:
-            gen[-1] == maxHeight
-    n_gens = [(float(gen[0])/maxHeight,float(gen[-1])/maxHeight) for gen in gens]
-    return n_gens
+    gens = handle_inf( rbc_diagrams.load(file), 'clamp', maxHeight )
+    n_gens = gens.pairs / float(maxHeight)
+    return [tuple(gen) for gen in n_gens.tolist()]
 
 def get_gens_bin (file, lb=0, per_bin=3,rmv='',data = ''):
     """
@@ -298,28 +261,163 @@ def get_gens_bin (file, lb=0, per_bin=3,rmv='',data = ''):
         are unique (=1) (or beneath per_bin requirement)
     """
     gens = get_gens (file,rmv,data )
-    pkMap = {}
-    pGenMap = {}
-    goodGens = []
-    for (birth,death) in gens:
-        pers = death-birth
-        if pers in pkMap:
-            pkMap[pers] = pkMap[pers]+1
-            pGenMap[pers].append( (birth,death) )
-        else:
-            pkMap[pers] = 1
-            pGenMap[pers] = [(birth, death)]
-    #get the lowest persistence value such that all larger 
-    #pers values have k <= 2
-    lb_pers = 0
-    for p in sorted(pkMap.iterkeys()):
-        if pkMap[p] > per_bin:
-            lb_pers = p
-    for p, k in pkMap.iteritems():
-        #if k <= 2 and p >= lb_pers: #madalena suggestion
-        if p >= lb_pers:
-            goodGens.extend (pGenMap[p])
-    return goodGens
+    return gens[bin_mask(gens.lifespans, per_bin)]
+
+def bin_threshold ( pers, per_bin=3 ):
+    """
+        - Lowest persistence value such that all larger persistence
+          values occur at most per_bin times, i.e. the largest value
+          with more than per_bin generators (0 if there is none)
+        """
+    vals, counts = numpy.unique(pers, return_counts=True)
+    crowded = vals[counts > per_bin]
+    if len(crowded):
+        return crowded[-1]
+    return 0
+
+def bin_mask ( pers, per_bin=3 ):
+    """
+        - Boolean mask of the outlying generators, persistence values
+          pers >= bin_threshold (see get_gens_bin)
+        """
+    return pers >= bin_threshold(pers, per_bin)
+
+def bin_masks ( pers, index, per_bin=3 ):
+    """
+        - bin_mask for every frame of a cell at once
+        - pers is the persistence values of all frames, concatenated,
+          and the values of frame i are pers[index[i]:index[i+1]] (CSR
+          layout, see rbc_diagrams)
+        - Returns one boolean mask over pers
+        """
+    counts = numpy.diff(index)
+    fid = numpy.repeat(numpy.arange(len(counts)), counts)
+    if not len(pers):
+        return numpy.zeros(0, dtype=bool)
+    #runs of equal values within each frame
+    order = numpy.lexsort((pers, fid))
+    sp, sf = pers[order], fid[order]
+    new = numpy.empty(len(sp), dtype=bool)
+    new[0] = True
+    new[1:] = (sf[1:] != sf[:-1]) | (sp[1:] != sp[:-1])
+    starts = numpy.flatnonzero(new)
+    runs = numpy.diff(numpy.append(starts, len(sp)))
+    crowded = starts[runs > per_bin]
+    #largest crowded value of each frame, 0 if none
+    lowest = numpy.iinfo(numpy.int64).min
+    thresh = numpy.empty(len(counts), dtype=numpy.int64)
+    thresh.fill(lowest)
+    numpy.maximum.at(thresh, sf[crowded], sp[crowded].astype(numpy.int64))
+    thresh[thresh == lowest] = 0
+    return pers >= thresh[fid]
+
+def cell_gens ( dgms, betti=1, inf='keep', maxHeights=None ):
+    """
+        - Generators of every frame of a cell, from a diagram store
+          (rbc_diagrams.DiagramStore or its path)
+        - inf: policy for the infinite generators (see handle_inf);
+          'clamp' needs maxHeights, one per frame of the store
+        - Returns (frames, Diagram of all generators, index), where the
+          generators of frames[i] are index[i]:index[i+1]
+        """
+    if not isinstance(dgms, rbc_diagrams.DiagramStore):
+        dgms = rbc_diagrams.get_diagrams(dgms)
+    index = dgms.index[betti]
+    gens = rbc_diagrams.Diagram(dgms.births(betti), dgms.deaths(betti))
+    if inf == 'keep':
+        return dgms.frames, gens, index
+    fid = numpy.repeat(numpy.arange(len(dgms.frames)), numpy.diff(index))
+    if inf == 'drop':
+        finite = gens.finite
+        counts = numpy.bincount(fid[finite], minlength=len(dgms.frames))
+        index = numpy.concatenate(([0], numpy.cumsum(counts)))
+        return dgms.frames, gens[finite], index
+    if inf == 'clamp':
+        if maxHeights is None:
+            raise ValueError("clamping infinite generators needs a max height per frame")
+        maxHeights = numpy.asarray(maxHeights)
+        return dgms.frames, gens.clamp_infinite(maxHeights[fid]), index
+    raise ValueError("unknown policy for infinite generators: " + str(inf) +
+                     ", use one of " + str(INF_POLICIES))
+
+def split_gens ( gens, index, mask=None ):
+    """
+        - Per-frame Diagrams from CSR generators (see cell_gens), keeping
+          only the generators in mask
+        """
+    if mask is not None:
+        fid = numpy.repeat(numpy.arange(len(index)-1), numpy.diff(index))
+        counts = numpy.bincount(fid[mask], minlength=len(index)-1)
+        index = numpy.concatenate(([0], numpy.cumsum(counts)))
+        gens = gens[mask]
+    return [gens[index[i]:index[i+1]] for i in xrange(len(index)-1)]
+
+def get_gens_bin_cell ( dgms, betti=1, per_bin=3, inf='keep', maxHeights=None ):
+    """
+        - get_gens_bin for every frame of a cell in one call, from its
+          diagram store (see cell_gens for inf, maxHeights)
+        - Returns (frames, list of Diagrams of outlying generators)
+        """
+    frames, gens, index = cell_gens(dgms, betti, inf, maxHeights)
+    mask = bin_masks(gens.lifespans, index, per_bin)
+    return frames, split_gens(gens, index, mask)
+
+def get_gens_sigma_cell ( dgms, betti=1, lb=1.5, ub=6, inf='keep', maxHeights=None ):
+    """
+        - get_gens_sigma for every frame of a cell in one call, from its
+          diagram store (see cell_gens for inf, maxHeights)
+        - Returns (frames, number of generators in the sigma band per
+          frame, list of Diagrams of those generators)
+        """
+    frames, gens, index = cell_gens(dgms, betti, inf, maxHeights)
+    mask, counts = sigma_masks(gens.lifespans, index, lb, ub)
+    return frames, counts, split_gens(gens, index, mask)
+
+def sigma_masks ( pers, index, lb=1.5, ub=6 ):
+    """
+        - get_gens_sigma selection for every frame of a cell at once:
+          lb < |pers - mean|/std < ub, with the mean and std of each
+          frame's persistence values
+        - pers, index: CSR layout as in bin_masks. The per-frame sums
+          are segmented reductions (add.reduceat) over the offsets
+        - Returns (boolean mask over pers, count of selected generators
+          per frame)
+        """
+    index = numpy.asarray(index)
+    counts = numpy.diff(index)
+    nframes = len(counts)
+    fid = numpy.repeat(numpy.arange(nframes), counts)
+    x = numpy.asarray(pers, dtype=numpy.float)
+    #a trailing 0 keeps the offsets of empty trailing frames in range;
+    #reduceat gives x[i] for an empty segment, so those are zeroed
+    empty = counts == 0
+    n = numpy.where(empty, 1, counts)
+    sums = numpy.add.reduceat(numpy.append(x, 0), index[:-1])
+    sums[empty] = 0
+    mean = sums / n
+    dev = x - mean[fid]
+    sq = numpy.add.reduceat(numpy.append(dev*dev, 0), index[:-1])
+    sq[empty] = 0
+    std = numpy.sqrt(sq / n)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        check = abs(dev)/std[fid]
+    mask = (check > lb) & (check < ub)
+    return mask, numpy.bincount(fid[mask], minlength=nframes)
+
+def concat_gens ( files ):
+    """
+        - Generators of a list of Perseus diagram files in CSR layout
+        - Returns (Diagram of all generators, index), the generators of
+          files[i] are index[i]:index[i+1]
+        """
+    dgms = [rbc_diagrams.load(f) for f in files]
+    index = numpy.zeros(len(dgms)+1, dtype=numpy.int64)
+    index[1:] = numpy.cumsum([len(g) for g in dgms])
+    if not dgms:
+        return rbc_diagrams.Diagram(numpy.zeros((0, 2))), index
+    gens = rbc_diagrams.Diagram(numpy.concatenate([g.births for g in dgms]),
+                                numpy.concatenate([g.deaths for g in dgms]))
+    return gens, index
 
 def get_gens_sigma (file, lb=1.5, ub=6,rmv='',data = ''):
     """
@@ -327,15 +425,10 @@ def get_gens_sigma (file, lb=1.5, ub=6,rmv='',data = ''):
         epsilon1 < (death - birth) < epsilon2
         """
     gens = get_gens(file, rmv,data)
-    ts = [(death-birth) for (birth,death) in gens]
-    tsArr = numpy.array(ts)
+    tsArr = gens.lifespans.astype(numpy.float)
     mean,std = tsArr.mean(), tsArr.std()
-    goodGens = []
-    for (birth, death) in gens:
-            check = abs((death-birth)-mean)/std
-            if check > lb and check < ub:
-                goodGens.append((birth,death))
-    return goodGens
+    check = abs(tsArr-mean)/std
+    return gens[(check > lb) & (check < ub)]
 
 def get_outlier_gens (file, lb, ub, out_type='bin', rmv='',data=''):
     """
@@ -362,18 +455,21 @@ def get_Max ( fname, add=1 ):
     """
         Send in add=k to return max height value + k
         For example, setting add=1 works when H_1 
+        .npy frames are looked up in the stats table (see rbc_stats)
         """
-    try:
-        return numpy.load(fname).max()+add
-    except IOError:
-        return int( numpy.loadtxt(fname).max() + add )
+    if fname.endswith('.npy'):
+        try:
+            return rbc_stats.frame_stat(fname, 'max')+add
+        except ValueError:
+            return numpy.load(fname).max()+add
+    return int( numpy.loadtxt(fname).max() + add )
 
 def get_Max_Block ( fname, ind, add=1 ):
     """
         Send in add=k to return max height value + k
         For example, setting add=1 works when H_1 
         """
-    return numpy.load(fname)[:,:,ind].max()+add
+    return rbc_stats.frame_stat(fname, 'max', ind)+add
 
 def get_gens_folder ( fdir, betti_num, epsilon1=0, epsilon2=0):
     """
@@ -384,19 +480,14 @@ def get_gens_folder ( fdir, betti_num, epsilon1=0, epsilon2=0):
     if not fdir.endswith('/'):
         fdir+='/'
     if os.path.isdir(fdir):
-        dlist = os.listdir(fdir)
-        files = []
-        for f in dlist:
-            if f.endswith(str(betti_num)+'.txt'):
-                files.append(fdir+f)
+        files = rbc_diagrams.diagram_files(fdir, betti_num)
     else:
         print 'Error: input is not a directory'
-    files.sort(key=natural_key)
-    cell_gens = []
-    for file in files:
-        #CURRENTLY ONLY NUMBER OF GENERATORS
-        cell_gens.append(len(get_gens_sigma(file,epsilon1)))
-        #print file     
+    #CURRENTLY ONLY NUMBER OF GENERATORS (as get_gens_sigma(file,epsilon1)),
+    #all frames at once
+    gens, index = concat_gens(files)
+    mask, counts = sigma_masks(gens.lifespans, index, epsilon1)
+    cell_gens = counts.tolist()
     #RETURN AVERAGE NUMBER ACROSS FRAMES
     return float(sum(cell_gens))/float(len(cell_gens)), cell_gens
 
@@ -463,28 +554,7 @@ def get_short_range_gens (file,per_bin=3,rmv='Y',data = ''):
         are unique (=1) (or beneath per_bin requirement)
     """
     gens = get_gens (file,rmv,data )
-    pkMap = {}
-    pGenMap = {}
-    shortGens = []
-    for (birth,death) in gens:
-        pers = death-birth
-        if pers in pkMap:
-            pkMap[pers] = pkMap[pers]+1
-            pGenMap[pers].append( (birth,death) )
-        else:
-            pkMap[pers] = 1
-            pGenMap[pers] = [(birth, death)]
-    #get the lowest persistence value such that all larger 
-    #pers values have k <= 2
-    lb_pers = 0
-    for p in sorted(pkMap.iterkeys()):
-        if pkMap[p] > per_bin:
-            lb_pers = p
-    for p, k in pkMap.iteritems():
-        #if k <= 2 and p >= lb_pers: #madalena suggestion
-        if p < lb_pers:
-            shortGens.extend (pGenMap[p])
-    return shortGens
+    return gens[~bin_mask(gens.lifespans, per_bin)]
 
 def plot_sgen ( b_num ):
     cell_Abbrs = ['n4','n5','n11','n13','n14','o5','o9','o10','o12']
@@ -519,12 +589,10 @@ def plot_sgen ( b_num ):
 
 def dir_list( fdir, betti=1 ):
     """
-    Returns a list of Perseus output files for given betti #.
+    Returns a list of Perseus output files for given betti #
+    (including frames held in a diagram store, see rbc_diagrams).
     """
-    dlist = os.listdir( fdir )
-    theFiles = [ fdir+f for f in dlist if f.endswith( '_'+str(betti)+'.txt' ) ]
-    theFiles.sort( key=natural_key )
-    return theFiles
+    return rbc_diagrams.diagram_files( fdir, betti )
 
 
 if __name__ == "__main__":
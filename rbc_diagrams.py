@@ -0,0 +1,733 @@
+"""
+Module containing a consolidated store of Perseus persistence
+diagrams. Instead of one <name>_<k>_<dim>.txt file per frame and
+dimension, the diagrams of a cell live in a directory <cell>_dgms/
+holding, for each dimension d, all (birth, death) pairs of all frames
+in one NPY file and the offsets of each frame's pairs in another
+(compressed sparse rows, frame by frame):
+
+dgm_<d>.npy -- (npairs, 2) int32 array of (birth, death) pairs
+
+index_<d>.npy -- (nframes+1,) offsets; the pairs of the i'th frame
+are dgm_<d>[ index_<d>[i] : index_<d>[i+1] ]
+
+frames.npy -- frame number of each row
+
+flush() appends the new pairs to the end of dgm_<d>.npy in place (its
+header is padded so the shape can be updated without moving the
+data); only the small index and frames arrays are rewritten.
+
+Useage:
+
+In [1]: import rbc_diagrams as D
+
+In [2]: dgms = D.open_diagrams( '/data/PerseusData/new_110125_dgms' )
+
+In [3]: dgms.get( 1000, 1 )      # H_1 pairs of frame 1000, (n, 2)
+
+In [4]: dgms.append( 1001, { 0 : gens0, 1 : gens1 } ); dgms.flush()
+
+In [5]: dgms.births( 1 ), dgms.deaths( 1 )   # of all frames, concatenated
+
+Infinite generators keep Perseus' death time of -1.
+
+The store of cell <name> in a Perseus output directory is
+<fdir><name>_dgms/. Convert a directory with import_perseus(). The
+analysis functions keep addressing diagrams by their Perseus file
+names: load_diagram( <fdir><name>_<k>_<d>.txt ) reads frame k from the
+store if it holds it, and parses the text file otherwise, and
+diagram_files() lists the diagrams held by either.
+
+The analysis code works on Diagram objects (see load()): int32 birth
+and death arrays that also behave like the list of (birth, death)
+pairs the Perseus files used to be parsed into.
+
+In [6]: gens = D.load( '/data/PerseusData/new_110125/new_110125-concatenated-ASCII_1000_1.txt' )
+
+In [7]: gens.lifespans, gens.infinite
+
+In [8]: for birth, death in gens.between( 10, 50 ): ...
+
+Diagrams returned by load() are kept in a process-wide LRU cache,
+keyed by ( path, mtime, size ) of their source, so repeated sweeps
+over a cell read each file once. The cache holds at most CACHE_BYTES
+(see set_cache_budget() and cache_info()).
+"""
+import numpy
+from numpy.lib.format import magic, read_magic, read_array_header_1_0, \
+    read_array_header_2_0
+import os
+import time
+import struct
+import threading
+from collections import OrderedDict
+import rbc_catalog
+
+slash = '/'
+
+# directory name suffix for diagram stores
+DIAGRAM_SUFFIX = '_dgms'
+FRAMES_NAME = 'frames.npy'
+# bytes reserved for the NPY header of a dgm_<d>.npy table, so its
+# shape can grow in place
+HEADER_BYTES = 128
+
+# default memory budget of the Diagram cache, in bytes
+CACHE_BYTES = 256 * 2**20
+# approximate memory of a cached Diagram beyond its arrays
+CACHE_OVERHEAD = 512
+
+# cache of opened DiagramStores, keyed by absolute path. Values are
+# ( mtime of frames.npy, DiagramStore ).
+_stores = {}
+
+
+def diagram_name( d ):
+    return 'dgm_' + str( d ) + '.npy'
+
+def index_name( d ):
+    return 'index_' + str( d ) + '.npy'
+
+def parse_diagram( text ):
+    """
+    Parse the contents of a Perseus diagram file (one 'birth death'
+    line per generator) into an (n, 2) int32 array.
+    """
+    vals = numpy.fromstring( text, dtype=numpy.int64, sep=' ' )
+    if vals.size % 2 != 0:
+        raise ValueError( "odd number of values in Perseus diagram" )
+    return vals.reshape( (-1, 2) ).astype( numpy.int32 )
+
+def read_diagram( fname ):
+    """
+    Read Perseus diagram file <fname>, eg.
+    new_110125-concatenated-ASCII_1000_1.txt, into an (n, 2) int32
+    array.
+    """
+    with open( fname, 'r' ) as fh:
+        return parse_diagram( fh.read() )
+
+def _save( fname, arr ):
+    """
+    Write <arr> under a temporary name and rename it, so readers never
+    see a partial file.
+    """
+    tmp = fname[:-4] + '.tmp' + str( os.getpid() ) + '.npy'
+    numpy.save( tmp, arr )
+    os.rename( tmp, fname )
+
+def _table_header( n, size=HEADER_BYTES ):
+    """
+    NPY (version 1.0) header of an (n, 2) little-endian int32 table,
+    padded with spaces to <size> bytes, or None if it does not fit.
+    """
+    header = "{'descr': '<i4', 'fortran_order': False, 'shape': (" + \
+        str( n ) + ", 2), }"
+    pad = size - len( magic( 1, 0 ) ) - 2 - len( header ) - 1
+    if pad < 0:
+        return None
+    header += ' ' * pad + '\n'
+    return magic( 1, 0 ) + struct.pack( '<H', len( header ) ) + header
+
+def _table_offset( fh ):
+    """
+    Length of the header of the NPY file open as <fh>, ie. the offset
+    of its data.
+    """
+    fh.seek( 0 )
+    if read_magic( fh ) == ( 1, 0 ):
+        read_array_header_1_0( fh )
+    else:
+        read_array_header_2_0( fh )
+    return fh.tell()
+
+def _save_table( fname, pairs ):
+    """
+    Write (n, 2) <pairs> as a dgm_<d>.npy table, with HEADER_BYTES of
+    header, under a temporary name and rename it.
+    """
+    pairs = numpy.ascontiguousarray( pairs, dtype='<i4' ).reshape( (-1, 2) )
+    tmp = fname[:-4] + '.tmp' + str( os.getpid() ) + '.npy'
+    with open( tmp, 'wb' ) as fh:
+        fh.write( _table_header( len( pairs ) ) )
+        fh.write( pairs.tostring() )
+    os.rename( tmp, fname )
+
+def _load( fname ):
+    try:
+        return numpy.load( fname, mmap_mode='r' )
+    except ValueError:
+        # an empty array cannot be memory-mapped
+        return numpy.load( fname )
+
+def is_diagrams( fname ):
+    """
+    True if <fname> is a diagram store directory.
+    """
+    return os.path.isfile( fname.rstrip( slash ) + slash + FRAMES_NAME )
+
+def create_diagrams( fname, dims=(0, 1) ):
+    """
+    Create an empty diagram store <fname> (a directory, should end in
+    DIAGRAM_SUFFIX) for dimensions <dims>, and return it.
+    """
+    fname = fname.rstrip( slash ) + slash
+    if not os.path.isdir( fname ):
+        os.makedirs( fname )
+    for d in dims:
+        _save_table( fname + diagram_name( d ), numpy.zeros( (0, 2), dtype=numpy.int32 ) )
+        _save( fname + index_name( d ), numpy.zeros( 1, dtype=numpy.int64 ) )
+    _save( fname + FRAMES_NAME, numpy.zeros( 0, dtype=numpy.int64 ) )
+    return DiagramStore( fname )
+
+def get_diagrams( fname ):
+    """
+    Return the (cached) DiagramStore <fname>, reopened if it was
+    flushed since it was cached.
+    """
+    key = os.path.abspath( fname )
+    mtime = os.stat( key + slash + FRAMES_NAME ).st_mtime
+    cached = _stores.get( key )
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    store = DiagramStore( fname )
+    _stores[ key ] = ( mtime, store )
+    return store
+
+def clear_cache():
+    """
+    Forget all cached stores and diagrams, and reset the cache
+    counters.
+    """
+    _stores.clear()
+    _cache.clear()
+
+def set_cache_budget( nbytes ):
+    """
+    Set the memory budget of the Diagram cache (0 disables it).
+    """
+    _cache.set_budget( nbytes )
+
+def cache_info():
+    """
+    Diagram cache statistics: dict with hits, misses, evictions,
+    entries, bytes and budget.
+    """
+    return _cache.info()
+
+def store_name( fdir, name ):
+    """
+    Path of the diagram store of cell <name> in directory <fdir>.
+    """
+    if not fdir.endswith( slash ): fdir += slash
+    return fdir + name + DIAGRAM_SUFFIX
+
+def cell_stores( fdir ):
+    """
+    Diagram stores in directory <fdir>. Returns dict, cell name -->
+    path.
+    """
+    cat = rbc_catalog.get_catalog( fdir )
+    return dict( ( f[:-len( DIAGRAM_SUFFIX )], cat.fdir + f ) for f in cat.seen
+                 if f.endswith( DIAGRAM_SUFFIX ) and is_diagrams( cat.fdir + f ) )
+
+def diagram_files( fdir, d, name=None ):
+    """
+    Paths of the dimension <d> diagrams in directory <fdir> (for cell
+    <name>), sorted by cell name and frame number, as the catalog's
+    files( 'dgm<d>' ). Frames held only by a diagram store are listed
+    under their Perseus file name, <fdir><name>_<k>_<d>.txt, which
+    load_diagram() resolves.
+    """
+    cat = rbc_catalog.get_catalog( fdir )
+    kind = 'dgm' + str( d )
+    files = {}
+    for n in cat.names( kind ):
+        files[n] = dict( cat.entries[ kind ][ n ] )
+    for n, path in cell_stores( fdir ).iteritems():
+        store = get_diagrams( path )
+        if d not in store.dims:
+            continue
+        frames = files.setdefault( n, {} )
+        for k in store.frames.tolist():
+            if k not in frames:
+                frames[k] = n + '_' + str( k ) + '_' + str( d ) + '.txt'
+    if name is not None:
+        files = { name : files.get( name, {} ) }
+    paths = []
+    for n in sorted( files, key=rbc_catalog.natural_key ):
+        paths.extend( cat.fdir + files[n][k] for k in sorted( files[n] ) )
+    return paths
+
+def load_diagram( fname ):
+    """
+    (n, 2) int32 pairs of the Perseus diagram file <fname>, eg.
+    <fdir>new_110125-concatenated-ASCII_1000_1.txt. If the cell's
+    diagram store in <fdir> holds the frame, the pairs come from the
+    store (the text file need not exist), otherwise the text file is
+    parsed.
+    """
+    found = _find_stored( fname )
+    if found is not None:
+        store, k, d = found
+        return store.get( k, d )
+    return read_diagram( fname )
+
+def _find_stored( fname ):
+    """
+    ( store, frame, dimension ) if the diagram store of the cell
+    holds the Perseus diagram <fname>, else None.
+    """
+    fdir, _, f = os.path.abspath( fname ).rpartition( slash )
+    parsed = rbc_catalog.parse_name( f )
+    if parsed is not None and parsed[0].startswith( 'dgm' ):
+        kind, name, k = parsed
+        path = store_name( fdir, name )
+        if is_diagrams( path ):
+            store = get_diagrams( path )
+            d = int( kind[3:] )
+            if k in store and d in store.dims:
+                return store, k, d
+    return None
+
+def load( fname ):
+    """
+    Diagram for the Perseus diagram file <fname> (see load_diagram()),
+    from the cache if its source did not change since it was loaded.
+    The arrays of a cached Diagram are read-only.
+    """
+    path = os.path.abspath( fname )
+    found = _find_stored( path )
+    try:
+        if found is not None:
+            st = os.stat( found[0].fname + FRAMES_NAME )
+        else:
+            st = os.stat( path )
+    except OSError:
+        # let load_diagram() report the missing file
+        return Diagram( load_diagram( fname ) )
+    key = ( path, st.st_mtime, st.st_size )
+    dgm = _cache.get( key )
+    if dgm is None:
+        if found is not None:
+            dgm = Diagram( found[0].get( found[1], found[2] ) )
+        else:
+            dgm = Diagram( read_diagram( path ) )
+        dgm.births.flags.writeable = False
+        dgm.deaths.flags.writeable = False
+        _cache.put( key, dgm )
+    return dgm
+
+def import_perseus( fdir, name=None, remove=False ):
+    """
+    Import the Perseus output in directory <fdir> into diagram stores,
+    one per cell, <fdir><name>_dgms/. Frames already in a store are
+    skipped, so new output can be imported into an existing store.
+    Frames missing the diagram of some dimension are left out.
+
+    name -- import only cell <name>
+
+    remove -- delete the text files once they are in the store
+
+    Returns list of DiagramStores.
+    """
+    cat = rbc_catalog.get_catalog( fdir )
+    dims = sorted( int( kind[3:] ) for kind in cat.kinds()
+                   if kind.startswith( 'dgm' ) )
+    if name is None:
+        names = sorted( set( n for d in dims for n in cat.names( 'dgm' + str( d ) ) ),
+                        key=rbc_catalog.natural_key )
+    else:
+        names = [ name ]
+    stores = []
+    for n in names:
+        tstart = time.time()
+        store = open_diagrams( store_name( cat.fdir, n ), dims )
+        frames = [ set( cat.frames( 'dgm' + str( d ), n ) ) for d in store.dims ]
+        complete = set.intersection( *frames ) if frames else set()
+        missing = set.union( *frames ) - complete if frames else set()
+        if missing:
+            print "skipping", len( missing ), "frames of", n, \
+                "with missing diagrams, eg. frame", min( missing )
+        new = sorted( k for k in complete if k not in store )
+        for k in new:
+            store.append( k, dict( ( d, read_diagram( cat.path( k, 'dgm' + str( d ), n ) ) )
+                                   for d in store.dims ) )
+        store.flush()
+        if remove:
+            for k in complete:
+                for d in store.dims:
+                    os.remove( cat.path( k, 'dgm' + str( d ), n ) )
+        print "It took ", time.time() - tstart, "seconds for importing", \
+            len( new ), "frames of", n
+        stores.append( store )
+    return stores
+
+def open_diagrams( fname, dims=(0, 1) ):
+    """
+    Return the DiagramStore <fname>, creating an empty one (with
+    <dims>) if it does not exist. If <fname> is already a store it is
+    returned unchanged.
+    """
+    if isinstance( fname, DiagramStore ):
+        return fname
+    if not is_diagrams( fname ):
+        return create_diagrams( fname, dims )
+    return DiagramStore( fname )
+
+
+class DiagramStore( object ):
+    """
+    Persistence diagrams of a single cell, one CSR table per
+    dimension. The tables on disk are memory-mapped; appended
+    diagrams are kept in memory until flush().
+    """
+    def __init__( self, fname ):
+        """
+        fname -- full path to the store directory
+        """
+        self.fname = fname.rstrip( slash ) + slash
+        self._open()
+
+    def _open( self ):
+        self.dims = sorted( int( f[4:-4] ) for f in os.listdir( self.fname )
+                            if f.startswith( 'dgm_' ) and f.endswith( '.npy' )
+                            and f[4:-4].isdigit() )
+        frames = numpy.load( self.fname + FRAMES_NAME )
+        n = len( frames )
+        self.pairs = {}
+        self.index = {}
+        for d in self.dims:
+            # frames.npy is written last, so a flush cut short leaves
+            # at most some trailing rows that are not yet listed
+            self.index[d] = numpy.load( self.fname + index_name( d ) )[:n+1]
+            self.pairs[d] = _load( self.fname + diagram_name( d ) )
+        self.frames = frames
+        self._row = dict( ( k, i ) for i, k in enumerate( frames.tolist() ) )
+        self._pending = []
+
+    def __len__( self ):
+        return len( self._row )
+
+    def __contains__( self, k ):
+        return k in self._row
+
+    def __repr__( self ):
+        return "DiagramStore( '" + self.fname + "', " + str( len( self ) ) + \
+            " frames, dims=" + str( self.dims ) + " )"
+
+    def births( self, d ):
+        """
+        Birth times of all (flushed) pairs in dimension d, frame by
+        frame.
+        """
+        return self.pairs[ d ][ :self.index[d][-1], 0 ]
+
+    def deaths( self, d ):
+        """
+        Death times of all (flushed) pairs in dimension d, frame by
+        frame. -1 for infinite generators.
+        """
+        return self.pairs[ d ][ :self.index[d][-1], 1 ]
+
+    def counts( self, d ):
+        """
+        Number of pairs of each (flushed) frame in dimension d.
+        """
+        return numpy.diff( self.index[ d ] )
+
+    def diagram( self, k, d ):
+        """
+        Diagram of frame k in dimension d.
+        """
+        return Diagram( self.get( k, d ) )
+
+    def get( self, k, d ):
+        """
+        (n, 2) array of the (birth, death) pairs of frame k in
+        dimension d.
+        """
+        i = self._row[ k ]
+        if i >= len( self.frames ):
+            return self._pending[ i - len( self.frames ) ][1][ d ]
+        index = self.index[ d ]
+        return self.pairs[ d ][ index[i] : index[i+1] ]
+
+    def append( self, k, dgms ):
+        """
+        Add the diagrams of frame k.
+
+        dgms -- dict, dimension --> (n, 2) pairs (array, list of
+        pairs, or Perseus diagram file). Missing dimensions are
+        stored as empty diagrams.
+        """
+        if k in self._row:
+            raise ValueError( "frame " + str( k ) + " is already in " + self.fname )
+        pairs = {}
+        for d in self.dims:
+            p = dgms.get( d, () )
+            if isinstance( p, str ):
+                p = read_diagram( p )
+            pairs[d] = numpy.asarray( p, dtype=numpy.int32 ).reshape( (-1, 2) )
+        self._row[ k ] = len( self.frames ) + len( self._pending )
+        self._pending.append( ( k, pairs ) )
+
+    def _append_rows( self, d, rows ):
+        """
+        Write (n, 2) <rows> after the listed pairs of dimension d, in
+        place, and update the shape in the table's header. Rows left
+        behind by an interrupted flush are overwritten. Only a table
+        whose header has no room for the new shape is rewritten.
+        """
+        fname = self.fname + diagram_name( d )
+        end = int( self.index[d][-1] )
+        with open( fname, 'r+b' ) as fh:
+            offset = _table_offset( fh )
+            header = _table_header( end + len( rows ), offset )
+            if header is not None:
+                fh.seek( offset + end * rows.itemsize * 2 )
+                fh.write( rows.tostring() )
+                fh.seek( 0 )
+                fh.write( header )
+                return
+        _save_table( fname, numpy.concatenate( ( self.pairs[d][:end], rows ) ) )
+
+    def flush( self ):
+        """
+        Write the appended diagrams to disk. The pairs are appended to
+        the tables; the index and frames are rewritten, frames last, so
+        an interrupted flush leaves the store as it was.
+        """
+        if not self._pending:
+            return
+        frames = [ k for k, pairs in self._pending ]
+        for d in self.dims:
+            new = [ pairs[d] for k, pairs in self._pending ]
+            counts = numpy.cumsum( [ len( p ) for p in new ] )
+            index = numpy.concatenate( ( self.index[d],
+                                         self.index[d][-1] + counts ) )
+            self._append_rows( d, numpy.ascontiguousarray(
+                numpy.concatenate( new ), dtype='<i4' ).reshape( (-1, 2) ) )
+            _save( self.fname + index_name( d ), index )
+        _save( self.fname + FRAMES_NAME,
+               numpy.concatenate( ( self.frames, frames ) ).astype( numpy.int64 ) )
+        self._open()
+
+
+class Diagram( object ):
+    """
+    A persistence diagram, as int32 arrays of birth and death times.
+    Infinite generators have death time -1, as in Perseus output (see
+    infinite/finite).
+
+    A Diagram behaves like the list of (birth, death) pairs the
+    analysis code used to build: len(), iteration and gens[i] give
+    pairs of ints, while gens[mask] or gens[i:j] give a new Diagram.
+    The lifespans and their sort order are computed on first use.
+    """
+    __slots__ = ( 'births', 'deaths', '_lifespans', '_order' )
+
+    def __init__( self, births, deaths=None ):
+        """
+        births -- birth times, or (n, 2) (birth, death) pairs if deaths
+        is None
+
+        deaths -- death times, -1 for infinite generators
+        """
+        if deaths is None:
+            pairs = numpy.asarray( births ).reshape( (-1, 2) )
+            births, deaths = pairs[:,0], pairs[:,1]
+        self.births = numpy.ascontiguousarray( births, dtype=numpy.int32 )
+        self.deaths = numpy.ascontiguousarray( deaths, dtype=numpy.int32 )
+        if self.births.shape != self.deaths.shape:
+            raise ValueError( "births and deaths differ in length" )
+        self._lifespans = None
+        self._order = None
+
+    def __getstate__( self ):
+        return ( self.births, self.deaths )
+
+    def __setstate__( self, state ):
+        self.births, self.deaths = state
+        self._lifespans = None
+        self._order = None
+
+    def __len__( self ):
+        return len( self.births )
+
+    def __iter__( self ):
+        return iter( zip( self.births.tolist(), self.deaths.tolist() ) )
+
+    def __getitem__( self, k ):
+        if isinstance( k, ( int, long, numpy.integer ) ):
+            return ( int( self.births[k] ), int( self.deaths[k] ) )
+        return Diagram( self.births[k], self.deaths[k] )
+
+    def __repr__( self ):
+        return "Diagram( " + str( len( self ) ) + " generators, " + \
+            str( int( self.infinite.sum() ) ) + " infinite )"
+
+    @property
+    def lifespans( self ):
+        """
+        death - birth of each generator. Negative for infinite
+        generators, whose death time is -1.
+        """
+        if self._lifespans is None:
+            self._lifespans = self._freeze( self.deaths - self.births )
+        return self._lifespans
+
+    @property
+    def order( self ):
+        """
+        Indices that sort the generators by lifespan (stable).
+        """
+        if self._order is None:
+            self._order = self._freeze( numpy.argsort( self.lifespans, kind='mergesort' ) )
+        return self._order
+
+    def _freeze( self, arr ):
+        """
+        Make <arr>, derived from a read-only (cached) Diagram,
+        read-only too.
+        """
+        if not self.births.flags.writeable:
+            arr.flags.writeable = False
+        return arr
+
+    @property
+    def infinite( self ):
+        """
+        Boolean mask of the infinite generators (death time -1).
+        """
+        return self.deaths == -1
+
+    @property
+    def finite( self ):
+        return self.deaths != -1
+
+    @property
+    def pairs( self ):
+        """
+        (n, 2) array of (birth, death) pairs.
+        """
+        return numpy.column_stack( ( self.births, self.deaths ) )
+
+    def tolist( self ):
+        """
+        [ [birth, death], ... ], as the old Perseus file parser gave.
+        """
+        return self.pairs.tolist()
+
+    def drop_infinite( self ):
+        """
+        Diagram without the infinite generators.
+        """
+        return self[ self.finite ]
+
+    def clamp_infinite( self, death ):
+        """
+        Diagram with the death time of the infinite generators set to
+        <death> (eg. the max height of the frame + 1).
+        """
+        return Diagram( self.births,
+                        numpy.where( self.infinite, death, self.deaths ) )
+
+    def between( self, lb, ub ):
+        """
+        Generators with lb < lifespan < ub.
+        """
+        life = self.lifespans
+        return self[ ( life > lb ) & ( life < ub ) ]
+
+
+class DiagramCache( object ):
+    """
+    Least recently used cache of Diagrams, bounded by an approximate
+    memory budget. Safe to share between threads.
+    """
+    def __init__( self, budget=CACHE_BYTES ):
+        self.budget = budget
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def __len__( self ):
+        return len( self.entries )
+
+    def __repr__( self ):
+        return "DiagramCache( " + str( len( self ) ) + " diagrams, " + \
+            str( self.nbytes ) + " of " + str( self.budget ) + " bytes )"
+
+    @staticmethod
+    def cost( dgm ):
+        """
+        Approximate memory of a cached Diagram, counting the lifespans
+        and sort order it computes on first use.
+        """
+        return 20 * len( dgm ) + CACHE_OVERHEAD
+
+    def get( self, key ):
+        """
+        Cached Diagram for <key>, or None. A hit makes it the most
+        recently used.
+        """
+        with self._lock:
+            try:
+                dgm = self.entries.pop( key )
+            except KeyError:
+                self.misses += 1
+                return None
+            self.entries[ key ] = dgm
+            self.hits += 1
+            return dgm
+
+    def put( self, key, dgm ):
+        """
+        Cache <dgm>, evicting least recently used diagrams to stay
+        within the budget. A diagram larger than the budget is not
+        cached.
+        """
+        cost = self.cost( dgm )
+        with self._lock:
+            old = self.entries.pop( key, None )
+            if old is not None:
+                self.nbytes -= self.cost( old )
+            if cost > self.budget:
+                return
+            self.entries[ key ] = dgm
+            self.nbytes += cost
+            self._evict()
+
+    def _evict( self ):
+        while self.nbytes > self.budget and self.entries:
+            key, dgm = self.entries.popitem( last=False )
+            self.nbytes -= self.cost( dgm )
+            self.evictions += 1
+
+    def set_budget( self, nbytes ):
+        with self._lock:
+            self.budget = nbytes
+            self._evict()
+
+    def clear( self ):
+        with self._lock:
+            self.entries.clear()
+            self.nbytes = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def info( self ):
+        with self._lock:
+            return { 'hits' : self.hits,
+                     'misses' : self.misses,
+                     'evictions' : self.evictions,
+                     'entries' : len( self.entries ),
+                     'bytes' : self.nbytes,
+                     'budget' : self.budget }
+
+
+# process-wide cache used by load()
+_cache = DiagramCache()
@@ -16,6 +16,8 @@ import itertools
 import rbc_current as rc
 import pickle as pkl
 import sys
+import rbc_stats
+import rbc_diagrams
 
 
 def dlag_Norms ( lag, pers_type, b_num, normalize='',rmv='',norm=2 ):
@@ -52,7 +54,7 @@ def dlag_Norms_All ( lag, pers_type, b_num, lb=0,ub=2,normalize='',rmv='',norm=2
         print cAbbr
         dvec = dlag_vec_Block ( cAbbr, lag, pers_type, b_num, 
                                             lb, ub, normalize, 'bin',rmv)
-        if cAbbr = 'o9':
+        if cAbbr == 'o9':
             normMap['old_9'] = get_Norm (dvec, norm)
         else:
             normMap[cAbbr] = get_Norm (dvec, norm)
@@ -99,15 +101,14 @@ def dlag_vec (cAbbr, lag, type, b_num,lb,ub,normalize='', out_type='',rmv='',
     files = fnames[cAbbr]
     cellFrames = []
     cellDict = {}
-    dlist = os.listdir(cell)
+    #Perseus output files for correct betti num, sorted by frame
+    dlist = [f.split('/')[-1] for f in rbc_diagrams.diagram_files(cell, b_num)]
     for f in dlist:
-        if f.endswith(str(b_num)+'.txt'):    #correct betti num
-            if f.split('-')[0] == files.split('/')[-2]:   #correct file type
-                cellPath = cell + f
-                fname = files + f[:-6] + '.npy'
-                cellFrames.append(cellPath)
-                cellDict[f.rstrip('.txt')] = fname
-    cellFrames.sort(key=natural_key)
+        if f.split('-')[0] == files.split('/')[-2]:   #correct file type
+            cellPath = cell + f
+            fname = files + f[:-6] + '.npy'
+            cellFrames.append(cellPath)
+            cellDict[f.rstrip('.txt')] = fname
     data = numpy.zeros(len(cellFrames) - (lag-1))#allocate length based on lag
     cellStack = []
     genStack = []
@@ -183,15 +184,14 @@ def lag_h (cAbbr, lag, b_num,normalize='',rmv='',out_type='',
     files = fnames[cAbbr]
     cellFrames = []
     cellDict = {}
-    dlist = os.listdir(cell)
+    #Perseus output files for correct betti num, sorted by frame
+    dlist = [f.split('/')[-1] for f in rbc_diagrams.diagram_files(cell, b_num)]
     for f in dlist:
-        if f.endswith(str(b_num)+'.txt'):    #correct betti num
-            if f.split('-')[0] == files.split('/')[-2]:   #correct file type
-                cellPath = cell + f
-                fname = files + f[:-6] + '.npy'
-                cellFrames.append(cellPath)
-                cellDict[cellPath] = fname
-    cellFrames.sort(key=natural_key)
+        if f.split('-')[0] == files.split('/')[-2]:   #correct file type
+            cellPath = cell + f
+            fname = files + f[:-6] + '.npy'
+            cellFrames.append(cellPath)
+            cellDict[cellPath] = fname
     data = numpy.zeros(len(cellFrames) - (lag-1))#allocate length based on lag
     cellStack = []
     genStack = []
@@ -269,15 +269,14 @@ def good_gens (cAbbr, lag, type, b_num,lb,ub,normalize='', out_type='',rmv='',
     files = fnames[cAbbr]
     cellFrames = []
     cellDict = {}
-    dlist = os.listdir(cell)
+    #Perseus output files for correct betti num, sorted by frame
+    dlist = [f.split('/')[-1] for f in rbc_diagrams.diagram_files(cell, b_num)]
     for f in dlist:
-        if f.endswith(str(b_num)+'.txt'):    #correct betti num
-            if f.split('-')[0] == files.split('/')[-2]:   #correct file type
-                cellPath = cell + f
-                fname = files + f[:-6] + '.npy'
-                cellFrames.append(cellPath)
-                cellDict[f.rstrip('.txt')] = fname
-    cellFrames.sort(key=natural_key)
+        if f.split('-')[0] == files.split('/')[-2]:   #correct file type
+            cellPath = cell + f
+            fname = files + f[:-6] + '.npy'
+            cellFrames.append(cellPath)
+            cellDict[f.rstrip('.txt')] = fname
     numGens = []
     birthAvg = []                
     for ind, g in enumerate(cellFrames):
@@ -317,8 +316,9 @@ def get_Max ( fname, add=0 ):
     """
         Send in add=k to return max height value + k
         For example, setting add=1 works when H_1 
+        Looked up in the stats table of the frame's directory (rbc_stats)
     """
-    return numpy.load(fname).max()+add
+    return rbc_stats.frame_stat(fname, 'max')+add
     
 def dlag_vec_Block (cAbbr, lag, type, b_num,lb,ub,normalize='', out_type='',rmv='',
               tempOut='/data/tOut.txt', save='NO', output='NIL'):
@@ -337,16 +337,15 @@ def dlag_vec_Block (cAbbr, lag, type, b_num,lb,ub,normalize='', out_type='',rmv=
     file_npy = fnames[cAbbr]
     cellFrames = []
     cellDict = {}
-    dlist = os.listdir(cell)
-    npy_matrix = numpy.load(file_npy)
+    #Perseus output files for correct betti num, sorted by frame
+    dlist = [f.split('/')[-1] for f in rbc_diagrams.diagram_files(cell, b_num)]
+    npy_max = rbc_stats.get_stats(file_npy)['max']#one entry per frame
     for f in dlist:
-        if f.endswith(str(b_num)+'.txt'):    #correct betti num
-            cellPath = cell + f
-            #fname = files + f[:-6] + '.npy'
-            cellFrames.append(cellPath)
-            max = npy_matrix[:,:,int(f.split('_')[-2])].max()+1
-            cellDict[f.rstrip('.txt')] = max#max for each cell of file
-    cellFrames.sort(key=natural_key)
+        cellPath = cell + f
+        #fname = files + f[:-6] + '.npy'
+        cellFrames.append(cellPath)
+        max = npy_max[int(f.split('_')[-2])]+1
+        cellDict[f.rstrip('.txt')] = max#max for each cell of file
     data = numpy.zeros(len(cellFrames) - (lag-1))#allocate length based on lag
     cellStack = []
     genStack = []
@@ -401,7 +400,7 @@ def get_Max_Block ( fname, ind, add=0 ):
         Send in add=k to return max height value + k
         For example, setting add=1 works when H_1 
     """
-    return numpy.load(fname)[:,:,ind].max()+add
+    return rbc_stats.frame_stat(fname, 'max', ind)+add
 
 def normalize ( frame ):
     """ normalize cell """
@@ -0,0 +1,915 @@
+"""
+Module containing a per-cell frame store. All frames of a cell live
+in a single memory-mapped (frames, nx, ny) NPY file, accompanied by a
+small metadata header (pickled dict). This replaces the directories
+of thousands of per-frame NPY files written by
+raw_cell.extract_frames().
+
+Useage:
+
+In [1]: import rbc_framestore as F
+
+In [2]: store = F.open_store( '/data/jberwald/rbc/New/new_110125-concatenated-ASCII_stack.npy' )
+
+In [3]: store[324]        # frame 324, a zero-copy view
+
+In [4]: store[100:200]    # frames 100..199, also a view
+
+In [5]: for frame in store: ...
+
+Convert an existing directory of per-frame NPY files with
+npy_dir2store().
+
+A store can also be packed (see pack_store()) down to the pixels
+inside the cell boundary, one (npix,) vector per frame plus a shared
+index of in-cell pixels. A PackedFrameStore has the same interface;
+store[k] unpacks frame k, store.vector(k) returns the packed vector.
+
+For moving cells between machines (or keeping many cells on fast
+disk), a store can be written to a compressed archive, <cell>_stack.rbz
+(see archive_store()). Frames are compressed losslessly (zlib) in
+chunks of ARCHIVE_CHUNK frames, with a chunk index at the end of the
+file. open_store() returns an ArchiveFrameStore, with the same
+interface, that decompresses chunks in parallel as they are needed:
+
+In [6]: F.archive_store( store )
+
+In [7]: arch = F.open_store( '/data/jberwald/rbc/New/new_110125-concatenated-ASCII_stack.rbz' )
+
+In [8]: arch[100:200]     # decompresses only chunks 1 and 2 (copies)
+"""
+import numpy
+from numpy.lib.format import open_memmap, magic
+import os, re
+import time
+import struct
+import zlib
+import threading
+import cPickle as pkl
+from collections import OrderedDict
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+import rbc_boundary
+
+slash = '/'
+
+# file name suffix for frame stores
+STORE_SUFFIX = '_stack.npy'
+# frame names follow <cell>-concatenated-ASCII_<k>
+FRAME_SEP = '_'
+# intensities are small integers; try these (in order) before
+# falling back to the original dtype
+COMPACT_DTYPES = ( numpy.uint16, numpy.int16 )
+# compressed archives
+ARCHIVE_SUFFIX = '_stack.rbz'
+ARCHIVE_MAGIC = 'RBCZ0001'
+# frames per compressed chunk
+ARCHIVE_CHUNK = 64
+# bytes reserved for the NPY header of a store written by a
+# StoreWriter, whose number of frames is only known at the end
+WRITER_HEADER = 256
+
+# thread pools for (de)compression, keyed by number of threads. zlib
+# releases the GIL, so threads are enough.
+_pools = {}
+
+
+def compact_dtype( arr ):
+    """
+    Return the first dtype in COMPACT_DTYPES that holds every value
+    in <arr> exactly. If none does (non-integral or out of range
+    values), return arr.dtype unchanged.
+    """
+    arr = numpy.asarray( arr )
+    if arr.dtype.kind not in 'iuf' or arr.size == 0:
+        return arr.dtype
+    if arr.dtype.kind == 'f' and numpy.any( numpy.floor( arr ) != arr ):
+        return arr.dtype
+    vmin, vmax = arr.min(), arr.max()
+    for dt in COMPACT_DTYPES:
+        info = numpy.iinfo( dt )
+        if info.min <= vmin and vmax <= info.max:
+            return numpy.dtype( dt )
+    return arr.dtype
+
+def check_lossless( arr, dtype ):
+    """
+    Raise a ValueError if casting <arr> to <dtype> would truncate or
+    wrap any value.
+    """
+    dtype = numpy.dtype( dtype )
+    arr = numpy.asarray( arr )
+    if dtype.kind == 'f' or arr.size == 0:
+        return
+    if arr.dtype.kind == 'f' and numpy.any( numpy.floor( arr ) != arr ):
+        raise ValueError( "non-integral values cannot be stored as " + \
+                          str( dtype ) )
+    info = numpy.iinfo( dtype )
+    vmin, vmax = arr.min(), arr.max()
+    if vmin < info.min or vmax > info.max:
+        raise ValueError( "values in [" + str( vmin ) + ", " + str( vmax ) + \
+                          "] do not fit in " + str( dtype ) )
+
+def to_compact( arr, dtype=None ):
+    """
+    Cast <arr> to <dtype> (default: compact_dtype( arr )). Raises a
+    ValueError rather than silently truncating.
+    """
+    if dtype is None:
+        dtype = compact_dtype( arr )
+    check_lossless( arr, dtype )
+    return numpy.asarray( arr ).astype( dtype )
+
+def header_name( fname ):
+    """
+    Name of the metadata header that accompanies the store <fname>.
+    """
+    return fname[:-4] + '_meta.pkl'
+
+def index_name( fname ):
+    """
+    Name of the in-cell pixel index that accompanies the packed store
+    <fname>.
+    """
+    return fname[:-4] + '_index.npy'
+
+def is_store( files ):
+    """
+    True if <files> is a FrameStore or the path to one (NPY store or
+    compressed archive).
+    """
+    if isinstance( files, FrameStore ):
+        return True
+    try:
+        return files.endswith( ( STORE_SUFFIX, ARCHIVE_SUFFIX ) ) and \
+            os.path.isfile( files )
+    except AttributeError:
+        return False
+
+def open_store( fname, mode='r' ):
+    """
+    Return a FrameStore for <fname>. If <fname> is already a store it
+    is returned unchanged.
+    """
+    if isinstance( fname, FrameStore ):
+        return fname
+    if fname.endswith( ARCHIVE_SUFFIX ):
+        return ArchiveFrameStore( fname, mode=mode )
+    if read_header( fname ).get( 'packed' ):
+        return PackedFrameStore( fname, mode=mode )
+    return FrameStore( fname, mode=mode )
+
+def create_store( fname, nframes, frame_shape, dtype=numpy.float64, **meta ):
+    """
+    Preallocate an empty store on disk and return it opened for
+    writing.
+
+    fname -- full path to the store. Should end in STORE_SUFFIX.
+
+    nframes -- number of frames in the cell
+
+    frame_shape -- (nx, ny)
+
+    meta -- additional metadata to record in the header (eg., name,
+    boundary file, source file)
+    """
+    shape = (nframes,) + tuple( frame_shape )
+    arr = open_memmap( fname, mode='w+', dtype=dtype, shape=shape )
+    del arr
+    # default frame name is the store name without the suffix
+    name = fname.rpartition( slash )[-1]
+    if name.endswith( STORE_SUFFIX ):
+        name = name[:-len( STORE_SUFFIX )]
+    header = { 'name' : name,
+               'nframes' : nframes,
+               'frame_shape' : tuple( frame_shape ),
+               'dtype' : numpy.dtype( dtype ).str,
+               'created' : time.time()
+               }
+    header.update( meta )
+    write_header( fname, header )
+    return FrameStore( fname, mode='r+' )
+
+def create_writer( fname, frame_shape, dtype, **meta ):
+    """
+    Start a store whose number of frames is not known in advance and
+    return a StoreWriter. Frames are appended with writer.append(
+    frames ); writer.close() fills in the number of frames.
+
+    meta -- additional metadata to record in the header (see
+    create_store())
+    """
+    return StoreWriter( fname, frame_shape, dtype, **meta )
+
+def _npy_header( shape, dtype, size ):
+    """
+    NPY (version 1.0) header of a C-order array, padded with spaces
+    to <size> bytes.
+    """
+    header = "{'descr': " + repr( numpy.dtype( dtype ).str ) + \
+        ", 'fortran_order': False, 'shape': " + \
+        repr( tuple( int( n ) for n in shape ) ) + ", }"
+    pad = size - len( magic( 1, 0 ) ) - 2 - len( header ) - 1
+    if pad < 0:
+        raise ValueError( "NPY header does not fit in " + str( size ) + " bytes" )
+    header += ' ' * pad + '\n'
+    return magic( 1, 0 ) + struct.pack( '<H', len( header ) ) + header
+
+def write_header( fname, header ):
+    with open( header_name( fname ), 'wb' ) as fh:
+        pkl.dump( header, fh, protocol=-1 )
+
+def read_header( fname ):
+    """
+    Return the metadata dict for store <fname> (empty if the store was
+    written without a header).
+    """
+    try:
+        with open( header_name( fname ), 'rb' ) as fh:
+            return pkl.load( fh )
+    except IOError:
+        return {}
+
+def natural_key(string_):
+    """
+    Use with frames.sort(key=natural_key)
+    """
+    return [int(s) if s.isdigit() else s for s in re.split(r'(\d+)', string_)]
+
+def npy_dir2store( fdir, fname=None, dtype=None, **meta ):
+    """
+    Pack a directory of per-frame NPY files (eg.,
+    new_110125-concatenated-ASCII_324.npy) into a single frame
+    store. The directory is listed and sorted once.
+
+    fdir -- directory containing the NPY frames
+
+    fname -- full path of the store. Default is
+    <fdir>/<cell name><STORE_SUFFIX>.
+
+    dtype -- dtype of the store. Default is compact_dtype() of the
+    first frame. Every frame is checked, a ValueError is raised if a
+    frame does not fit.
+
+    The per-frame statistics are written next to the store (see
+    rbc_stats).
+
+    Returns the FrameStore.
+    """
+    if not fdir.endswith( slash ): fdir += slash
+    dlist = os.listdir( fdir )
+    frames = [ f for f in dlist if f.endswith( 'npy' )
+               and not f.endswith( STORE_SUFFIX )
+               and not os.path.isdir( fdir+f ) ]
+    frames.sort( key=natural_key )
+    # frame names are <name>_<k>.npy
+    name = frames[0][:-4].rpartition( FRAME_SEP )[0]
+    if fname is None:
+        fname = fdir + name + STORE_SUFFIX
+    first = numpy.load( fdir + frames[0] )
+    if dtype is None:
+        dtype = compact_dtype( first )
+    store = create_store( fname, len( frames ), first.shape, dtype,
+                          name=name, source=fdir, **meta )
+    print "packing", len( frames ), "frames into", fname, "as", \
+        numpy.dtype( dtype )
+    tstart = time.time()
+    for k, f in enumerate( frames ):
+        store.data[k] = to_compact( numpy.load( fdir + f ), dtype )
+    store.flush()
+    del store
+    print "It took ", time.time() - tstart, "seconds for packing", \
+        len( frames ), "frames."
+    import rbc_stats
+    rbc_stats.write_stats( fname )
+    return open_store( fname )
+
+def pack_store( store, bnd, fname=None ):
+    """
+    Write a packed copy of <store> that keeps only the pixels inside
+    the boundary <bnd> (boundary file or rbc_boundary.Boundary).
+
+    fname -- full path of the packed store. Default is the name of
+    <store> with STORE_SUFFIX replaced by '_packed' + STORE_SUFFIX.
+
+    Raises a ValueError if a frame has nonzero pixels outside the
+    boundary, since those would be lost.
+
+    Returns the PackedFrameStore.
+    """
+    store = open_store( store )
+    bnd = rbc_boundary.get_boundary( bnd )
+    if tuple( store.frame_shape ) != bnd.shape:
+        raise ValueError( "frame shape " + str( store.frame_shape ) + \
+                          " does not match boundary " + str( bnd.shape ) )
+    if fname is None:
+        fname = store.fname[:-len( STORE_SUFFIX )] + '_packed' + STORE_SUFFIX
+    arr = open_memmap( fname, mode='w+', dtype=store.dtype,
+                       shape=( len( store ), bnd.npix ) )
+    del arr
+    numpy.save( index_name( fname ), bnd.index )
+    meta = dict( store.header )
+    meta.update( packed=True, boundary=bnd.fname,
+                 frame_shape=tuple( store.frame_shape ),
+                 nframes=len( store ), dtype=store.dtype.str,
+                 created=time.time() )
+    write_header( fname, meta )
+    packed = PackedFrameStore( fname, mode='r+' )
+    # pack a block of frames at a time
+    step = 100
+    for k in xrange( 0, len( store ), step ):
+        packed.data[k:k+step] = bnd.gather( store[k:k+step], check=True )
+    packed.flush()
+    del packed
+    import rbc_stats
+    rbc_stats.write_stats( fname )
+    return open_store( fname )
+
+
+def _thread_pool( nthreads ):
+    try:
+        return _pools[ nthreads ]
+    except KeyError:
+        pool = ThreadPool( nthreads )
+        _pools[ nthreads ] = pool
+        return pool
+
+def _pmap( func, args, nthreads ):
+    """
+    map() <func> over <args>, using <nthreads> threads if there is
+    more than one item.
+    """
+    if nthreads > 1 and len( args ) > 1:
+        return _thread_pool( nthreads ).map( func, args )
+    return map( func, args )
+
+def _compress( args ):
+    """
+    Compress a block of frames. The bytes of each value are shuffled
+    (all first bytes, then all second bytes, ...) first; intensities
+    are small, so the high bytes are mostly zero and compress well.
+    """
+    block, level = args
+    raw = numpy.ascontiguousarray( block ).view( numpy.uint8 )
+    itemsize = block.dtype.itemsize
+    if itemsize > 1:
+        raw = raw.reshape( (-1, itemsize) ).T
+    return zlib.compress( raw.tostring(), level )
+
+def _decompress( args ):
+    """
+    Inverse of _compress(). Returns a read-only (n, nx, ny) block.
+    """
+    comp, n, frame_shape, dtype = args
+    raw = numpy.frombuffer( zlib.decompress( comp ), dtype=numpy.uint8 )
+    if dtype.itemsize > 1:
+        raw = raw.reshape( (dtype.itemsize, -1) ).T.copy()
+    block = raw.view( dtype ).reshape( (n,) + frame_shape )
+    block.flags.writeable = False
+    return block
+
+def create_archive( fname, frame_shape, dtype, chunk=ARCHIVE_CHUNK, level=6,
+                    nthreads=None, **meta ):
+    """
+    Start a compressed archive and return an ArchiveWriter. Frames
+    are appended with writer.append( frames ); writer.close() writes
+    the chunk index.
+
+    fname -- full path to the archive. Should end in ARCHIVE_SUFFIX.
+
+    chunk -- frames per compressed chunk
+
+    level -- zlib compression level (1-9)
+
+    nthreads -- number of chunks compressed at once. Default is
+    cpu_count().
+
+    meta -- additional metadata to record in the header (see
+    create_store())
+    """
+    return ArchiveWriter( fname, frame_shape, dtype, chunk, level, nthreads,
+                          **meta )
+
+def read_archive_index( fname ):
+    """
+    Return the index (dict) of archive <fname>: header, frame shape,
+    dtype, and ( offset, length, nframes ) of each chunk.
+    """
+    with open( fname, 'rb' ) as fh:
+        if fh.read( len( ARCHIVE_MAGIC ) ) != ARCHIVE_MAGIC:
+            raise ValueError( fname + " is not a frame archive" )
+        fh.seek( -8, os.SEEK_END )
+        end = fh.tell()
+        offset = struct.unpack( '<Q', fh.read( 8 ) )[0]
+        fh.seek( offset )
+        return pkl.loads( fh.read( end - offset ) )
+
+def archive_store( store, fname=None, chunk=ARCHIVE_CHUNK, level=6,
+                   nthreads=None ):
+    """
+    Write a compressed archive of <store> (any FrameStore or path to
+    one). Packed stores are archived as dense frames; the zeros outside
+    the cell cost next to nothing once compressed.
+
+    fname -- full path of the archive. Default is the name of <store>
+    with its suffix replaced by ARCHIVE_SUFFIX.
+
+    Returns the ArchiveFrameStore.
+    """
+    store = open_store( store )
+    if fname is None:
+        fname = store.fname[:-len( STORE_SUFFIX )] + ARCHIVE_SUFFIX
+    meta = dict( store.header )
+    for key in ( 'packed', 'nframes', 'frame_shape', 'dtype', 'created' ):
+        meta.pop( key, None )
+    writer = create_archive( fname, store.frame_shape, store.dtype, chunk,
+                             level, nthreads, **meta )
+    tstart = time.time()
+    # hand the writer enough frames to keep every thread busy
+    step = chunk * writer.nthreads
+    for k in xrange( 0, len( store ), step ):
+        writer.append( store[k:k+step] )
+    writer.close()
+    nbytes = len( store ) * store.frame_shape[0] * store.frame_shape[1] * \
+        store.dtype.itemsize
+    print "It took ", time.time() - tstart, "seconds for archiving", \
+        len( store ), "frames (", round( nbytes / float( os.path.getsize( fname ) ), 1 ), \
+        "x compression )"
+    return open_store( fname )
+
+def extract_archive( archive, fname=None ):
+    """
+    Decompress <archive> into an ordinary (memory-mapped) frame
+    store. Default <fname> is the archive name with STORE_SUFFIX.
+
+    Returns the FrameStore.
+    """
+    archive = open_store( archive )
+    if fname is None:
+        fname = archive.fname[:-len( ARCHIVE_SUFFIX )] + STORE_SUFFIX
+    meta = dict( archive.header )
+    for key in ( 'nframes', 'frame_shape', 'dtype', 'created' ):
+        meta.pop( key, None )
+    store = create_store( fname, len( archive ), archive.frame_shape,
+                          archive.dtype, **meta )
+    step = archive.chunk * archive.nthreads
+    for k in xrange( 0, len( archive ), step ):
+        store.data[k:k+step] = archive[k:k+step]
+    store.flush()
+    del store
+    return open_store( fname )
+
+
+class FrameStore( object ):
+    """
+    Frames of a single cell, backed by one memory-mapped NPY file.
+    """
+    def __init__( self, fname, mode='r' ):
+        """
+        fname -- full path to the store (NPY file)
+
+        mode -- memmap mode. 'r' (default) is read-only, 'r+' allows
+        frames to be written in place.
+        """
+        self.fname = fname
+        self.mode = mode
+        self.data = numpy.load( fname, mmap_mode=mode )
+        self.header = read_header( fname )
+        if 'name' not in self.header:
+            name = fname.rpartition( slash )[-1]
+            if name.endswith( STORE_SUFFIX ):
+                name = name[:-len( STORE_SUFFIX )]
+            self.header['name'] = name
+
+    def __len__( self ):
+        return self.data.shape[0]
+
+    def __getitem__( self, k ):
+        """
+        store[k] returns frame k, store[m:n] returns frames m..n-1. Both
+        are views into the memmap (no copy).
+        """
+        return self.data[k]
+
+    def __iter__( self ):
+        for k in xrange( len( self ) ):
+            yield self.data[k]
+
+    def __repr__( self ):
+        return "FrameStore( '" + self.fname + "', " + str( len( self ) ) + \
+            " frames of shape " + str( self.frame_shape ) + " )"
+
+    @property
+    def name( self ):
+        return self.header['name']
+
+    @property
+    def shape( self ):
+        return self.data.shape
+
+    @property
+    def frame_shape( self ):
+        return self.data.shape[1:]
+
+    @property
+    def dtype( self ):
+        return self.data.dtype
+
+    @property
+    def fdir( self ):
+        """
+        Directory containing the store (ends in '/').
+        """
+        return os.path.dirname( os.path.abspath( self.fname ) ) + slash
+
+    def frame_name( self, k ):
+        """
+        Name of frame k using the per-frame file convention,
+        eg. new_110125-concatenated-ASCII_324
+        """
+        return self.name + FRAME_SEP + str( k )
+
+    def frames( self, start=0, stop=None ):
+        """
+        Iterate over frames start..stop-1.
+        """
+        if stop is None:
+            stop = len( self )
+        for k in xrange( start, stop ):
+            yield self.data[k]
+
+    def flush( self ):
+        if self.mode != 'r':
+            self.data.flush()
+
+    def pixels( self, k ):
+        """
+        The nonzero (in-cell) pixels of frame k, eg. for thresholds
+        based on the mean or median intensity of the cell.
+        """
+        frame = self.data[k]
+        return frame[ frame > 0 ]
+
+
+class PackedFrameStore( FrameStore ):
+    """
+    Frames of a single cell packed down to the pixels inside the cell
+    boundary. self.data is an (nframes, npix) memmap and self.index
+    holds the flat (row-major) indices of the in-cell pixels, shared by
+    all frames.
+    """
+    def __init__( self, fname, mode='r' ):
+        FrameStore.__init__( self, fname, mode=mode )
+        self.index = numpy.load( index_name( fname ) )
+        self._frame_shape = tuple( self.header['frame_shape'] )
+
+    def __getitem__( self, k ):
+        """
+        store[k] returns dense frame k, store[m:n] dense frames
+        m..n-1. Unlike FrameStore, these are copies.
+        """
+        return self.scatter( self.data[k] )
+
+    def __iter__( self ):
+        for k in xrange( len( self ) ):
+            yield self[k]
+
+    def __repr__( self ):
+        return "PackedFrameStore( '" + self.fname + "', " + \
+            str( len( self ) ) + " frames of " + str( self.npix ) + \
+            " pixels )"
+
+    @property
+    def frame_shape( self ):
+        return self._frame_shape
+
+    @property
+    def npix( self ):
+        return len( self.index )
+
+    @property
+    def coords( self ):
+        """
+        ( rows, cols ) of the in-cell pixels, in packed order.
+        """
+        return numpy.unravel_index( self.index, self.frame_shape )
+
+    def vector( self, k ):
+        """
+        Packed vector(s) for frame k (or frames m:n). A view into the
+        memmap.
+        """
+        return self.data[k]
+
+    def scatter( self, packed ):
+        """
+        Unpack vector(s) to dense frame(s), zeros outside the cell.
+        """
+        lead = packed.shape[:-1]
+        size = self.frame_shape[0] * self.frame_shape[1]
+        dense = numpy.zeros( lead + ( size, ), dtype=packed.dtype )
+        dense[..., self.index] = packed
+        return dense.reshape( lead + self.frame_shape )
+
+    def frames( self, start=0, stop=None ):
+        if stop is None:
+            stop = len( self )
+        for k in xrange( start, stop ):
+            yield self[k]
+
+    def pixels( self, k ):
+        v = self.data[k]
+        return v[ v > 0 ]
+
+
+class StoreWriter( object ):
+    """
+    Appends frames to a frame store, sequentially, without knowing
+    the number of frames in advance (see create_writer()).
+    """
+    def __init__( self, fname, frame_shape, dtype, **meta ):
+        self.fname = fname
+        self.frame_shape = tuple( frame_shape )
+        self.dtype = numpy.dtype( dtype )
+        self.nframes = 0
+        name = fname.rpartition( slash )[-1]
+        if name.endswith( STORE_SUFFIX ):
+            name = name[:-len( STORE_SUFFIX )]
+        self.header = { 'name' : name,
+                        'created' : time.time() }
+        self.header.update( meta )
+        self.fh = open( fname, 'wb' )
+        self.fh.write( _npy_header( (0,) + self.frame_shape, self.dtype,
+                                    WRITER_HEADER ) )
+
+    def append( self, frames ):
+        """
+        Append a frame (nx, ny) or a block of frames (n, nx, ny). A
+        ValueError is raised if the values do not fit the store dtype.
+        """
+        frames = numpy.asarray( frames )
+        if frames.shape == self.frame_shape:
+            frames = frames[numpy.newaxis]
+        if frames.shape[1:] != self.frame_shape:
+            raise ValueError( "frames of shape " + str( frames.shape[1:] ) + \
+                              " do not match store " + str( self.frame_shape ) )
+        frames = numpy.ascontiguousarray( to_compact( frames, self.dtype ) )
+        self.fh.write( frames.tostring() )
+        self.nframes += len( frames )
+
+    def close( self ):
+        """
+        Write the final shape into the NPY header, and the metadata
+        header.
+        """
+        if self.fh is None:
+            return
+        self.fh.seek( 0 )
+        self.fh.write( _npy_header( (self.nframes,) + self.frame_shape,
+                                    self.dtype, WRITER_HEADER ) )
+        self.fh.close()
+        self.fh = None
+        self.header.update( nframes=self.nframes,
+                            frame_shape=self.frame_shape,
+                            dtype=self.dtype.str )
+        write_header( self.fname, self.header )
+
+
+class ArchiveWriter( object ):
+    """
+    Appends frames to a compressed archive (see create_archive()).
+    """
+    def __init__( self, fname, frame_shape, dtype, chunk=ARCHIVE_CHUNK,
+                  level=6, nthreads=None, **meta ):
+        self.fname = fname
+        self.frame_shape = tuple( frame_shape )
+        self.dtype = numpy.dtype( dtype )
+        self.chunk = chunk
+        self.level = level
+        if nthreads is None:
+            nthreads = cpu_count()
+        self.nthreads = nthreads
+        self.nframes = 0
+        self.chunks = []
+        name = fname.rpartition( slash )[-1]
+        if name.endswith( ARCHIVE_SUFFIX ):
+            name = name[:-len( ARCHIVE_SUFFIX )]
+        self.header = { 'name' : name,
+                        'created' : time.time() }
+        self.header.update( meta )
+        # frames not yet compressed
+        self._pending = []
+        self._npending = 0
+        self.fh = open( fname, 'wb' )
+        self.fh.write( ARCHIVE_MAGIC )
+
+    def append( self, frames ):
+        """
+        Append a frame (nx, ny) or a block of frames (n, nx, ny). A
+        ValueError is raised if the values do not fit the archive
+        dtype.
+        """
+        frames = numpy.asarray( frames )
+        if frames.shape == self.frame_shape:
+            frames = frames[numpy.newaxis]
+        if frames.shape[1:] != self.frame_shape:
+            raise ValueError( "frames of shape " + str( frames.shape[1:] ) + \
+                              " do not match archive " + str( self.frame_shape ) )
+        self._pending.append( to_compact( frames, self.dtype ) )
+        self._npending += len( frames )
+        if self._npending >= self.chunk * self.nthreads:
+            self._write( final=False )
+
+    def _write( self, final ):
+        """
+        Compress and write all complete chunks (and the last partial
+        one if <final>), <nthreads> at a time.
+        """
+        if not self._pending:
+            return
+        pending = numpy.concatenate( self._pending )
+        nfull = len( pending ) // self.chunk * self.chunk
+        if final:
+            nfull = len( pending )
+        blocks = [ pending[k:k+self.chunk] for k in xrange( 0, nfull, self.chunk ) ]
+        comp = _pmap( _compress, [ ( b, self.level ) for b in blocks ],
+                      self.nthreads )
+        for b, c in zip( blocks, comp ):
+            self.chunks.append( ( self.fh.tell(), len( c ), len( b ) ) )
+            self.fh.write( c )
+            self.nframes += len( b )
+        rest = pending[nfull:]
+        self._pending = [ rest ] if len( rest ) else []
+        self._npending = len( rest )
+
+    def close( self ):
+        """
+        Write the remaining frames and the chunk index.
+        """
+        if self.fh is None:
+            return
+        self._write( final=True )
+        self.header.update( nframes=self.nframes,
+                            frame_shape=self.frame_shape,
+                            dtype=self.dtype.str )
+        index = { 'header' : self.header,
+                  'frame_shape' : self.frame_shape,
+                  'dtype' : self.dtype.str,
+                  'chunk' : self.chunk,
+                  'chunks' : self.chunks }
+        offset = self.fh.tell()
+        self.fh.write( pkl.dumps( index, protocol=-1 ) )
+        self.fh.write( struct.pack( '<Q', offset ) )
+        self.fh.close()
+        self.fh = None
+
+
+class ArchiveFrameStore( FrameStore ):
+    """
+    Frames of a single cell, read from a compressed archive. Chunks
+    are decompressed on demand, several at a time in parallel, and the
+    most recently used ones are cached. Frames are read-only copies;
+    there is no memmap (self.data is not available).
+    """
+    def __init__( self, fname, mode='r', nthreads=None, cache=4 ):
+        """
+        fname -- full path to the archive
+
+        nthreads -- number of chunks decompressed at once. Default is
+        cpu_count().
+
+        cache -- number of decompressed chunks to keep
+        """
+        if mode != 'r':
+            raise ValueError( "archives are read-only, use extract_archive()" )
+        self.fname = fname
+        self.mode = mode
+        index = read_archive_index( fname )
+        self.header = index['header']
+        self.chunk = index['chunk']
+        self.chunks = index['chunks']
+        self._frame_shape = tuple( index['frame_shape'] )
+        self._dtype = numpy.dtype( index['dtype'] )
+        self._nframes = sum( c[2] for c in self.chunks )
+        if nthreads is None:
+            nthreads = cpu_count()
+        self.nthreads = nthreads
+        self.cache = cache
+        self._cache = OrderedDict()
+        # the cache is shared by all threads reading the store
+        self._lock = threading.Lock()
+
+    def __len__( self ):
+        return self._nframes
+
+    def __getitem__( self, k ):
+        """
+        store[k] returns frame k, store[m:n] frames m..n-1. Only the
+        chunks holding the requested frames are decompressed.
+        """
+        if isinstance( k, slice ):
+            start, stop, step = k.indices( len( self ) )
+            return self.read( start, stop )[::step]
+        if k < 0:
+            k += len( self )
+        if not 0 <= k < len( self ):
+            raise IndexError( "frame " + str( k ) + " out of range" )
+        return self._get_chunks( [ k // self.chunk ] )[0][ k % self.chunk ]
+
+    def __iter__( self ):
+        return self.frames()
+
+    def __repr__( self ):
+        return "ArchiveFrameStore( '" + self.fname + "', " + str( len( self ) ) + \
+            " frames of shape " + str( self.frame_shape ) + ", " + \
+            str( len( self.chunks ) ) + " chunks )"
+
+    @property
+    def shape( self ):
+        return ( len( self ), ) + self.frame_shape
+
+    @property
+    def frame_shape( self ):
+        return self._frame_shape
+
+    @property
+    def dtype( self ):
+        return self._dtype
+
+    def _decompress_chunks( self, cs ):
+        """
+        Read chunks <cs> from disk (sequentially) and decompress them
+        (in parallel). Bypasses the cache.
+        """
+        args = []
+        with open( self.fname, 'rb' ) as fh:
+            for c in cs:
+                offset, length, n = self.chunks[c]
+                fh.seek( offset )
+                args.append( ( fh.read( length ), n, self.frame_shape,
+                               self.dtype ) )
+        return _pmap( _decompress, args, self.nthreads )
+
+    def _get_chunks( self, cs ):
+        """
+        Decompressed chunks <cs>, using the cache. Safe to call from
+        several threads; chunks are decompressed outside the lock.
+        """
+        with self._lock:
+            blocks = dict( ( c, self._cache[c] ) for c in cs if c in self._cache )
+        missing = [ c for c in cs if c not in blocks ]
+        blocks.update( zip( missing, self._decompress_chunks( missing ) ) )
+        with self._lock:
+            for c in cs:
+                # most recently used last
+                self._cache.pop( c, None )
+                self._cache[c] = blocks[c]
+            while len( self._cache ) > self.cache:
+                self._cache.popitem( last=False )
+        return [ blocks[c] for c in cs ]
+
+    def read( self, start=0, stop=None ):
+        """
+        Frames start..stop-1 as one (n, nx, ny) array.
+        """
+        if stop is None:
+            stop = len( self )
+        stop = min( stop, len( self ) )
+        if start >= stop:
+            return numpy.zeros( (0,) + self.frame_shape, dtype=self.dtype )
+        c0 = start // self.chunk
+        c1 = ( stop - 1 ) // self.chunk + 1
+        blocks = self._get_chunks( range( c0, c1 ) )
+        if len( blocks ) == 1:
+            block = blocks[0]
+        else:
+            block = numpy.concatenate( blocks )
+        offset = c0 * self.chunk
+        return block[ start-offset:stop-offset ]
+
+    def frames( self, start=0, stop=None ):
+        """
+        Iterate over frames start..stop-1, decompressing <nthreads>
+        chunks at a time.
+        """
+        if stop is None:
+            stop = len( self )
+        stop = min( stop, len( self ) )
+        if start >= stop:
+            return
+        c0 = start // self.chunk
+        c1 = ( stop - 1 ) // self.chunk + 1
+        for c in xrange( c0, c1, self.nthreads ):
+            cs = range( c, min( c + self.nthreads, c1 ) )
+            for ci, block in zip( cs, self._decompress_chunks( cs ) ):
+                first = ci * self.chunk
+                for k in xrange( max( start, first ),
+                                 min( stop, first + len( block ) ) ):
+                    yield block[ k - first ]
+
+    def flush( self ):
+        pass
+
+    def pixels( self, k ):
+        frame = self[k]
+        return frame[ frame > 0 ]
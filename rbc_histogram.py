@@ -9,6 +9,7 @@ from mpl_toolkits.axes_grid.inset_locator import inset_axes, zoomed_inset_axes
 from mpl_toolkits.axes_grid.inset_locator import mark_inset
 import matplotlib.colors as colors
 import timer
+import rbc_diagrams
 
 slash = '/'
 
@@ -58,13 +59,15 @@ def cell_max( fdir, dim=1 ):
     frames for a given cell. 
     """
     if not fdir.endswith( slash ): fdir += slash
-    frames = os.listdir( fdir )
-    ending = str( dim ) + '.txt'
-    frames = [ fdir+f for f in frames if f.endswith( ending ) ]
+    frames = rbc_diagrams.diagram_files( fdir, dim )
     the_max = 0
     for frame in frames:
-        # from rbc_current
-        x = get_Max( frame )
+        # max height + 1, as get_Max(), but read through the store so
+        # imported cells need no Perseus text files
+        pairs = rbc_diagrams.load( frame ).pairs
+        if not len( pairs ):
+            continue
+        x = int( pairs.max() ) + 1
         if x > the_max:
             the_max = x
     return the_max
@@ -679,12 +682,10 @@ def plot_hist( fname, nbins=None, scale=1.0, color='blue',
 
 def dir_list( fdir, betti=1 ):
     """
-    Returns a list of Perseus output files for given betti #.
+    Returns a list of Perseus output files for given betti #
+    (including frames held in a diagram store, see rbc_diagrams).
     """
-    dlist = os.listdir( fdir )
-    theFiles = [ fdir+f for f in dlist if f.endswith( '_'+str(betti)+'.txt' ) ]
-    theFiles.sort( key=natural_key )
-    return theFiles
+    return rbc_diagrams.diagram_files( fdir, betti )
 
 def plot_hist_colors( cell, color='blue',
                       normed=False, fontsize=20,
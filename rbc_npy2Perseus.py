@@ -18,7 +18,16 @@ import matplotlib.pylab as plt
 import re
 import os
 import pickle as pkl
+import time
+import hashlib
+import fcntl
+import thread
+from collections import deque
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
 from scipy.spatial import distance
+import rbc_framestore
+import rbc_catalog
 
 
 def write_file ( fname, output ):
@@ -40,23 +49,176 @@ def write_file ( fname, output ):
     """
     #Load npy file
     data = numpy.load(fname)
-    size = data.shape#(203,198)
-    dim = len ( size )
-    #Open file
-    text = open (output + ".txt", "w")
-    #Write number of dimensions
-    text . write (str(dim) + "\n")
-    #Write resolutions
-    for i in xrange(len(size)):
-        text . write (str(size[i]) + "\n")
-    #Write strictly 2D file
-    for i in xrange(size[0]):#203
-        for j in xrange(size[1]):#198
-            if int(data[i][j]) == 0:
-                text . write (str(-1) + "\n")
-            else:
-                text . write (str(int(data[i][j])) + "\n")
-    text . close()
+    #header and grid in one write, 0 -> -1
+    write_dense (data, output + ".txt")
+
+# manifest of input digests kept in each output directory by
+# incremental exports, and the format version that goes into every
+# digest (bump it when the output format changes)
+MANIFEST_NAME = '.perseus_manifest.pkl'
+EXPORT_FORMAT = 'sparse-1'
+
+# strings cached by the bulk sparse writers: 'i j ' for every pixel
+# of a frame shape, and 'v\n' for a contiguous range of values
+_coord_strings = {}
+_value_strings = [ 0, numpy.empty( 0, dtype=object ) ]
+# widest value range that is formatted through a lookup table
+MAX_VALUE_TABLE = 1 << 20
+
+def format_lines( columns ):
+    """
+    Format integer columns (arrays of equal length) as lines of
+    space separated values, in one bulk string operation.
+    """
+    n = len( columns[0] )
+    if n == 0:
+        return ''
+    flat = numpy.column_stack( columns ).ravel().tolist()
+    line = ' '.join( ['%d'] * len( columns ) ) + '\n'
+    return ( line * n ) % tuple( flat )
+
+def coord_strings( shape ):
+    """
+    Object array of 'i j ' strings, one per pixel of a frame of
+    <shape>, in row-major order.
+    """
+    shape = tuple( shape )
+    try:
+        return _coord_strings[ shape ]
+    except KeyError:
+        nx, ny = shape
+        strs = numpy.array( [ '%d %d ' % ( i, j ) for i in xrange( nx )
+                              for j in xrange( ny ) ], dtype=object )
+        _coord_strings[ shape ] = strs
+        return strs
+
+def value_strings( vmin, vmax ):
+    """
+    Return ( lo, table ), where table[ v-lo ] is 'v\n' for every v in
+    [vmin, vmax]. The table is cached and only grows.
+    """
+    lo, table = _value_strings
+    hi = lo + len( table )
+    if len( table ) == 0:
+        lo, hi = vmin, vmax + 1
+    elif vmin >= lo and vmax < hi:
+        return lo, table
+    else:
+        lo, hi = min( lo, vmin ), max( hi, vmax + 1 )
+    table = numpy.array( [ '%d\n' % v for v in xrange( lo, hi ) ], dtype=object )
+    _value_strings[:] = [ lo, table ]
+    return lo, table
+
+def format_pixels( index, vals, shape, prefix=None ):
+    """
+    'i j value' lines for the pixels with flat (row-major) indices
+    <index> of a frame of <shape>. Coordinates and values are looked
+    up in cached string tables and joined once, which is much faster
+    than formatting each number.
+
+    prefix -- constant first coordinate, giving 'prefix i j value'
+    lines
+    """
+    if len( index ) == 0:
+        return ''
+    vmin, vmax = vals.min(), vals.max()
+    if vmax - vmin > MAX_VALUE_TABLE:
+        rows, cols = numpy.unravel_index( index, shape )
+        columns = [ rows, cols, vals ]
+        if prefix is not None:
+            columns.insert( 0, numpy.repeat( prefix, len( index ) ) )
+        return format_lines( columns )
+    lo, table = value_strings( int( vmin ), int( vmax ) )
+    ncol = 2 if prefix is None else 3
+    out = numpy.empty( ( len( index ), ncol ), dtype=object )
+    if prefix is not None:
+        out[:,0] = '%d ' % prefix
+    out[:,-2] = coord_strings( shape )[ index ]
+    out[:,-1] = table[ vals - lo ]
+    return ''.join( out.ravel().tolist() )
+
+def format_sparse( arr, prefix=None ):
+    """
+    Body of a *sparse* Perseus file: one 'i j value' line per nonzero
+    entry of <arr>, in row-major order. Values are truncated to int
+    first, as in int( arr[i,j] ). Works for a single frame (nx, ny)
+    or a whole stack (n, nx, ny), giving 'k i j value' lines.
+
+    prefix -- constant first coordinate of a single frame (eg. its
+    frame number in a 3D block), giving 'prefix i j value' lines.
+    """
+    vals = numpy.asarray( arr ).astype( int )
+    if vals.ndim == 3 and prefix is None:
+        return ''.join( [ format_sparse( vals[k], prefix=k )
+                          for k in xrange( len( vals ) ) ] )
+    if vals.ndim != 2:
+        idx = numpy.nonzero( vals )
+        columns = list( idx ) + [ vals[idx] ]
+        if prefix is not None:
+            columns.insert( 0, numpy.repeat( prefix, len( columns[0] ) ) )
+        return format_lines( columns )
+    flat = vals.ravel()
+    nz = numpy.flatnonzero( flat )
+    return format_pixels( nz, flat[nz], vals.shape, prefix )
+
+def format_dense( arr, binary=False ):
+    """
+    Body of a *dense* Perseus file: one birth time per line, in
+    row-major order (frame by frame for a 3D block). Values are
+    truncated to int and empty cubes (0) become -1, as array
+    operations.
+
+    binary -- write 1 for every nonzero value (standard homology, see
+    npy2PerseusHom)
+    """
+    vals = numpy.asarray( arr ).astype( int ).ravel()
+    if binary:
+        vals = numpy.where( vals != 0, 1, -1 )
+    else:
+        vals = numpy.where( vals == 0, -1, vals )
+    if len( vals ) == 0:
+        return ''
+    vmin, vmax = vals.min(), vals.max()
+    if vmax - vmin > MAX_VALUE_TABLE:
+        return ( '%d\n' * len( vals ) ) % tuple( vals.tolist() )
+    lo, table = value_strings( int( vmin ), int( vmax ) )
+    return ''.join( table[ vals - lo ].tolist() )
+
+def dense_header( dims ):
+    """
+    Header of a *dense* Perseus file: number of dimensions, then the
+    size of each dimension, one per line.
+    """
+    return str( len( dims ) ) + '\n' + ''.join( [ str( d ) + '\n' for d in dims ] )
+
+def write_dense( arr, output, dims=None, binary=False ):
+    """
+    Write a frame (nx, ny) or a block of frames (n, nx, ny) to *dense*
+    Perseus format with a single write.
+
+    output -- name (full path) of output file
+
+    dims -- sizes written to the header. Default is arr.shape.
+
+    binary -- see format_dense()
+    """
+    if dims is None:
+        dims = numpy.shape( arr )
+    with open( output, 'w' ) as fh:
+        fh.write( dense_header( dims ) + format_dense( arr, binary ) )
+
+def read_block( files, m, n ):
+    """
+    Frames m..n (inclusive) of a frame store, or of a directory of
+    per-frame NPY files, as an (n-m+1, nx, ny) array. Only the frames
+    in the block are read.
+    """
+    if rbc_framestore.is_store( files ):
+        return rbc_framestore.open_store( files )[m:n+1]
+    if not files.endswith( '/' ):
+        files += '/'
+    frames = rbc_catalog.get_catalog( files ).files( 'npy' )
+    return numpy.array( [ numpy.load( f ) for f in frames[m:n+1] ] )
 
 def write_sparse_array( arr, output, ndim=2 ):
     """
@@ -70,14 +232,48 @@ def write_sparse_array( arr, output, ndim=2 ):
     """
     with open( output, 'w' ) as fh:
         fh.write( str( arr.ndim )+'\n' )
-        for i in xrange( arr.shape[0] ): 
-            for j in xrange( arr.shape[1] ):
-                if int( arr[i,j] ) != 0:
-                    pos = str(i) + ' ' + str(j) + ' '
-                    fh.write (pos + str(int( arr[i,j] )) + "\n")
+        fh.write( format_sparse( arr ) )
+
+def write_sparse_frames( frames, output, start=0, stop=None ):
+    """
+    Write frames start..stop-1 of <frames> to *sparse* Perseus
+    format, one file per frame, <output>_<k>.txt.
+
+    frames -- (n, nx, ny) array, path to a 3D NPY file, or a frame
+    store (see rbc_framestore)
+    """
+    if rbc_framestore.is_store( frames ):
+        frames = rbc_framestore.open_store( frames )
+    elif isinstance( frames, str ):
+        frames = numpy.load( frames, mmap_mode='r' )
+    if stop is None:
+        stop = len( frames )
+    for k in xrange( start, stop ):
+        write_sparse_array( frames[k], output + '_' + str( k ) + '.txt' )
         
     
 
+def write_sparse_packed( vec, index, shape, output ):
+    """
+    Write a packed frame (see rbc_framestore.PackedFrameStore) to
+    *sparse* Perseus format. Same output as write_sparse_array() on the
+    dense frame.
+
+    vec -- packed vector of in-cell pixels
+
+    index -- flat (row-major) indices of the in-cell pixels, in packed
+    order
+
+    shape -- shape of the dense frame
+
+    output -- name (full path) of output file
+    """
+    vals = vec.astype( int )
+    nz = numpy.flatnonzero( vals )
+    with open( output, 'w' ) as fh:
+        fh.write( '2\n' )
+        fh.write( format_pixels( index[nz], vals[nz], shape ) )
+
 def write_sparse_file ( fname, output=None ):
     """
     fname -- filename without extension. Extension must be .txt or .npy.
@@ -100,12 +296,7 @@ def write_sparse_file ( fname, output=None ):
         data = numpy.load(fname)
     else:
         data = numpy.loadtxt(fname)
-    size = data.shape
-    for i in range(0,size[0]):
-        for j in range(0,size[1]):
-            if int(data[i][j]) != 0:
-                pos = str(i) + ' ' + str(j) + ' '
-                text . write (pos + str(int(data[i][j])) + "\n")
+    text . write (format_sparse(data))
     text . close()
 
 
@@ -127,24 +318,14 @@ def write_double_file ( fname, output ):
         """
     #Load npy file
     data = numpy.load(fname)
-    size = data.shape
-    dim = len ( size )
-    
-    #Write to output
-    #Open file
+    if data.dtype.kind in 'iub':
+        write_dense (data, output + ".txt")
+        return
+    #floats are written as str(value), not truncated
     text = open (output + ".txt", "w")
-    #Write number of dimensions
-    text . write (str(dim) + "\n")
-    #Write resolutions
-    for i in size:
-        text . write (str(i) + "\n")
-    #Write strictly 2D file
-    for i in range(0,size[0]):
-        for j in range(0,size[1]):
-            if data[i][j] == 0:
-                text . write (str(-1) + "\n")
-            else:
-                text . write (str(data[i][j]) + "\n")
+    text . write (dense_header(data.shape) + \
+                  ''.join(["-1\n" if v == 0 else str(v) + "\n"
+                           for v in data.ravel()]))
     text . close()
 
 def write_distance_mat( data, output=None, g=0.1, stepsize=0.2,
@@ -234,12 +415,16 @@ def plot_block( files, m, n ):
     plt.colorbar()
     plt.show()
 
-def write_All_Cells ( dir, output):
+def write_All_Cells ( dir, output, nproc=1, threads=False, incremental=False ):
     """
         Collects all cells in same directory (say '../New/frames') and writes perseus output (currently writes sparse output)
         Note: dir, output need to end with '/'
         Ex dir: '/data/rbc-Diff-Frames/New/frames/10-diff/'
         ex output: '/home/kellys/Persistence/Perseus/Formatted_Cells/frames/New/diff-10/'
+        nproc, threads: see write_tasks; frames of all cells are shared
+        among the workers
+        incremental: only rewrite frames whose inputs changed (see
+        write_frames)
     """
     cellFolders = []
     cellOutput = []
@@ -248,17 +433,254 @@ def write_All_Cells ( dir, output):
         if os.path.isdir(dir+f) and (f.startswith('new') or f.startswith('old')):
             cellFolders.append(dir+f+'/')
             cellOutput.append(output+f+'/')
+    if nproc != 1 or incremental:
+        tasks = []
+        for cell, out in zip(cellFolders, cellOutput):
+            tasks.extend(cell_tasks(cell, out, incremental=incremental))
+        write_tasks (tasks, nproc, threads)
+        return
     while cellFolders: #if cellF not empty
         write_Cell (cellFolders.pop(0), cellOutput.pop(0) )#call write Cell
 
-def write_Cell ( files, output ):
+def read_manifest ( output ):
+    """
+        - Manifest of an output directory for incremental export:
+          dict of output file name -> digest of its inputs
+        """
+    try:
+        with open(output + MANIFEST_NAME, 'rb') as fh:
+            return pkl.load(fh)
+    except (IOError, EOFError):
+        return {}
+
+def update_manifest ( output, updates ):
+    """
+        - Merge updates into the manifest of <output>. Written under a
+          temporary name (unique to this process and thread) and
+          renamed, so it is never left half written
+        - read, merge and rename hold a lock on <output>'s manifest, so
+          concurrent exports into <output> do not lose each other's
+          updates
+        """
+    if not updates:
+        return
+    with open(output + MANIFEST_NAME + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            manifest = read_manifest (output)
+            manifest.update(updates)
+            tmp = output + MANIFEST_NAME + '.' + str(os.getpid()) + '.' + \
+                str(thread.get_ident()) + '.tmp'
+            with open(tmp, 'wb') as fh:
+                pkl.dump(manifest, fh, protocol=-1)
+            os.rename(tmp, output + MANIFEST_NAME)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def frame_digest ( data, *extra ):
+    """
+        - md5 of a frame (values, dtype and shape) plus any extra inputs
+          (boundary digest, format options)
+        """
+    data = numpy.ascontiguousarray(data)
+    h = hashlib.md5()
+    h.update(data.dtype.str + str(data.shape))
+    h.update(data.data)
+    for e in extra:
+        h.update(str(e))
+    return h.hexdigest()
+
+_file_digests = {}
+def file_digest ( fname ):
+    """
+        - md5 of a (small) file, eg. a boundary, cached by mtime
+        """
+    if fname is None or not os.path.isfile(fname):
+        return ''
+    key = (os.path.abspath(fname), os.stat(fname).st_mtime)
+    if key not in _file_digests:
+        with open(fname, 'rb') as fh:
+            _file_digests[key] = hashlib.md5(fh.read()).hexdigest()
+    return _file_digests[key]
+
+def cell_tasks ( files, output, chunk=100, incremental=False ):
+    """
+        - Split the frames of one cell into shards of <chunk> frames
+        - files is a frame store or a directory of .npy frames (as in
+          write_Cell)
+        - Returns list of (kind, source, output, start, stop, incremental)
+          tasks for write_frames. Stores are passed by path, each worker
+          opens the memmap itself, nothing large is pickled
+        """
+    if rbc_framestore.is_store (files):
+        store = rbc_framestore.open_store (files)
+        return [('store', store.fname, output, k, min(k+chunk, len(store)),
+                 incremental)
+                for k in xrange(0, len(store), chunk)]
+    fdir = files.rstrip('/') + '/'
+    frames = [f for f in os.listdir(fdir)
+              if f.endswith('npy') and not os.path.isdir(fdir+f)]
+    frames.sort(key=natural_key)
+    return [('npy', (fdir, frames[k:k+chunk]), output, 0,
+             len(frames[k:k+chunk]), incremental)
+            for k in xrange(0, len(frames), chunk)]
+
+def write_frames ( task ):
+    """
+        - Worker: write frames start..stop-1 of a task (see cell_tasks)
+          to sparse Perseus format
+        - output names follow <cell>-concatenated-ASCII_<k>.txt
+        - incremental: skip frames whose output exists and whose inputs
+          (frame, boundary, EXPORT_FORMAT) match the manifest
+        - Returns (output, frames in task, frames written, manifest
+          updates)
+        """
+    kind, src, output, start, stop, incremental = task
+    manifest = read_manifest (output) if incremental else {}
+    updates = {}
+    written = [0]
+    def changed ( name, data, *extra ):
+        #True if <name> has to be (re)written
+        if not incremental:
+            written[0] += 1
+            return True
+        digest = frame_digest (data, EXPORT_FORMAT, *extra)
+        if manifest.get(name) == digest and os.path.isfile(output + name):
+            return False
+        updates[name] = digest
+        written[0] += 1
+        return True
+    if kind == 'store':
+        store = rbc_framestore.open_store (src)
+        bnd = file_digest (store.header.get('boundary'))
+        if isinstance(store, rbc_framestore.PackedFrameStore):
+            for k in xrange(start, stop):
+                name = store.frame_name(k)+'.txt'
+                #digest of the dense frame, so switching between packed
+                #and dense stores of the same cell rewrites nothing
+                if changed (name, store[k] if incremental else None, bnd):
+                    write_sparse_packed (store.vector(k), store.index,
+                                         store.frame_shape, output+name)
+        else:
+            for k in xrange(start, stop):
+                name = store.frame_name(k)+'.txt'
+                frame = store[k]
+                if changed (name, frame, bnd):
+                    write_sparse_array (frame, output+name)
+    elif kind == 'block':
+        #3D array with time along the last axis (see write_Cell_Block)
+        fname, cell = src
+        data = numpy.load(fname, mmap_mode='r')
+        for ind in xrange(start, stop):
+            name = cell + '-concatenated-ASCII_'+str(ind) + ".txt"
+            frame = data[:,:,ind]
+            if changed (name, frame):
+                with open(output + name, "w") as text:
+                    text . write ("2\n" + format_sparse(frame))
+    else:
+        fdir, frames = src
+        for frame in frames[start:stop]:
+            name = frame.rstrip('.npy')
+            if incremental:
+                data = numpy.load(fdir+frame)
+                if not changed (name + '.txt', data):
+                    continue
+            else:
+                written[0] += 1
+            write_sparse_file ( fdir+frame, output+name)
+    return output, stop - start, written[0], updates
+
+def write_tasks ( tasks, nproc=None, threads=False, report=1000, flush=1000 ):
+    """
+        - Run write_frames on all tasks using nproc workers
+        - nproc = number of processes (threads if threads=True), default
+          cpu_count(). nproc=1 runs in this process
+        - prints throughput (frames/sec) every <report> frames
+        - manifests of incremental tasks are updated as results arrive,
+          every <flush> frames and when the run ends or is interrupted,
+          so an interrupted export does not redo finished frames
+        - Returns number of frames written
+        """
+    if not tasks:
+        return 0
+    if nproc is None:
+        nproc = cpu_count()
+    nproc = max(1, min(nproc, len(tasks)))
+    total = sum(t[4] - t[3] for t in tasks)
+    if nproc == 1:
+        pool = None
+        results = (write_frames(t) for t in tasks)
+    else:
+        if threads:
+            pool = ThreadPool(nproc)
+        else:
+            pool = Pool(processes=nproc)
+        results = pool.imap_unordered(write_frames, tasks)
+    done = 0
+    written = 0
+    updates = {}
+    pending = [0]
+    def save ():
+        for output, u in updates.iteritems():
+            update_manifest (output, u)
+        updates.clear()
+        pending[0] = 0
+    tstart = time.time()
+    try:
+        for output, n, w, u in results:
+            #report whenever we cross a multiple of <report>
+            if report and (done+n) // report > done // report:
+                elapsed = max(time.time() - tstart, 1e-6)
+                print "  processed", done+n, "of", total, "frames (", \
+                    round((done+n) / elapsed, 1), "frames/sec )"
+            done += n
+            written += w
+            if u:
+                updates.setdefault(output, {}).update(u)
+                pending[0] += n
+                if pending[0] >= flush:
+                    save()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        save()
+    elapsed = max(time.time() - tstart, 1e-6)
+    print "It took ", elapsed, "seconds for", done, "frames (", \
+        round(done / elapsed, 1), "frames/sec,", nproc, "workers ),", \
+        written, "written,", done - written, "unchanged"
+    return written
+
+def write_Cell ( files, output, nproc=1, threads=False, incremental=False ):
     """
         - Using write_file for cell's stack of frames
         - output is location of desired output directory
         e.g. files = '/data/jberwald/wyss/data/Cells_Jesse/Old/frames/old_120125/'
         output = '/home/kellys/Dropbox/rbc_shared/'
+        - files may also be a frame store (see rbc_framestore)
+        - nproc > 1 (or None for cpu_count()) shards the frames among
+          worker processes, or threads if threads=True (see write_tasks)
+        - incremental=True only rewrites frames whose inputs changed
+          since the last incremental export (see write_frames)
         - warning: careful use of output (probably not in Dropbox)
         """
+    if nproc != 1 or incremental:
+        write_tasks (cell_tasks(files, output, incremental=incremental),
+                     nproc, threads)
+        return
+    #frame store, all frames in one memmap
+    if rbc_framestore.is_store (files):
+        store = rbc_framestore.open_store (files)
+        if isinstance(store, rbc_framestore.PackedFrameStore):
+            #packed store, only in-cell pixels are read
+            for k in xrange(len(store)):
+                write_sparse_packed (store.vector(k), store.index,
+                                     store.frame_shape,
+                                     output+store.frame_name(k)+'.txt')
+            return
+        for k, frame in enumerate(store):
+            write_sparse_array (frame, output+store.frame_name(k)+'.txt')
+        return
     #grab files, skip directories
     if os.path.isdir (files):
         fdir = files + '/'
@@ -284,25 +706,10 @@ def write_Comp_Cell ( compArray, output ):
         output = '/home/kellys/Dropbox/rbc_shared/'
         - warning: careful use of output (probably not in Dropbox)
         """
-    data = numpy.load(compArray)
-    #dimension array
-    numDim = 2
-    #Write to output
-    for ind in xrange(data.shape[0]):
-        #Open file
-        text = open (output +'_' + str(ind) + ".txt", "w")
-        #Write number of dimensions
-        text . write (str(numDim) + "\n")
-        #Write strictly 2D file
-        size = data[ind].shape
-        for i in range(0,size[0]):
-            for j in range(0,size[1]):
-                if int(data[ind][i][j]) != 0:
-                    pos = str(i) + ' ' + str(j) + ' '
-                    text . write (pos + str(int(data[ind][i][j])) + "\n")
-        text . close()
+    write_sparse_frames (compArray, output)
         
-def write_Cell_Block ( cAbbr ):
+def write_Cell_Block ( cAbbr, nproc=1, threads=False, chunk=100,
+                       incremental=False ):
     """
         - WRITE 3D NUMPY FILE INTO PERSEUS FORMAT
         - NOTE: cnames is a dictionary of paths to numpy files
@@ -311,29 +718,18 @@ def write_Cell_Block ( cAbbr ):
         - output is location of desired output directory
         e.g. files = '/data/jberwald/wyss/data/Cells_Jesse/Old/frames/old_120125/'
         output = '/home/kellys/Dropbox/rbc_shared/'
+        - the 3D array is memory mapped, frames are sharded among nproc
+          workers (see write_tasks)
         - warning: careful use of output (probably not in Dropbox)
         """
     cnames = pkl.load(open('moreCellNames.pkl','r'))
     fnames = pkl.load(open('moreFileNames.pkl','r'))
-    data = numpy.load(cnames[cAbbr])
+    nFrames = numpy.load(cnames[cAbbr], mmap_mode='r').shape[-1]
     output = fnames[cAbbr]
-    #dimension array
-    numDim = 2
-    #Write to output
-    for ind in xrange(data.shape[-1]):
-        #Open file
-        name = output.split('/')[-2] + '-concatenated-ASCII_'+str(ind)
-        text = open (output + name + ".txt", "w")
-        #Write number of dimensions
-        text . write (str(numDim) + "\n")
-        #Write strictly 2D file
-        size = data[:,:,ind].shape
-        for i in range(0,size[0]):
-            for j in range(0,size[1]):
-                if int(data[i][j][ind]) != 0:
-                    pos = str(i) + ' ' + str(j) + ' '
-                    text . write (pos + str(int(data[i][j][ind])) + "\n")
-        text . close()
+    src = (cnames[cAbbr], output.split('/')[-2])
+    tasks = [('block', src, output, k, min(k+chunk, nFrames), incremental)
+             for k in xrange(0, nFrames, chunk)]
+    write_tasks (tasks, nproc, threads)
     
 def write_block_dense ( files, output, m, n ):
     """
@@ -343,7 +739,14 @@ def write_block_dense ( files, output, m, n ):
         - DENSE CUBICAL TOPLEX FORMAT
         - m is index of frame to start from (index start at 0)
         - n is index of frame to end at
+        - files may also be a frame store (see rbc_framestore), the
+          block is then sliced out of the store
         """
+    if rbc_framestore.is_store (files):
+        block = read_block (files, m, n)
+        #sizes are written backward
+        write_dense (block, output + ".txt", dims=block.shape[::-1])
+        return
     #grab files, skip directories
     if os.path.isdir (files):
         fdir = files + '/'
@@ -378,16 +781,9 @@ def write_block_dense ( files, output, m, n ):
     for i in xrange(len(dataDims)):
         #text . write (str(dataDims[i]) + "\n") #Iterate forward
         text . write (str(dataDims[-1-i]) + "\n")#Iterate backward
-    #Write data
-    for ind, frame in zip(xrange(len(frames)),frames):
-        if ind >= m and ind <= n: #if within block
-            data = numpy.load(files+frame)
-            for i in xrange(imgSize[0]):
-                for j in xrange(imgSize[1]):
-                    if int(data[i][j]) == 0:
-                        text . write (str(-1) + "\n")
-                    else:
-                        text . write (str(int(data[i][j])) + "\n")
+    #Write data, only the frames within the block are loaded
+    block = [numpy.load(files+frame) for frame in frames[m:n+1]]
+    text . write (format_dense(block))
     text . close()
 
 
@@ -434,11 +830,7 @@ def write_sparse ( files, output, m ):
     text . write (str(numDim) + "\n")
     #Write strictly 2D file
     data = numpy.load(files + frames[m])
-    for i in xrange(size[0]):
-        for j in xrange(size[1]):
-            if int(data[i][j]) != 0:
-                pos = str(i) + ' ' + str(j) + ' '
-                text . write (pos + str(int(data[i][j])) + "\n")
+    text . write (format_sparse(data))
     text . close()
 
 def write_block_sparse ( files, output, m, n ):
@@ -486,13 +878,78 @@ def write_block_sparse ( files, output, m, n ):
     for ind, frame in zip(xrange(len(frames)),frames):
         if ind >= m and ind <= n: #if within block
             data = numpy.load(files + frame)
-            for i in xrange(size[0]):
-                for j in xrange(size[1]):
-                    if int(data[i][j]) != 0:
-                        pos =  str(ind) + ' ' + str(i) + ' ' + str(j) + ' ' 
-                        text . write ( pos + str(int(data[i][j])) + "\n")
+            #frame number as the first coordinate
+            text . write (format_sparse(data, prefix=ind))
     text . close()
 
+def frame_reader ( files ):
+    """
+        - Returns ( number of frames, function k -> frame k ) for a frame
+          store, a 3D array (frames first), or a directory of .npy frames
+        """
+    if rbc_framestore.is_store (files):
+        store = rbc_framestore.open_store (files)
+        return len(store), store.__getitem__
+    if isinstance(files, numpy.ndarray):
+        return len(files), files.__getitem__
+    frames = rbc_catalog.get_catalog(files).files('npy')
+    return len(frames), lambda k: numpy.load(frames[k])
+
+def write_windows ( files, output, width, stride=1, start=0, stop=None,
+                    dense=False ):
+    """
+        - Write every 3D block (window) of <width> frames, starting every
+          <stride> frames, to Perseus format. Same output as
+          write_block_sparse (or write_block_dense if dense=True) for
+          each window [m, n], n = m+width-1
+        - files is a frame store, a 3D array or a directory of .npy frames
+        - the cell is streamed once; each frame is read and formatted
+          once and kept in a ring buffer for every window containing it
+        - frames start..stop-1 are used
+        - output files are <output>_<m>-<n>.txt
+        - Returns list of (m, n) windows written
+        """
+    nFrames, read = frame_reader (files)
+    if stop is None or stop > nFrames:
+        stop = nFrames
+    starts = range(start, stop - width + 1, stride)
+    if not starts:
+        print 'no window of width', width, 'in frames', start, 'to', stop-1
+        return []
+    last = starts[-1]
+    header = None
+    ring = deque()
+    windows = []
+    w = 0
+    tstart = time.time()
+    for k in xrange(start, last + width):
+        #latest window starting at or before k
+        m = min(start + ((k - start) // stride) * stride, last)
+        if k <= m + width - 1:#frame k is in a window
+            frame = read(k)
+            if dense:
+                if header is None:
+                    dims = (width,) + tuple(frame.shape)
+                    header = dense_header(dims[::-1])#sizes written backward
+                ring.append((k, format_dense(frame)))
+            else:
+                header = '3\n'
+                ring.append((k, format_sparse(frame, prefix=k)))
+        #write every window ending at k
+        while w < len(starts) and starts[w] + width - 1 == k:
+            m = starts[w]
+            while ring[0][0] < m:
+                ring.popleft()
+            name = output + '_' + str(m) + '-' + str(k) + '.txt'
+            with open(name, 'w') as fh:
+                fh.write(header)
+                fh.writelines([text for j, text in ring])
+            windows.append((m, k))
+            w += 1
+    print "It took ", time.time() - tstart, "seconds for writing", \
+        len(windows), "windows of", width, "frames."
+    return windows
+
 def natural_key(string_):
     """
     Use with frames.sort(key=natural_key)
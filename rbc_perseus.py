@@ -13,56 +13,410 @@ import matplotlib.pylab as plt
 import re
 import os
 import rbc_npy2Perseus as R
-from multiprocessing import Pool
-from subprocess import call
+import time
+import tempfile
+import shutil
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from subprocess import call, Popen, STDOUT
 import pickle as pkl
+import rbc_catalog
+import rbc_framestore
+import rbc_diagrams
+
+PERSEUS = '/usr/bin/perseus'
+# completion ledger kept in each output directory
+LEDGER_NAME = '.perseus_ledger'
+# RAM-backed directories for staging fused runs, tried in order
+STAGING_DIRS = ['/dev/shm']
+# frame stores opened by fused runs, keyed by file name
+_stores = {}
 
 def perseus ( fname, output, type='scubtop' ):
     """
         TYPE is input to perseus ex, cubtop, scubtop, etc
         run perseus
     """
-    call(['/usr/bin/perseus', type, fname, output])
+    call([PERSEUS, type, fname, output])
+
+def perseus_tasks ( type, files, output ):
+    """
+        - Perseus tasks for every frame of a cell
+        - files is directory of Perseus input, output is output prefix
+          (as in run_perseus)
+        - Returns list of (type, input file, output prefix)
+        """
+    fdir = files.rstrip('/') + '/'
+    frames = rbc_catalog.get_catalog(fdir).filenames('pers')
+    return [(type, fdir+frame, output+frame.rstrip('.txt')) for frame in frames]
+
+def ledger_dir ( task ):
+    """
+        - Directory holding the ledger for a task (its output directory)
+        """
+    return os.path.dirname(os.path.abspath(task[2])) + '/'
+
+def read_ledger ( fdir ):
+    """
+        - Output prefixes recorded as complete in the ledger of <fdir>
+        - The ledger is append-only, one 'output<TAB>input' line per
+          frame; a line cut short by a crash is ignored
+        """
+    done = set()
+    try:
+        with open(fdir + LEDGER_NAME, 'r') as fh:
+            for line in fh:
+                if not line.endswith('\n'):
+                    continue
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) == 2:
+                    done.add(fields[0])
+    except IOError:
+        pass
+    return done
+
+def record ( task ):
+    """
+        - Append a completed task to the ledger of its output directory.
+          The line is flushed to disk before returning
+        """
+    with open(ledger_dir(task) + LEDGER_NAME, 'a') as fh:
+        fh.write(os.path.abspath(task[2]) + '\t' + task[1] + '\n')
+        fh.flush()
+        os.fsync(fh.fileno())
+
+def validate_output ( output, dims=(0,1) ):
+    """
+        - True if the Perseus diagrams <output>_<d>.txt exist for every d
+          in dims, and every line is a (birth, death) pair of integers
+        """
+    for d in dims:
+        try:
+            with open(output + '_' + str(d) + '.txt', 'r') as fh:
+                for line in fh:
+                    pair = line.split()
+                    if not pair:
+                        continue
+                    if len(pair) != 2:
+                        return False
+                    int(pair[0]), int(pair[1])
+        except (IOError, ValueError):
+            return False
+    return True
+
+def pending_tasks ( tasks, dims=(0,1) ):
+    """
+        - Drop the tasks recorded in their ledger whose outputs still
+          validate (see validate_output)
+        """
+    ledgers = {}
+    pending = []
+    for task in tasks:
+        fdir = ledger_dir(task)
+        if fdir not in ledgers:
+            ledgers[fdir] = read_ledger(fdir)
+        if os.path.abspath(task[2]) in ledgers[fdir] and \
+                validate_output(task[2], dims):
+            continue
+        pending.append(task)
+    if len(pending) < len(tasks):
+        print "resuming:", len(tasks) - len(pending), "of", len(tasks), \
+            "frames already complete"
+    return pending
+
+def run_task ( task, timeout=None, retries=2, poll=0.5 ):
+    """
+        - Run perseus on one frame, task = (type, input file, output prefix)
+        - the run is killed after <timeout> seconds (None = no limit)
+        - a non-zero exit or a timeout is retried up to <retries> times
+        - Returns dict with the task, 'status' (0 on success, exit code
+          or 'timeout'), 'attempts', 'time' and the tail of perseus'
+          output ('log') on failure
+        """
+    type, fname, output = task
+    tstart = time.time()
+    for attempt in xrange(1, retries + 2):
+        log = tempfile.TemporaryFile()
+        try:
+            proc = Popen([PERSEUS, type, fname, output], stdout=log,
+                         stderr=STDOUT)
+            t0 = time.time()
+            #short jobs are the common case, back off to <poll> seconds
+            wait = 0.01
+            status = proc.poll()
+            while status is None:
+                if timeout is not None and time.time() - t0 > timeout:
+                    proc.kill()
+                    proc.wait()
+                    status = 'timeout'
+                    break
+                time.sleep(wait)
+                wait = min(2*wait, poll)
+                status = proc.poll()
+            tail = ''
+            if status != 0:
+                log.seek(0)
+                tail = log.read()[-500:]
+        except OSError, e:
+            status, tail = 'error', str(e)
+        finally:
+            log.close()
+        if status == 0:
+            break
+    return {'task' : task, 'status' : status, 'attempts' : attempt,
+            'time' : time.time() - tstart, 'log' : tail}
 
-def run_perseus_All ( type, dir, output):
+def run_tasks ( tasks, nproc=None, timeout=None, retries=2, report=10,
+                resume=True, dims=(0,1) ):
+    """
+        - Run perseus on every task (see perseus_tasks), nproc at a time.
+          Frames of all cells share the same pool, so the longest cell
+          does not set the wall time
+        - nproc default is cpu_count(); each worker thread waits on one
+          perseus process
+        - timeout, retries: see run_task
+        - resume: skip frames completed by an earlier (interrupted) run.
+          Each frame is recorded in the ledger of its output directory as
+          soon as its diagrams (dims) validate
+        - prints progress and ETA every <report> seconds, and a summary
+          of the failed frames at the end
+        - Returns list of failed results (see run_task)
+        """
+    if resume:
+        tasks = pending_tasks (tasks, dims)
+    def work ( task ):
+        return run_task (task, timeout, retries)
+    def check ( result ):
+        if result['status'] == 0:
+            if validate_output(result['task'][2], dims):
+                record (result['task'])
+            else:
+                result['status'] = 'invalid output'
+    return run_pool (work, tasks, nproc, report, check)
+
+def run_pool ( work, tasks, nproc=None, report=10, check=None ):
+    """
+        - Call work(task) for every task on nproc threads (default
+          cpu_count()); work returns a result dict as run_task does
+        - check(result) is called in this thread as results come in, and
+          may change result['status']
+        - prints progress and ETA every <report> seconds, and a summary
+          of the failed tasks at the end
+        - Returns list of failed results
+        """
+    if nproc is None:
+        nproc = cpu_count()
+    nproc = max(1, min(nproc, len(tasks)))
+    total = len(tasks)
+    failed = []
+    if not tasks:
+        return failed
+    pool = ThreadPool(nproc)
+    done = 0
+    tstart = time.time()
+    last = tstart
+    try:
+        for result in pool.imap_unordered(work, tasks):
+            done += 1
+            if check is not None:
+                check (result)
+            if result['status'] != 0:
+                failed.append(result)
+            now = time.time()
+            if now - last >= report or done == total:
+                last = now
+                rate = done / max(now - tstart, 1e-6)
+                eta = (total - done) / rate
+                print "  finished", done, "of", total, "frames,", len(failed), \
+                    "failed (", round(rate, 2), "frames/sec, ETA", \
+                    time.strftime('%H:%M:%S', time.gmtime(eta)), ")"
+    finally:
+        pool.close()
+        pool.join()
+    print "It took ", time.time() - tstart, "seconds for", total, \
+        "frames using", nproc, "workers."
+    if failed:
+        print len(failed), "frames failed:"
+        for result in failed:
+            print "  ", result['task'][1], ": status", result['status'], \
+                "after", result['attempts'], "attempts"
+            if result['log']:
+                print "     ", result['log'].strip().replace('\n', '\n      ')
+    return failed
+
+def staging_dir ( stage=None ):
+    """
+        - Directory in which fused runs stage their Perseus files
+        - stage=None: first writable entry of STAGING_DIRS (tmpfs), else
+          the default temp directory; stage='disk': the default temp
+          directory; otherwise stage is the directory itself
+        """
+    if stage is None:
+        for sdir in STAGING_DIRS:
+            if os.path.isdir(sdir) and os.access(sdir, os.W_OK):
+                return sdir
+        stage = 'disk'
+    if stage == 'disk':
+        return tempfile.gettempdir()
+    return stage
+
+def fused_tasks ( type, src, name=None ):
+    """
+        - Fused tasks for every frame of a cell
+        - src is a directory of per-frame npy files, or a frame store
+        - name: cell of the npy files, needed if the directory holds
+          several cells (a ValueError is raised otherwise)
+        - Returns list of (type, source, frame number, index in store),
+          index is None for per-frame npy files
+        """
+    if rbc_framestore.is_store(src):
+        store = rbc_framestore.open_store(src)
+        return [(type, store.fname, k, k) for k in xrange(len(store))]
+    fdir = src.rstrip('/') + '/'
+    cat = rbc_catalog.get_catalog(fdir)
+    return [(type, cat.path(k, 'npy', name), k, None)
+            for k in cat.frames('npy', name)]
+
+def load_frame ( src, ind=None ):
+    """
+        - Frame <ind> of frame store <src>, or npy file <src> if ind is None
+        """
+    if ind is None:
+        return numpy.load(src)
+    if src not in _stores:
+        _stores[src] = rbc_framestore.open_store(src)
+    return _stores[src][ind]
+
+def stage_frame ( task, frame, sdir, dims=(0,1), timeout=None, retries=2 ):
+    """
+        - Write <frame> as sparse Perseus input in a private directory
+          under <sdir>, run perseus there and parse its diagrams. The
+          directory is removed afterwards
+        - Returns result of run_task, with 'task' set to the fused task
+          and 'diagrams' (dict dim --> (n,2) array, None on failure)
+        """
+    tmp = tempfile.mkdtemp(prefix='perseus_', dir=sdir)
+    try:
+        fname = tmp + '/frame.txt'
+        R.write_sparse_array(frame, fname)
+        result = run_task ((task[0], fname, tmp + '/frame'), timeout, retries)
+        result['task'] = task
+        result['diagrams'] = None
+        if result['status'] == 0:
+            try:
+                result['diagrams'] = dict(
+                    (d, rbc_diagrams.read_diagram(tmp+'/frame_'+str(d)+'.txt'))
+                    for d in dims)
+            except (IOError, ValueError):
+                result['status'] = 'invalid output'
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return result
+
+def run_fused ( task, stage=None, dims=(0,1), timeout=None, retries=2 ):
+    """
+        - Export, perseus and parse for one frame (see fused_tasks),
+          without keeping any Perseus files
+        - stage: where to stage the Perseus files, see staging_dir. If
+          staging fails (eg. tmpfs is full) the frame is redone on disk
+        - Returns result of stage_frame
+        """
+    frame = load_frame(task[1], task[3])
+    try:
+        return stage_frame (task, frame, staging_dir(stage), dims, timeout,
+                            retries)
+    except (IOError, OSError):
+        if stage == 'disk':
+            raise
+        return stage_frame (task, frame, staging_dir('disk'), dims, timeout,
+                            retries)
+
+def run_fused_cell ( src, output, type='scubtop', nproc=None, stage=None,
+                     dims=(0,1), timeout=None, retries=2, flush=100, report=10,
+                     name=None ):
+    """
+        - Fused pipeline for a cell: each frame of <src> (directory of npy
+          frames, or a frame store) is exported, run through perseus and
+          parsed by one worker, and its diagrams are appended to the
+          diagram store <output> (see rbc_diagrams). No Perseus input or
+          output files are kept
+        - stage: see staging_dir, stage='disk' stages on disk
+        - frames already in <output> are skipped, so an interrupted run
+          resumes; the store is flushed every <flush> frames
+        - nproc, timeout, retries, report: see run_tasks
+        - name: cell of the npy frames in <src>, see fused_tasks
+        - Returns list of failed results (see stage_frame)
+        """
+    dgms = rbc_diagrams.open_diagrams(output, dims)
+    tasks = [task for task in fused_tasks(type, src, name)
+             if task[2] not in dgms]
+    def work ( task ):
+        # any failure is recorded against its frame, the other frames
+        # of the cell go on
+        try:
+            return run_fused (task, stage, dims, timeout, retries)
+        except Exception, e:
+            return {'task' : task, 'status' : 'error', 'attempts' : 1,
+                    'time' : 0, 'log' : str(e), 'diagrams' : None}
+    counter = [0]
+    def check ( result ):
+        if result['status'] == 0:
+            dgms.append(result['task'][2], result['diagrams'])
+            counter[0] += 1
+            if counter[0] % flush == 0:
+                dgms.flush()
+    try:
+        failed = run_pool (work, tasks, nproc, report, check)
+    finally:
+        dgms.flush()
+    return failed
+
+def run_perseus_All ( type, dir, output, nproc=None, resume=True ):
     """
         Collects all cells in same directory (say '../New') and runs perseus
         Note: dir, output need to end with '/'
+        nproc: workers, default cpu_count() (see run_tasks); 1 runs serially
+        resume: an interrupted batch picks up where it stopped (see run_tasks)
+        Returns list of failed frames
     """
-    cellFolders = []
-    cellOutput = []
+    tasks = []
     dlist = os.listdir(dir)
     for f in dlist:
         if os.path.isdir(dir+f):
-            cellFolders.append(dir+f+'/')
-            cellOutput.append(output+f+'/')#no +f if want in ..-all directory
-    while cellFolders:
-        run_perseus (type, cellFolders.pop(0), cellOutput.pop(0) )#perseus for frames of cell
+            #no +f if want in ..-all directory
+            tasks.extend(perseus_tasks(type, dir+f+'/', output+f+'/'))
+    return run_tasks (tasks, nproc, resume=resume)
 
-def run_perseus_More ( type='scubtop' ):
+def run_perseus_More ( type='scubtop', nproc=None, resume=True ):
     """
         Collects all cells in same directory (say '../New') and runs perseus
         Note: dir, output need to end with '/'
+        nproc: workers, default cpu_count() (see run_tasks); 1 runs serially
+        resume: an interrupted batch picks up where it stopped (see run_tasks)
+        Returns list of failed frames
     """
     fnames = pkl.load(open('moreFileNames.pkl','r'))
     outnames = pkl.load(open('morePersFiles.pkl','r'))
-    
+    tasks = []
     for cAbbr in fnames:
-        run_perseus (type, fnames[cAbbr], outnames[cAbbr] )#perseus for frames of cell
+        tasks.extend(perseus_tasks(type, fnames[cAbbr], outnames[cAbbr]))
+    return run_tasks (tasks, nproc, resume=resume)
 
-def run_perseus_All_parallel ( dir, output):
+def run_perseus_All_parallel ( dir, output, type='scubtop', nproc=None,
+                               timeout=None, retries=2, resume=True ):
     """
         Parallel implementation
+        Frames of all cells are scheduled individually on nproc workers
+        (default cpu_count()), see run_tasks
+        Returns list of failed frames
         """
-    pool = Pool(processes=7)
-    cellFolders = []
-    cellOutput = []
+    tasks = []
     dlist = os.listdir(dir)
     for f in dlist:
         if os.path.isdir(dir+f):
-            cellFolders.append(dir+f+'/')
-            cellOutput.append(output+'/')#no +f if want in ..-all directory
-    pool.map(run_perseus,zip(cellFolders,cellOutput))#perseus for frames of cell
+            #no +f if want in ..-all directory
+            tasks.extend(perseus_tasks(type, dir+f+'/', output+'/'))
+    return run_tasks (tasks, nproc, timeout, retries, resume=resume)
 
 def run_perseus_list ( type, folder, file, list, output):
     """
@@ -75,30 +429,23 @@ def run_perseus_list ( type, folder, file, list, output):
     for l in list:
         dir = folder + file + '/'
         frame = dir + file + interm + str(l) + '.txt'
-        perseus ( type, frame, output + file + '_' + str(l))
+        perseus ( frame, output + file + '_' + str(l), type )
 
-def run_perseus ( type, files, output ):
+def run_perseus ( type, files, output, nproc=None, resume=True ):
     """
         - Using perseus to run on single frame
         - output is location of desired output directory
         e.g. files = '/home/kellys/Persistence/Perseus/Output/frames/Old/diff-10/'
         output = '/home/kellys/Persistence/Perseus/Output'
+        - nproc: workers, default cpu_count() (see run_tasks); 1 runs
+          serially
+        - resume: skip frames completed by an earlier run (see run_tasks)
         - warning: careful use of output (probably not in Dropbox)
+        - Returns list of failed frames
         """
-    #grab files, skip directories
-    if os.path.isdir (files):
-        fdir = files + '/'
-        dlist = os.listdir(fdir)
-        frames = []
-        for f in dlist:
-            if f.endswith('.txt') and not os.path.isdir(fdir+f):
-                frames.append(f)
-    else:
+    if not os.path.isdir (files):
         print 'error'
-    #sort frames
-    frames.sort(key=R.natural_key)
-    #for all frames call write_file
-    for frame in frames:
-        print fdir+frame
-        perseus ( type, fdir+frame, output+frame.rstrip('.txt'))
+        return
+    return run_tasks (perseus_tasks(type, files, output), nproc,
+                      resume=resume)
         
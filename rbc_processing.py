@@ -14,6 +14,7 @@ matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import re
 import os
+import rbc_framestore
 
 def save_npy_as_png( data, output ):
     plt.ioff()
@@ -46,6 +47,19 @@ def npy2png( folder, file, list, output ):
         plt.savefig(output + file + '_' + str(l))
 
 def diff_image (files, savedir):
+    """
+        files - directory of npy frames or a frame store (see rbc_framestore)
+        savedir - output directory, needs to end in '/'
+        """
+    #frame store, consecutive frames are views into one memmap
+    if rbc_framestore.is_store(files):
+        store = rbc_framestore.open_store(files)
+        n = len(store)
+        for k in xrange(1, n-1):
+            #upcast, compact unsigned frames would wrap
+            diffFrame = numpy.abs(store[k].astype(float)-store[k-1])
+            numpy.save(savedir+store.frame_name(k) + '.npy',diffFrame)
+        return
     if os.path.isdir(files):
         fdir = files + '/'
         dlist = os.listdir(fdir)
@@ -62,7 +76,8 @@ def diff_image (files, savedir):
     frames.sort(key=natural_key)
     for frame in frames:
         k = k+1
-        newFrame = numpy.load(fdir+frame)
+        #upcast, compact unsigned frames would wrap when differenced
+        newFrame = numpy.load(fdir+frame).astype(float)
         savename = frame.rstrip('.npy')
         if k!= 1 and k < n:
             diffFrame = numpy.abs(newFrame-prevFrame)
@@ -88,7 +103,8 @@ def k_diff_image (files, savedir, k):
     frames.sort(key=natural_key)
     for frame in frames:
         i = i+1
-        newFrame = numpy.load(fdir+frame)
+        #upcast, compact unsigned frames would wrap when differenced
+        newFrame = numpy.load(fdir+frame).astype(float)
         savename = frame.rstrip('.npy')
         if i > k:
             #diffFrame = numpy.abs(newFrame-frameStack.pop(0))#abs value
@@ -0,0 +1,392 @@
+"""
+Module containing per-frame statistics tables. The statistics that
+the analysis code needs for every frame (eg., the max height for
+infinite Perseus generators, the median for betti thresholds) are
+computed once, in a single vectorized pass over the frames, and saved
+next to the frames as an NPZ sidecar. Lookups are then cached array
+indexing instead of numpy.load'ing a whole frame.
+
+Useage:
+
+In [1]: import rbc_stats as S
+
+In [2]: stats = S.get_stats( '/data/jberwald/rbc/New/new_110125-concatenated-ASCII_stack.npy' )
+
+In [3]: stats['max']             # max of every frame
+
+In [4]: stats.get( 324, 'median' )
+
+In [5]: S.frame_stat( '/data/rbc/New/new_110125/new_110125-concatenated-ASCII_324.npy', 'max' )
+
+Sources of frames and their sidecars:
+
+frame store -- <store>_stats.npz, eg. new_110125-concatenated-ASCII_stack_stats.npz
+
+3D block (nx, ny, frames) -- <block>_stats.npz
+
+directory of per-frame NPY files -- <fdir><name>_stats.npz, eg.
+new_110125-concatenated-ASCII_stats.npz. The table also records the
+mtime and size of every frame file (SOURCE_COLUMNS); frames that were
+added or rewritten since are recomputed and merged in, frames whose
+files are gone are dropped.
+
+Columns (COLUMNS), one entry per frame:
+
+min -- smallest in-cell (nonzero) value, 0 for an empty frame
+
+max -- largest value in the frame
+
+mean, median -- of the in-cell values, nan for an empty frame
+
+count -- number of in-cell pixels
+
+sum -- sum of the in-cell values
+"""
+import numpy
+import os
+import time
+import rbc_framestore
+import rbc_catalog
+
+slash = '/'
+
+STATS_SUFFIX = '_stats.npz'
+COLUMNS = ( 'min', 'max', 'mean', 'median', 'count', 'sum' )
+# recorded for each frame of a directory, to notice rewritten frames
+SOURCE_COLUMNS = ( 'mtime', 'size' )
+
+# cache of FrameStats, keyed by absolute path of the sidecar. Values
+# are ( sidecar mtime, FrameStats ).
+_tables = {}
+
+
+def frame_stats( frames ):
+    """
+    Compute the statistics for a stack of frames, (n, nx, ny) or
+    packed (n, npix), in one pass. Returns a dict of length n arrays,
+    keyed by COLUMNS.
+    """
+    frames = numpy.asarray( frames )
+    n = frames.shape[0]
+    flat = frames.reshape( (n, -1) )
+    if flat.dtype.kind in 'iub':
+        acc = numpy.int64
+    else:
+        acc = numpy.float64
+    mask = flat > 0
+    count = mask.sum( axis=1 )
+    total = numpy.where( mask, flat, 0 ).sum( axis=1, dtype=acc )
+    # one sort per frame gives both the min and the median of the
+    # in-cell values; out-of-cell pixels sort to the end
+    vals = numpy.where( mask, flat, numpy.inf )
+    vals.sort( axis=1 )
+    rows = numpy.arange( n )
+    safe = numpy.maximum( count, 1 )
+    median = ( vals[ rows, (safe-1) // 2 ] + vals[ rows, safe // 2 ] ) / 2.
+    empty = count == 0
+    vmin = numpy.where( empty, 0, vals[:,0] ).astype( acc )
+    median[ empty ] = numpy.nan
+    mean = total / safe.astype( numpy.float64 )
+    mean[ empty ] = numpy.nan
+    if flat.shape[1]:
+        vmax = flat.max( axis=1 ).astype( acc )
+    else:
+        vmax = numpy.zeros( n, dtype=acc )
+    return { 'min' : vmin,
+             'max' : vmax,
+             'mean' : mean,
+             'median' : median,
+             'count' : count.astype( numpy.int64 ),
+             'sum' : total }
+
+def concat_stats( parts ):
+    """
+    Join a list of frame_stats() dicts, eg. one per chunk of frames.
+    """
+    return dict( ( c, numpy.concatenate( [ p[c] for p in parts ] ) )
+                 for c in COLUMNS )
+
+def file_stats( files ):
+    """
+    Modification times and sizes of <files>, as the table of a
+    directory records them. Returns a dict of arrays keyed by
+    SOURCE_COLUMNS.
+    """
+    st = [ os.stat( f ) for f in files ]
+    return { 'mtime' : numpy.array( [ x.st_mtime for x in st ], dtype=numpy.float64 ),
+             'size' : numpy.array( [ x.st_size for x in st ], dtype=numpy.int64 ) }
+
+def _dir_name( fdir, name ):
+    """
+    Cell name of the per-frame NPY files in <fdir>.
+    """
+    if name is None:
+        names = rbc_catalog.get_catalog( fdir ).names( 'npy' )
+        if len( names ) != 1:
+            raise ValueError( fdir + " holds " + str( len( names ) ) + \
+                              " cells, pass name= one of " + str( names ) )
+        name = names[0]
+    return name
+
+def stats_name( src, name=None ):
+    """
+    Name of the sidecar for <src>: a frame store, a 3D block, or a
+    directory of per-frame NPY files named <name>_<k>.npy.
+    """
+    if isinstance( src, rbc_framestore.FrameStore ):
+        src = src.fname
+    if os.path.isdir( src ):
+        if not src.endswith( slash ): src += slash
+        return src + _dir_name( src, name ) + STATS_SUFFIX
+    return src[:-4] + STATS_SUFFIX
+
+def compute_stats( src, name=None, chunk=100, only=None ):
+    """
+    Compute the statistics of every frame in <src> (see stats_name()),
+    <chunk> frames at a time.
+
+    only -- for a directory, compute only these frame numbers
+
+    Returns ( frame numbers, dict of columns ). For a directory the
+    dict also holds SOURCE_COLUMNS.
+    """
+    source = None
+    if isinstance( src, rbc_framestore.FrameStore ) or \
+            rbc_framestore.is_store( src ):
+        store = rbc_framestore.open_store( src )
+        if isinstance( store, rbc_framestore.PackedFrameStore ):
+            # no need to unpack, the statistics only see in-cell pixels
+            getter = store.vector
+        else:
+            getter = store.__getitem__
+        nframes = len( store )
+        parts = [ frame_stats( getter( slice( k, k+chunk ) ) )
+                  for k in xrange( 0, nframes, chunk ) ]
+        frames = numpy.arange( nframes )
+    elif os.path.isdir( src ):
+        cat = rbc_catalog.get_catalog( src )
+        name = _dir_name( src, name )
+        frames = cat.frames( 'npy', name )
+        if only is not None:
+            only = set( only )
+            frames = [ k for k in frames if k in only ]
+        files = [ cat.path( k, 'npy', name ) for k in frames ]
+        frames = numpy.array( frames, dtype=numpy.int64 )
+        # stat before loading, so a frame rewritten meanwhile is
+        # recomputed next time
+        source = file_stats( files )
+        parts = [ frame_stats( [ numpy.load( f ) for f in files[k:k+chunk] ] )
+                  for k in xrange( 0, len( files ), chunk ) ]
+    else:
+        # rbc_dlag's 3D blocks keep time along the last axis
+        block = numpy.load( src, mmap_mode='r' )
+        nframes = block.shape[-1]
+        parts = [ frame_stats( numpy.rollaxis( block[..., k:k+chunk], -1 ) )
+                  for k in xrange( 0, nframes, chunk ) ]
+        frames = numpy.arange( nframes )
+    if not parts:
+        parts = [ frame_stats( numpy.zeros( (0, 0) ) ) ]
+    stats = concat_stats( parts )
+    if source is not None:
+        stats.update( source )
+    return frames, stats
+
+def save_stats( sname, frames, stats ):
+    """
+    Write a stats table to <sname>. The table is written under a
+    temporary name and renamed, so readers never see a partial file.
+    SOURCE_COLUMNS are written if <stats> holds them.
+    """
+    tmp = sname[:-4] + '.tmp' + str( os.getpid() ) + '.npz'
+    cols = dict( ( c, stats[c] ) for c in COLUMNS + SOURCE_COLUMNS
+                 if c in stats )
+    numpy.savez( tmp, frame=numpy.asarray( frames ), **cols )
+    os.rename( tmp, sname )
+    _tables.pop( os.path.abspath( sname ), None )
+
+def write_stats( src, name=None, chunk=100 ):
+    """
+    Compute and save the stats table for <src>. Returns the
+    FrameStats.
+    """
+    sname = stats_name( src, name )
+    tstart = time.time()
+    frames, stats = compute_stats( src, name, chunk )
+    save_stats( sname, frames, stats )
+    print "It took ", time.time() - tstart, "seconds for computing stats of", \
+        len( frames ), "frames."
+    return _load_table( sname )
+
+def update_stats( fdir, name=None, frames=() ):
+    """
+    Recompute the statistics of <frames> (frame numbers) of the
+    per-frame NPY files in directory <fdir> and merge them into its
+    table; frames whose files are gone are dropped. If there is no
+    table, or it does not record SOURCE_COLUMNS, all frames are
+    recomputed. Returns the FrameStats.
+    """
+    if not fdir.endswith( slash ): fdir += slash
+    name = _dir_name( fdir, name )
+    sname = stats_name( fdir, name )
+    table = _load_table( sname )
+    if table is None or table.source is None:
+        return write_stats( fdir, name )
+    new, stats = compute_stats( fdir, name, only=frames )
+    listed = rbc_catalog.get_catalog( fdir ).frames( 'npy', name )
+    keep = numpy.in1d( table.frame, listed ) & ~numpy.in1d( table.frame, new )
+    allframes = numpy.concatenate( ( table.frame[keep], new ) )
+    order = numpy.argsort( allframes, kind='mergesort' )
+    cols = dict( ( c, numpy.concatenate( ( table[c][keep], stats[c] ) )[order] )
+                 for c in COLUMNS + SOURCE_COLUMNS )
+    save_stats( sname, allframes[order], cols )
+    return _load_table( sname )
+
+def _load_table( sname ):
+    """
+    The (cached) FrameStats in <sname>, or None if there is none.
+    """
+    try:
+        smtime = os.stat( sname ).st_mtime
+    except OSError:
+        return None
+    key = os.path.abspath( sname )
+    cached = _tables.get( key )
+    if cached is not None and cached[0] == smtime:
+        return cached[1]
+    table = FrameStats( sname )
+    _tables[ key ] = ( smtime, table )
+    return table
+
+def _stale_frames( table, fdir, name ):
+    """
+    Frames of directory <fdir> that are missing from <table> or were
+    rewritten since, and whether frames were removed. Returns ( list
+    of frame numbers, bool ).
+    """
+    cat = rbc_catalog.get_catalog( fdir )
+    frames = cat.frames( 'npy', name )
+    source = file_stats( [ cat.path( k, 'npy', name ) for k in frames ] )
+    stale = [ k for k, mtime, size in zip( frames, source['mtime'].tolist(),
+                                           source['size'].tolist() )
+              if not table.fresh( k, mtime, size ) ]
+    return stale, not numpy.in1d( table.frame, frames ).all()
+
+def get_stats( src, name=None ):
+    """
+    Return the (cached) FrameStats for <src>, computing the table if
+    it is missing.
+
+    For a store or block, the table is recomputed if it is older than
+    <src>. For a directory, frames added or rewritten since the table
+    was written are recomputed (see update_stats()).
+    """
+    if isinstance( src, rbc_framestore.FrameStore ):
+        src = src.fname
+    sname = stats_name( src, name )
+    table = _load_table( sname )
+    if table is None:
+        return write_stats( src, name )
+    if os.path.isdir( src ):
+        if table.source is None:
+            return write_stats( src, name )
+        stale, removed = _stale_frames( table, src, _dir_name( src, name ) )
+        if stale or removed:
+            return update_stats( src, name, stale )
+    elif os.stat( sname ).st_mtime < os.stat( src ).st_mtime:
+        return write_stats( src, name )
+    return table
+
+def frame_stat( fname, column, ind=None ):
+    """
+    Look up <column> for a single frame.
+
+    fname -- per-frame NPY file (eg.,
+    <fdir>/new_110125-concatenated-ASCII_324.npy), or, if <ind> is
+    given, a frame store or 3D block
+
+    ind -- frame number within the store or block
+
+    Only <fname> itself is checked against the table of its
+    directory; if the table does not hold it, or the file was
+    rewritten since, just that frame is recomputed and merged in.
+    """
+    if ind is None:
+        fdir, _, f = os.path.abspath( fname ).rpartition( slash )
+        parsed = rbc_catalog.parse_name( f )
+        if parsed is None or parsed[0] != 'npy':
+            raise ValueError( "not a per-frame NPY file: " + fname )
+        kind, name, ind = parsed
+        fdir += slash
+        table = _load_table( stats_name( fdir, name ) )
+        st = os.stat( fname )
+        if table is None or not table.fresh( ind, st.st_mtime, st.st_size ):
+            table = update_stats( fdir, name, [ ind ] )
+    else:
+        table = get_stats( fname )
+    return table.get( ind, column )
+
+def clear_cache():
+    """
+    Forget all cached tables.
+    """
+    _tables.clear()
+
+
+class FrameStats( object ):
+    """
+    Columns of per-frame statistics. stats[ column ] is an array with
+    one entry per frame, in the order of stats.frame.
+
+    self.source -- dict of SOURCE_COLUMNS for tables of directories,
+    else None
+    """
+    def __init__( self, fname ):
+        self.fname = fname
+        npz = numpy.load( fname )
+        try:
+            self.frame = npz['frame']
+            self.columns = dict( ( c, npz[c] ) for c in COLUMNS )
+            if all( c in npz.files for c in SOURCE_COLUMNS ):
+                self.source = dict( ( c, npz[c] ) for c in SOURCE_COLUMNS )
+                self.columns.update( self.source )
+            else:
+                self.source = None
+        finally:
+            npz.close()
+        self._row = dict( ( k, i ) for i, k in enumerate( self.frame.tolist() ) )
+
+    def __len__( self ):
+        return len( self.frame )
+
+    def __contains__( self, k ):
+        return k in self._row
+
+    def __getitem__( self, column ):
+        return self.columns[ column ]
+
+    def __repr__( self ):
+        return "FrameStats( '" + self.fname + "', " + str( len( self ) ) + \
+            " frames )"
+
+    def fresh( self, k, mtime, size ):
+        """
+        True if the table holds frame k, computed from a file with this
+        <mtime> and <size>.
+        """
+        i = self._row.get( k )
+        if i is None or self.source is None:
+            return False
+        return self.source['mtime'][i] == mtime and self.source['size'][i] == size
+
+    def get( self, k, column ):
+        """
+        Value of <column> for frame k.
+        """
+        return self.columns[ column ][ self._row[ k ] ]
+
+    def row( self, k ):
+        """
+        All columns for frame k, as a dict.
+        """
+        i = self._row[ k ]
+        return dict( ( c, self.columns[c][i] ) for c in COLUMNS )
@@ -0,0 +1,328 @@
+"""
+Module containing an in-process engine for sublevel set persistence
+of 2D frames. It gives the same diagrams as running
+
+perseus scubtop <frame>.txt <output>
+
+on the sparse Perseus file of a frame (see rbc_npy2Perseus), without
+spawning perseus or writing any text files.
+
+The complex is the union of the closed unit squares of the nonzero
+pixels, each entering at its (int truncated) value:
+
+H_0 -- union-find over the pixels in increasing order. Squares
+sharing an edge or a corner are connected (8-connectivity). When two
+components meet the younger one dies (elder rule).
+
+H_1 -- by Alexander duality, a hole of the frame is a bounded
+component of the complement. Running the same union-find over the
+pixels in decreasing order, on the complement (4-connectivity), with
+one node for the outside of the frame, gives the holes: a hole is born
+at the value of the pixel that splits it off, and dies at the largest
+value in it. Zero pixels inside the frame never fill, so a hole
+around them never dies.
+
+As in Perseus output, zero persistence pairs are left out and
+infinite generators have death time -1. Pairs are returned as an
+(n, 2) int32 array, finite pairs sorted by birth and death, followed
+by the infinite pairs.
+
+Useage:
+
+In [1]: import rbc_sublevel as S
+
+In [2]: dgms = S.persistence( frame )      # { 0 : gens0, 1 : gens1 }
+
+In [3]: S.validate( frame, '/data/PerseusData/new_110125/new_110125-concatenated-ASCII_1000' )
+
+In [4]: S.persistence_cell( '/data/jberwald/rbc/New/new_110125-concatenated-ASCII_stack.npy',
+                            '/data/PerseusData/new_110125_dgms' )
+"""
+import numpy
+import time
+from scipy import ndimage
+from multiprocessing import Pool, cpu_count
+import rbc_framestore
+import rbc_catalog
+import rbc_diagrams
+
+slash = '/'
+
+
+def _pad( frame ):
+    """
+    Frame values, int truncated, with a ring of zeros around the frame
+    so neighbors never run off the edge. Returns ( padded frame, flat
+    padded frame ).
+    """
+    vals = numpy.asarray( frame ).astype( numpy.int64 )
+    if vals.ndim != 2:
+        raise ValueError( "expected a 2D frame, got shape " + str( vals.shape ) )
+    padded = numpy.zeros( ( vals.shape[0]+2, vals.shape[1]+2 ), dtype=numpy.int64 )
+    padded[1:-1,1:-1] = vals
+    return padded, padded.ravel()
+
+def _pairs( finite, infinite ):
+    """
+    (n, 2) int32 array of the finite pairs, sorted, followed by the
+    infinite ones (death -1), sorted by birth.
+    """
+    finite = numpy.array( finite, dtype=numpy.int64 ).reshape( (-1, 2) )
+    finite = finite[ numpy.lexsort( ( finite[:,1], finite[:,0] ) ) ]
+    births = numpy.sort( numpy.array( infinite, dtype=numpy.int64 ) )
+    inf = numpy.column_stack( ( births, -numpy.ones_like( births ) ) )
+    return numpy.concatenate( ( finite, inf ) ).astype( numpy.int32 )
+
+def h0( frame ):
+    """
+    H_0 persistence pairs of <frame> (see module docstring).
+    """
+    padded, flat = _pad( frame )
+    w = padded.shape[1]
+    offsets = ( -w-1, -w, -w+1, -1, 1, w-1, w, w+1 )
+    nz = numpy.flatnonzero( flat )
+    order = nz[ numpy.argsort( flat[nz], kind='mergesort' ) ].tolist()
+    vals = flat.tolist()
+    parent = range( len( vals ) )
+    present = bytearray( len( vals ) )
+    finite = []
+    for p in order:
+        present[p] = 1
+        v = vals[p]
+        for o in offsets:
+            q = p + o
+            if not present[q]:
+                continue
+            # find, with path halving
+            while parent[q] != q:
+                parent[q] = parent[ parent[q] ]
+                q = parent[q]
+            r = p
+            while parent[r] != r:
+                parent[r] = parent[ parent[r] ]
+                r = parent[r]
+            if q == r:
+                continue
+            # the root's value is the birth of its component
+            if vals[q] > vals[r]:
+                q, r = r, q
+            if vals[r] != v:
+                finite.append( ( vals[r], v ) )
+            parent[r] = q
+    infinite = [ vals[p] for p in order if parent[p] == p ]
+    return _pairs( finite, infinite )
+
+def h1( frame ):
+    """
+    H_1 persistence pairs of <frame> (see module docstring).
+    """
+    padded, flat = _pad( frame )
+    w = padded.shape[1]
+    offsets = ( -w, -1, 1, w )
+    # components of the zero pixels, never filled. The ring around the
+    # frame joins everything connected to the outside.
+    labels, nlabels = ndimage.label( padded == 0 )
+    labels = labels.ravel()
+    nz = numpy.flatnonzero( flat )
+    order = nz[ numpy.argsort( -flat[nz], kind='mergesort' ) ].tolist()
+    # birth (in decreasing order) of each root. Bounded zero components
+    # come before all pixels; the outside is the eldest of all.
+    top = ( int( flat.max() ) if len( nz ) else 0 ) + 1
+    births = flat.tolist()
+    parent = range( len( births ) )
+    present = bytearray( len( births ) )
+    zero = numpy.flatnonzero( labels )
+    roots = numpy.zeros( nlabels+1, dtype=numpy.int64 )
+    roots[ labels[zero][::-1] ] = zero[::-1]
+    for p, l in zip( zero.tolist(), labels[zero].tolist() ):
+        parent[p] = int( roots[l] )
+        present[p] = 1
+    for r in roots[1:].tolist():
+        births[r] = top
+    births[0] = top + 1
+    finite = []
+    infinite = []
+    for p in order:
+        present[p] = 1
+        v = births[p]
+        for o in offsets:
+            q = p + o
+            if not present[q]:
+                continue
+            while parent[q] != q:
+                parent[q] = parent[ parent[q] ]
+                q = parent[q]
+            r = p
+            while parent[r] != r:
+                parent[r] = parent[ parent[r] ]
+                r = parent[r]
+            if q == r:
+                continue
+            # the younger component has the smaller birth, and becomes
+            # a hole born at v
+            if births[q] < births[r]:
+                q, r = r, q
+            if births[r] >= top:
+                infinite.append( v )
+            elif births[r] != v:
+                finite.append( ( v, births[r] ) )
+            parent[r] = q
+    return _pairs( finite, infinite )
+
+def persistence( frame, dims=(0, 1) ):
+    """
+    Persistence diagrams of a 2D frame. Returns a dict, dimension -->
+    (n, 2) int32 array of (birth, death) pairs.
+    """
+    engines = { 0 : h0, 1 : h1 }
+    return dict( ( d, engines[d]( frame ) ) for d in dims )
+
+def read_perseus( output, dims=(0, 1) ):
+    """
+    Read Perseus output <output>_<d>.txt for each d in dims into a dict
+    like persistence() returns.
+    """
+    return dict( ( d, rbc_diagrams.read_diagram( output + '_' + str( d ) + '.txt' ) )
+                 for d in dims )
+
+def write_perseus( dgms, output ):
+    """
+    Write diagrams (see persistence()) as Perseus output,
+    <output>_<d>.txt, for the functions that read Perseus files.
+    """
+    for d, pairs in dgms.iteritems():
+        with open( output + '_' + str( d ) + '.txt', 'w' ) as fh:
+            fh.write( ''.join( [ str( b ) + ' ' + str( e ) + '\n'
+                                 for b, e in pairs.tolist() ] ) )
+
+def same_diagram( a, b ):
+    """
+    True if two diagrams hold the same pairs (in any order).
+    """
+    a = numpy.asarray( a ).reshape( (-1, 2) )
+    b = numpy.asarray( b ).reshape( (-1, 2) )
+    if a.shape != b.shape:
+        return False
+    a = a[ numpy.lexsort( ( a[:,1], a[:,0] ) ) ]
+    b = b[ numpy.lexsort( ( b[:,1], b[:,0] ) ) ]
+    return bool( numpy.all( a == b ) )
+
+def validate( frame, expected, dims=(0, 1) ):
+    """
+    Compare the diagrams of <frame> against stored Perseus output.
+
+    expected -- Perseus output prefix (reads <expected>_<d>.txt), or a
+    dict of diagrams
+
+    Returns the list of dimensions that disagree (empty if all match).
+    """
+    if isinstance( expected, str ):
+        expected = read_perseus( expected, dims )
+    dgms = persistence( frame, dims )
+    return [ d for d in dims if not same_diagram( dgms[d], expected[d] ) ]
+
+def frame_source( src, name=None ):
+    """
+    Frames of a cell: a frame store, or a directory of per-frame NPY
+    files (of cell <name>, needed if it holds several cells). Returns
+    list of ( frame number, source, index in store ), with index None
+    for NPY files.
+    """
+    if rbc_framestore.is_store( src ):
+        store = rbc_framestore.open_store( src )
+        return [ ( k, store.fname, k ) for k in xrange( len( store ) ) ]
+    cat = rbc_catalog.get_catalog( src )
+    return [ ( k, cat.path( k, 'npy', name ), None )
+             for k in cat.frames( 'npy', name ) ]
+
+def validate_cell( src, pdir, dims=(0, 1), name=None ):
+    """
+    Validate the engine against the Perseus output in directory <pdir>
+    for every frame of <src> (see frame_source(), for <name>) that has
+    one.
+
+    Returns dict, frame number --> list of dimensions that disagree,
+    for the frames that do not match.
+    """
+    cat = rbc_catalog.get_catalog( pdir )
+    bad = {}
+    nframes = 0
+    for k, fname, ind in frame_source( src, name ):
+        expected = {}
+        for d in dims:
+            path = cat.path( k, 'dgm' + str( d ) )
+            if path is not None:
+                expected[d] = rbc_diagrams.read_diagram( path )
+        if len( expected ) != len( dims ):
+            continue
+        nframes += 1
+        diff = validate( _load( fname, ind ), expected, dims )
+        if diff:
+            bad[k] = diff
+    print "validated", nframes, "frames,", len( bad ), "disagree"
+    return bad
+
+# frame stores opened in this (worker) process, keyed by file name
+_stores = {}
+
+def _load( fname, ind ):
+    if ind is None:
+        return numpy.load( fname )
+    if fname not in _stores:
+        _stores[ fname ] = rbc_framestore.open_store( fname )
+    return _stores[ fname ][ ind ]
+
+def _persistence_task( args ):
+    """
+    Pool.imap() helper. Computes the diagrams of a chunk of frames,
+    loading them in the worker so no frames are pickled.
+    """
+    frames, dims = args
+    return [ ( k, persistence( _load( fname, ind ), dims ) )
+             for k, fname, ind in frames ]
+
+def persistence_cell( src, output, dims=(0, 1), nproc=None, chunk=10, flush=500,
+                      name=None ):
+    """
+    Compute the diagrams of every frame of <src> (frame store or
+    directory of per-frame NPY files) on <nproc> processes (default
+    cpu_count()), and append them to the diagram store <output> (see
+    rbc_diagrams). Frames already in the store are skipped.
+
+    chunk -- frames per task
+
+    flush -- write the store to disk every <flush> frames
+
+    name -- cell of the NPY files in <src> (see frame_source())
+
+    Returns the DiagramStore.
+    """
+    dgms = rbc_diagrams.open_diagrams( output, dims )
+    frames = [ f for f in frame_source( src, name ) if f[0] not in dgms ]
+    tasks = [ ( frames[i:i+chunk], dims ) for i in xrange( 0, len( frames ), chunk ) ]
+    if nproc is None:
+        nproc = cpu_count()
+    nproc = max( 1, min( nproc, len( tasks ) ) )
+    tstart = time.time()
+    if nproc == 1:
+        pool = None
+        results = ( _persistence_task( t ) for t in tasks )
+    else:
+        pool = Pool( processes=nproc )
+        results = pool.imap( _persistence_task, tasks )
+    n = 0
+    try:
+        for result in results:
+            for k, diagrams in result:
+                dgms.append( k, diagrams )
+                n += 1
+                if n % flush == 0:
+                    dgms.flush()
+    finally:
+        dgms.flush()
+        if pool is not None:
+            pool.close()
+            pool.join()
+    print "It took ", time.time() - tstart, "seconds for", n, \
+        "frames using", nproc, "processes."
+    return dgms
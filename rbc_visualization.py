@@ -19,6 +19,7 @@ import scipy.io
 import os
 import cPickle as pkl
 import rbc_processing as rp
+import rbc_framestore
 
 def plot_frame( frame, outname=None ):
     """
@@ -192,15 +193,19 @@ def plot_interlevels (file, persFile, output, interval, r, mask=False):
 def create_3d_sublevels( folder, file, frameList, heightList, output, ext='npy' ):
     """
         This function creates .mats to view with Matlab or .npy
-        - folder is directory to cells, ends in '/'
+        - folder is directory to cells, ends in '/', or a frame store
+        (see rbc_framestore), in which case file is ignored
         - file is category of cell, ex. new_110125
         - frameList is numbers of frames to calculate on
         - heightList is list of heights for sublevel sets
         - output is output file for .mat files
         - ext is extension '.npy' or 'm'
         """
+    store = None
+    if rbc_framestore.is_store(folder):
+        store = rbc_framestore.open_store(folder)
     #correcting data
-    if folder.endswith('/') == False:
+    elif folder.endswith('/') == False:
         folder = folder + '/'
     #processing variables
     interm = '-concatenated-ASCII_'
@@ -210,9 +215,13 @@ def create_3d_sublevels( folder, file, frameList, heightList, output, ext='npy'
         stack = []
         for f in frameList:
             #frame processing
-            dir = folder + file + '/'
-            frame = dir + file + interm + str(f) + '.npy'
-            data = numpy.load(frame)
+            if store is not None:
+                #copy, the memmap is read-only
+                data = numpy.array(store[f])
+            else:
+                dir = folder + file + '/'
+                frame = dir + file + interm + str(f) + '.npy'
+                data = numpy.load(frame)
             #find superlevel set and set to 0
             d = numpy.where(data>h)
             data[d] = 0